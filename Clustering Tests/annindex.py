@@ -0,0 +1,216 @@
+'''
+Approximate nearest neighbour index over image features, for "similar photos"
+queries without a brute force pass over every image.
+
+The hierarchical k-means tree the clusterers already build is used as the
+coarse quantizer (an IVF index where the inverted lists are the leaves). A
+query walks down the tree keeping the nprobe nodes whose centroids are nearest
+at every level (a beam search), then compares exactly against the images in
+the leaves it ends up in. Features are stored in leaf order, so every node's
+images are one contiguous range of rows, and the feature matrix can be memory
+mapped: a query only touches the rows of the leaves it probes.
+
+Saved as a directory with index.npz (the tree) and features.npy.
+
+Look up photos similar to one already in the index:
+  python "Clustering Tests/annindex.py" ./output/keras-index ./example-data/images/x.JPEG -k 10
+'''
+import os
+import argparse
+from functools import partial
+import numpy as np
+import treebuilder as tb
+
+METRICS = ('euclidean', 'cosine')
+
+
+def _normalize(X):
+    norms = np.linalg.norm(X, axis=-1, keepdims=True)
+    return X / np.maximum(norms, 1e-12)
+
+
+class TreeIndex:
+    '''
+    Nodes are numbered in pre-order, like treebuilder numbers them.
+    centroids - mean feature of every node
+    child_offsets, children - children of node i are
+        children[child_offsets[i]:child_offsets[i + 1]]
+    start, end - rows of features under node i are start[i]:end[i]
+    ids - original index of every row of features
+    features - features in leaf order (float32, possibly memory mapped)
+    names - optional path of every original index
+    metric - 'euclidean' or 'cosine'
+    '''
+    def __init__(self, centroids, child_offsets, children, start, end, ids, features, names=None,
+                 metric='euclidean'):
+        if metric not in METRICS:
+            raise ValueError(f'Unknown metric {metric}, expected one of {METRICS}')
+        self.centroids = centroids
+        self.centroid_norms = np.einsum('ij,ij->i', centroids, centroids)
+        self.child_offsets = child_offsets
+        self.children = children
+        self.start = start
+        self.end = end
+        self.ids = ids
+        self.features = features
+        self.names = names
+        self.metric = metric
+        self._rows = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def from_tree(cls, root, X, names=None, metric='euclidean'):
+        '''
+        Index X using an existing treebuilder tree (e.g. the one a clusterer
+        just built on X).
+        '''
+        X = np.asarray(X, dtype=np.float32).reshape(len(X), -1)
+        if metric == 'cosine':
+            X = _normalize(X)
+        nodes = list(tb.preorder(root))
+        n_nodes = len(nodes)
+        child_offsets = np.zeros(n_nodes + 1, dtype=np.int64)
+        child_offsets[1:] = np.cumsum([len(node.children or []) for node in nodes])
+        children = np.array([child.id for node in nodes for child in node.children or []], dtype=np.int64)
+
+        # leaves in pre-order, so every subtree is a contiguous range of rows
+        start = np.zeros(n_nodes, dtype=np.int64)
+        end = np.zeros(n_nodes, dtype=np.int64)
+        ids = []
+        row = 0
+        for node in nodes:
+            if node.children is None:
+                start[node.id] = row
+                row += node.size
+                end[node.id] = row
+                ids.append(node.indices)
+        for node in reversed(nodes):
+            if node.children is not None:
+                start[node.id] = start[node.children[0].id]
+                end[node.id] = end[node.children[-1].id]
+        ids = np.concatenate(ids).astype(np.int64)
+
+        centroids = tb.node_means(root, X)
+        if metric == 'cosine':
+            centroids = _normalize(centroids)
+        return cls(centroids, child_offsets, children, start, end, ids, X[ids],
+                   names=None if names is None else np.asarray(names, dtype=str), metric=metric)
+
+    @classmethod
+    def build(cls, X, names=None, k=16, leaf_size=64, max_depth=20, metric='euclidean', split=None,
+              workers=None):
+        '''
+        Build the tree and the index.
+        k - branching factor
+        leaf_size - nodes with fewer images than this aren't split
+        split - treebuilder split function, k-means by default
+            (streamkmeans.minibatch_kmeans_split for big corpora)
+        '''
+        X = np.asarray(X, dtype=np.float32).reshape(len(X), -1)
+        data = _normalize(X) if metric == 'cosine' else X
+        root = tb.build_tree(data, split or partial(tb.kmeans_split, k=k), split_threshold=leaf_size,
+                             max_depth=max_depth, workers=workers)
+        return cls.from_tree(root, X, names=names, metric=metric)
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        arrays = dict(centroids=self.centroids, child_offsets=self.child_offsets, children=self.children,
+                      start=self.start, end=self.end, ids=self.ids, metric=self.metric)
+        if self.names is not None:
+            arrays['names'] = self.names
+        np.savez(os.path.join(directory, 'index.npz'), **arrays)
+        np.save(os.path.join(directory, 'features.npy'), np.ascontiguousarray(self.features, dtype=np.float32))
+
+    @classmethod
+    def load(cls, directory, mmap=True):
+        '''mmap - leave the features on disk and only read the rows queries need'''
+        data = np.load(os.path.join(directory, 'index.npz'))
+        features = np.load(os.path.join(directory, 'features.npy'), mmap_mode='r' if mmap else None)
+        return cls(data['centroids'], data['child_offsets'], data['children'], data['start'], data['end'],
+                   data['ids'], features, names=data['names'] if 'names' in data else None,
+                   metric=str(data['metric']))
+
+    def _probe(self, q, nprobe):
+        '''Beam search down the tree. Returns the (up to nprobe) leaves to scan.'''
+        frontier = np.zeros(1, dtype=np.int64)
+        while True:
+            counts = self.child_offsets[frontier + 1] - self.child_offsets[frontier]
+            if not counts.any():
+                return frontier
+            internal = frontier[counts > 0]
+            expanded = np.concatenate([frontier[counts == 0]] +
+                                      [self.children[self.child_offsets[i]:self.child_offsets[i + 1]]
+                                       for i in internal])
+            if len(expanded) <= nprobe:
+                frontier = expanded
+                continue
+            d = self.centroid_norms[expanded] - 2 * (self.centroids[expanded] @ q)
+            frontier = expanded[np.argpartition(d, nprobe - 1)[:nprobe]]
+
+    def query(self, q, k=10, nprobe=16):
+        '''
+        The approximate k nearest images to feature q.
+        nprobe - nodes kept per level; higher is slower but more accurate
+        Returns (ids, distances), nearest first. ids index the X the
+        index was built from.
+        '''
+        q = np.asarray(q, dtype=np.float32).ravel()
+        if self.metric == 'cosine':
+            q = _normalize(q)
+        leaves = np.sort(self._probe(q, nprobe)) # sorted so memory mapped reads go forwards
+        rows = np.concatenate([np.arange(self.start[i], self.end[i]) for i in leaves])
+        candidates = np.asarray(self.features[rows])
+        if self.metric == 'cosine':
+            d = 1 - candidates @ q
+        else:
+            d = np.einsum('ij,ij->i', candidates, candidates) - 2 * (candidates @ q) + q @ q
+        k = min(k, len(rows))
+        best = np.argpartition(d, k - 1)[:k]
+        best = best[np.argsort(d[best])]
+        d = d[best]
+        if self.metric == 'euclidean':
+            d = np.sqrt(np.maximum(d, 0))
+        return self.ids[rows[best]], d
+
+    def query_batch(self, Q, k=10, nprobe=16):
+        '''query for every row of Q. Rows with fewer than k results are padded with -1 / inf.'''
+        Q = np.asarray(Q, dtype=np.float32).reshape(len(Q), -1)
+        ids = np.full((len(Q), k), -1, dtype=np.int64)
+        distances = np.full((len(Q), k), np.inf, dtype=np.float32)
+        for i, q in enumerate(Q):
+            found, d = self.query(q, k, nprobe)
+            ids[i, :len(found)] = found
+            distances[i, :len(found)] = d
+        return ids, distances
+
+    def feature(self, i):
+        '''Stored (normalized for cosine) feature of original index i.'''
+        if self._rows is None:
+            self._rows = np.empty(len(self.ids), dtype=np.int64)
+            self._rows[self.ids] = np.arange(len(self.ids))
+        return np.asarray(self.features[self._rows[i]])
+
+    def similar(self, name, k=10, nprobe=16):
+        '''Images most similar to one already in the index, by path. Returns [(path, distance)].'''
+        if self.names is None:
+            raise ValueError('This index was built without names')
+        matches = np.flatnonzero(self.names == name)
+        if not len(matches):
+            raise KeyError(name)
+        ids, d = self.query(self.feature(matches[0]), k + 1, nprobe)
+        return [(str(self.names[i]), float(dist)) for i, dist in zip(ids, d) if i != matches[0]][:k]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Find photos similar to a photo in a saved index')
+    parser.add_argument('index', help='directory the index was saved to')
+    parser.add_argument('photo', help='path of the photo, as it was indexed')
+    parser.add_argument('-k', type=int, default=10)
+    parser.add_argument('--nprobe', type=int, default=16)
+    args = parser.parse_args()
+
+    index = TreeIndex.load(args.index)
+    for path, distance in index.similar(args.photo, args.k, args.nprobe):
+        print(f'{distance:.4f}  {path}')
@@ -7,158 +7,202 @@ Code by Fred Choi
 
 import os
 import argparse
-import cv2
 from glob import glob
-from sklearn.cluster import k_means
+from functools import partial
 from sklearn.cluster import AffinityPropagation
 from sklearn.cluster import mean_shift
 import numpy as np
-import json
 import clusternode as cn
-
-print("Loading images...")
-filenames = glob('./example-data/images/*.JPEG')
-images = [cv2.imread(fname) for fname in filenames]
-
-def hierarchical_k_means(xs, names, k=7, split_threshold=10, max_depth=10):
+import imageloader
+import treebuilder as tb
+import streamkmeans
+import incremental
+import centroidwriter
+import quantize
+import kselect
+import colorfeatures
+import instrument
+
+def leaf_node(names, i):
+  return cn.ClusterNode(os.path.basename(names[i]), names[i], 1)
+
+def affinity_propagation_split(xs, indices):
+  clustering = AffinityPropagation().fit(xs[indices])
+  # the exemplars, as indices into the full data set
+  return clustering.labels_, indices[clustering.cluster_centers_indices_]
+
+def mean_shift_split(xs, indices):
+  cluster_centers, labels = mean_shift(xs[indices])
+  return labels, cluster_centers
+
+def hierarchical_k_means(xs, names, image_shape, k=7, split_threshold=10, max_depth=10, workers=None,
+                         minibatch=False, batch_size=1024, state_path=None, writer=None, k_range=None,
+                         criterion='silhouette', images=None):
   '''
   Compute the hierarchical k means of a (transformed) data set.
 
-  xs - input data
-  ys - labels (to keep track of whats in which cluster)
+  xs - input data, can be compressed (see quantize)
+  names - labels (to keep track of whats in which cluster)
+  image_shape - shape to reshape the centroids to when writing them out
   k - branching factor. How many clusters per level.
   split_threshold and max_depth - stopping point for recursion
+  workers - processes to build subtrees on (see treebuilder)
+  minibatch - use streaming mini-batch k-means (see streamkmeans), so xs can
+    be a memmap bigger than RAM
+  batch_size - rows per mini-batch
+  state_path - if set, save what's needed to add images later (see incremental)
+  writer - centroidwriter.CentroidWriter for the centroid images (a default one if None)
+  k_range - (smallest, largest) k to choose from at every node instead of a
+    fixed k (see kselect). k is still what incremental updates split with.
+  criterion - how k_range candidates are compared, 'silhouette' or 'calinski'
+  images - the images, when xs are descriptors (see colorfeatures) rather
+    than the pixels. The previews are then the mean images of the clusters.
   '''
-  cluster = cn.ClusterNode()
-  cluster.size = xs.shape[0]
-
-  if xs.shape[0] < split_threshold or max_depth <= 0:
-    cluster.children = [cn.ClusterNode(os.path.basename(name) , name , 1) for name in names]
+  if isinstance(xs, quantize.PQCodes):
+    split = quantize.pq_kmeans_split
+  elif minibatch:
+    split = partial(streamkmeans.minibatch_kmeans_split, batch_size=batch_size)
+  else:
+    split = tb.kmeans_split
+  tree = tb.build_tree(xs, tb.make_split(split, k, k_range, criterion), split_threshold=split_threshold,
+                       max_depth=max_depth, workers=workers)
+  if state_path is not None:
+    # (xs can't be PQCodes here, the state needs uncompressed features)
+    state_images = images if images is not None else xs.reshape((-1,) + tuple(image_shape))
+    incremental.TreeState.from_tree(tree, xs, state_images, names, k=k,
+                                    split_threshold=split_threshold, max_depth=max_depth,
+                                    centroid_pattern='./output/centroids/kmeans-centroid-{}.JPEG').save(state_path)
+  # previews are the mean images when xs are descriptors, the k-means centers when they're the pixels
+  if images is not None:
+    return tb.cluster_nodes(tree, images, names, './output/centroids/kmeans-centroid-{}.JPEG', writer)
+
+  def make_cluster(node):
+    cluster = cn.ClusterNode(size=node.size)
+    if node.center is not None:
+      # output the centroids to a separate file
+      centroid_outname = './output/centroids/kmeans-centroid-' + str(node.id) + '.JPEG'
+      cluster.name = f'cluster {node.id + 1}'
+      cluster.preview = writer.write(centroid_outname, node.center.reshape(image_shape))
     return cluster
-  # print(k_means(xs, k))
-  centroids, labels, _ = k_means(xs, k)
-
-  cluster.children = []
-  for i in range(k):
-    cluster_xs = xs[labels==i]
-    cluster_names = names[labels==i]
-    subcluster = hierarchical_k_means(cluster_xs, cluster_names, k, split_threshold=split_threshold, max_depth=max_depth-1)
-
-    # output the centroids to a separate file
-    global cluster_id
-    centroid_outname = './output/centroids/kmeans-centroid-' + str(cluster_id) + '.JPEG'
-    cluster_id += 1
-    subcluster.name = f'cluster {cluster_id}'
-    subcluster.preview = centroid_outname
-    cv2.imwrite(centroid_outname, centroids[i].reshape(images[0].shape))
 
-    cluster.children.append(subcluster)
+  with centroidwriter.using(writer) as writer:
+    return tb.convert(tree, make_cluster, partial(leaf_node, names))
 
-  return cluster
-
-def hierarchical_affinity_propagation(xs, names, split_threshold=10, max_depth=10):
+def hierarchical_affinity_propagation(xs, names, split_threshold=10, max_depth=10, workers=None):
   '''
   Compute the hierarchical affinity propagation clustering of a (transformed) data set.
 
   xs - input data
-  ys - labels (to keep track of whats in which cluster)
+  names - labels (to keep track of whats in which cluster)
   split_threshold and max_depth - stopping point for recursion
+  workers - processes to build subtrees on (see treebuilder)
   '''
-  cluster = cn.ClusterNode()
-  cluster.size = xs.shape[0]
-
-  if xs.shape[0] < split_threshold or max_depth <= 0:
-    cluster.children = [cn.ClusterNode(os.path.basename(name) , name , 1) for name in names]
+  tree = tb.build_tree(xs, affinity_propagation_split, split_threshold=split_threshold,
+                       max_depth=max_depth, workers=workers)
+
+  def make_cluster(node):
+    cluster = cn.ClusterNode(size=node.size)
+    if node.center is not None:
+      cluster.name = f'cluster {node.id + 1}'
+      cluster.preview = names[node.center]
     return cluster
 
-  clustering = AffinityPropagation().fit(xs)
-  n_clusters = clustering.cluster_centers_indices_.shape[0]
-
-  if n_clusters > 1:
-    cluster.children = []
-    for i in range(n_clusters):
-      cluster_xs = xs[clustering.labels_==i]
-      cluster_names = names[clustering.labels_==i]
-      subcluster = hierarchical_affinity_propagation(cluster_xs, cluster_names, split_threshold=split_threshold, max_depth=max_depth-1)
-
-      global cluster_id
-      cluster_id += 1
-      subcluster.name = f'cluster {cluster_id}'
-      subcluster.preview = names[clustering.cluster_centers_indices_[i]]
-
-      cluster.children.append(subcluster)
-  else:
-    cluster.children = [cn.ClusterNode(os.path.basename(name) , name , 1) for name in names]
-
-  return cluster 
+  return tb.convert(tree, make_cluster, partial(leaf_node, names))
 
-def hierarchical_mean_shift(xs, names, split_threshold=10, max_depth=10):
+def hierarchical_mean_shift(xs, names, image_shape, split_threshold=10, max_depth=10, workers=None, writer=None):
   '''
   Compute the hierarchical mean shift clustering of a (transformed) data set.
 
   xs - input data
-  ys - labels (to keep track of whats in which cluster)
+  names - labels (to keep track of whats in which cluster)
+  image_shape - shape to reshape the centers to when writing them out
   split_threshold and max_depth - stopping point for recursion
+  workers - processes to build subtrees on (see treebuilder)
+  writer - centroidwriter.CentroidWriter for the center images (a default one if None)
   '''
-  cluster = cn.ClusterNode()
-  cluster.size = xs.shape[0]
-
-  if xs.shape[0] < split_threshold or max_depth <= 0:
-    cluster.children = [cn.ClusterNode(os.path.basename(name) , name , 1) for name in names]
-    return cluster
-
-  cluster_centers, labels = mean_shift(xs)
-  n_clusters = cluster_centers.shape[0]
-
-  if n_clusters > 1:
-    cluster.children = []
-    for i in range(n_clusters):
-      cluster_xs = xs[labels==i]
-      cluster_names = names[labels==i]
-      subcluster = hierarchical_mean_shift(cluster_xs, cluster_names, split_threshold=split_threshold, max_depth=max_depth-1)
+  tree = tb.build_tree(xs, mean_shift_split, split_threshold=split_threshold,
+                       max_depth=max_depth, workers=workers)
 
+  def make_cluster(node):
+    cluster = cn.ClusterNode(size=node.size)
+    if node.center is not None:
       # output the centroids to a separate file
-      global cluster_id
-      centroid_outname = './output/centroids/meanshift-center-' + str(cluster_id) + '.JPEG'
-      cluster_id += 1
-      subcluster.name = f'cluster {cluster_id}'
-      subcluster.preview = centroid_outname
-      cv2.imwrite(centroid_outname, cluster_centers[i].reshape(images[0].shape))
-
-      cluster.children.append(subcluster)
-  else:
-    cluster.children = [cn.ClusterNode(os.path.basename(name), name , 1) for name in names]
-
-  return cluster
-
-xs = np.stack(images).reshape(len(images), -1)  
-
-
-print("Clustering (K-Means)...")
-cluster_id = 0 # give a unique id to each cluster
-kmeans = hierarchical_k_means(xs, np.array(filenames))
-
-f = open('./output/kmeans.json', 'w')
-f.write(kmeans.json())
-f.write('\n')
-f.close()
-
-# print("Clustering (Affinity Propagation)...")
-# cluster_id = 0 
-# aprop = hierarchical_affinity_propagation(xs, np.array(filenames))
-
-# f = open('./output/affinity-prop.json', 'w')
-# f.write(aprop.json())
-# f.write('\n')
-# f.close()
-
-# print("Clustering (Mean Shift)...")
-# cluster_id = 0 
-# mean_shift = hierarchical_mean_shift(xs, np.array(filenames))
-
-# f = open('./output/mean-shift.json', 'w')
-# f.write(mean_shift.json())
-# f.write('\n')
-# f.close()
+      centroid_outname = './output/centroids/meanshift-center-' + str(node.id) + '.JPEG'
+      cluster.name = f'cluster {node.id + 1}'
+      cluster.preview = writer.write(centroid_outname, node.center.reshape(image_shape))
+    return cluster
 
-print("Done!")
\ No newline at end of file
+  with centroidwriter.using(writer) as writer:
+    return tb.convert(tree, make_cluster, partial(leaf_node, names))
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Hierarchical clustering on raw pixels')
+  parser.add_argument('--minibatch', action='store_true', help='use streaming mini-batch k-means')
+  parser.add_argument('--batch-size', type=int, default=1024)
+  parser.add_argument('--memmap', help='decode the images into this .npy file instead of RAM')
+  parser.add_argument('--workers', type=int, default=None)
+  parser.add_argument('--state', help='.npz file to save the tree state to, or update from')
+  parser.add_argument('--update', metavar='GLOB', help='add these images to the tree saved in --state')
+  parser.add_argument('--compress', choices=['float16', 'pq'], help='cluster on compressed pixels (see quantize)')
+  parser.add_argument('--pq-subspaces', type=int, default=64, help='bytes per image with --compress pq')
+  parser.add_argument('--shard', metavar='DIR', help='also write the tree as shards the viewer can load on demand')
+  parser.add_argument('--shard-levels', type=int, default=3, help='tree levels per shard file')
+  parser.add_argument('--adaptive-k', type=int, nargs=2, metavar=('MIN', 'MAX'),
+                      help='choose the branching factor per node from this range (see kselect)')
+  parser.add_argument('--k-criterion', choices=kselect.CRITERIA, default='silhouette')
+  parser.add_argument('--features', choices=['pixels', 'color'], default='pixels',
+                      help='cluster on the raw pixels or on compact color descriptors (see colorfeatures)')
+  instrument.add_arguments(parser)
+  args = parser.parse_args()
+  instrument.setup(args)
+
+  if args.update and not args.state:
+    parser.error('--update needs the --state the tree was built with')
+  if args.state and args.compress == 'pq':
+    parser.error('--state needs uncompressed features')
+
+  if args.update:
+    print("Adding images...")
+    new_filenames = glob(args.update)
+    new_images = imageloader.load_images(new_filenames)
+    new_xs = colorfeatures.describe(new_images) if args.features == 'color' else new_images.reshape(len(new_images), -1)
+    incremental.update(args.state, './output/kmeans.json', new_xs, new_images, new_filenames)
+    print("Done!")
+    raise SystemExit
+
+  print("Loading images...")
+  filenames = glob('./example-data/images/*.JPEG')
+  images = imageloader.load_images(filenames, memmap_path=args.memmap)
+
+  xs = images.reshape(len(images), -1) # a view, no copy
+  if args.features == 'color':
+    print("Computing color descriptors...")
+    xs = colorfeatures.describe(images)
+  if args.compress == 'float16':
+    xs = quantize.to_float16(xs)
+  elif args.compress == 'pq':
+    print("Compressing...")
+    xs = quantize.PQCodes.compress(xs, m=args.pq_subspaces)
+
+  print("Clustering (K-Means)...")
+  with instrument.span('clustering'), instrument.profile('clustering'):
+    kmeans = hierarchical_k_means(xs, np.array(filenames), images.shape[1:], workers=args.workers,
+                                  minibatch=args.minibatch, batch_size=args.batch_size, state_path=args.state,
+                                  k_range=args.adaptive_k, criterion=args.k_criterion,
+                                  images=images if args.features == 'color' else None)
+
+  cn.save_json(kmeans, './output/kmeans.json')
+  if args.shard:
+    cn.save_sharded(kmeans, args.shard, levels=args.shard_levels)
+
+  # print("Clustering (Affinity Propagation)...")
+  # aprop = hierarchical_affinity_propagation(xs, np.array(filenames))
+
+  # cn.save_json(aprop, './output/affinity-prop.json')
+
+  # print("Clustering (Mean Shift)...")
+  # mean_shift = hierarchical_mean_shift(xs, np.array(filenames), images.shape[1:])
+
+  # cn.save_json(mean_shift, './output/mean-shift.json')
+
+  print("Done!")
@@ -0,0 +1,238 @@
+'''
+Benchmarks for the clustering stages on synthetic, seeded image corpora.
+
+A corpus of any size is generated from a few classes like the ones in train/
+(grass, ocean, redcarpet, ...): every class has its own colors and gradient
+direction, and every image gets its own noise and brightness, so the
+clusterers have real structure to find. Each stage (load, hashing, feature
+extraction, distances, clustering, centroid writing, json output) is timed
+and its peak RSS and throughput recorded to a json file, which can be compared
+against a saved baseline.
+
+  python "Clustering Tests/benchmark.py" --sizes 1000 10000 --out ./output/bench/results.json
+  python "Clustering Tests/benchmark.py" --sizes 1000 10000 --compare ./output/bench/baseline.json
+
+Corpora are cached in ./output/bench/, so only the first run per size and seed
+pays for generating them.
+'''
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import resource
+import subprocess
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+import imageloader
+import featurecache
+import distances
+import treebuilder as tb
+import centroidwriter
+import dendrogram
+import pipeline
+import colorfeatures
+from clusternode import save_json
+
+DEFAULT_ROOT = './output/bench'
+
+# base BGR colors and gradient direction of each class
+CLASSES = {
+    'grass': ((40, 140, 60), (20, 200, 90), 0),
+    'ocean': ((140, 90, 20), (220, 170, 80), 90),
+    'redcarpet': ((30, 30, 150), (60, 60, 220), 45),
+    'sand': ((120, 180, 200), (170, 220, 240), 135),
+    'night': ((40, 20, 10), (90, 60, 40), 60),
+    'snow': ((220, 220, 220), (255, 250, 245), 30),
+}
+
+
+def synthetic_image(rng, cls, shape):
+    '''One image of a class: a noisy two color gradient, randomly tilted and lit.'''
+    (low, high, angle) = CLASSES[cls]
+    h, w = shape[:2]
+    angle = np.deg2rad(angle + rng.normal(0, 15))
+    y, x = np.mgrid[0:h, 0:w]
+    t = (np.cos(angle) * x / w + np.sin(angle) * y / h)
+    t = (t - t.min()) / max(np.ptp(t), 1e-6)
+    img = np.asarray(low, dtype=np.float32) + t[..., None] * (np.asarray(high) - np.asarray(low))
+    img *= rng.uniform(0.8, 1.2) # brightness
+    img += rng.normal(0, 12, size=img.shape) # texture
+    return np.clip(img, 0, 255).astype(np.uint8)
+
+
+def make_corpus(n, shape=(48, 64, 3), seed=0, root=DEFAULT_ROOT, workers=None):
+    '''
+    Generate (or reuse) a corpus of n images. Images are generated from
+    per-image seeds, so a corpus is the same whatever order it's written in.
+    Returns the list of paths.
+    '''
+    directory = os.path.join(root, f'corpus-{n}-{seed}-{"x".join(map(str, shape))}')
+    names = [f'{cls}_{i:06d}.JPEG' for i, cls in zip(range(n), (list(CLASSES) * n)[:n])]
+    paths = [os.path.join(directory, name) for name in names]
+    done = os.path.join(directory, 'complete')
+    if os.path.exists(done):
+        return paths
+    os.makedirs(directory, exist_ok=True)
+
+    def write(i):
+        rng = np.random.default_rng([seed, i])
+        cv2.imwrite(paths[i], synthetic_image(rng, names[i].split('_')[0], shape))
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as pool:
+        list(pool.map(write, range(n)))
+    open(done, 'w').close()
+    return paths
+
+
+def _reset_peak():
+    '''Reset the kernel's peak RSS counter (Linux), so each stage gets its own peak.'''
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is the peak of the whole process, in KB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def measure(fn, items, repeat=1):
+    '''
+    Run fn repeat times. Returns (its last result, stats) where stats holds
+    the best wall time, the peak RSS and items per second.
+    '''
+    times = []
+    for _ in range(repeat):
+        _reset_peak()
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    seconds = min(times)
+    return result, {'seconds': round(seconds, 4), 'peak_rss_mb': round(_peak_rss_mb(), 1), 'items': items,
+                    'per_second': round(items / seconds, 1) if seconds > 0 else None}
+
+
+def run(n, shape=(48, 64, 3), seed=0, k=7, repeat=1, max_dense=20000, root=DEFAULT_ROOT, workers=None):
+    '''
+    Benchmark every stage on a corpus of n images. Returns {stage: stats}.
+    max_dense - skip the O(n^2) dense distance stage above this many images
+    '''
+    results = {}
+
+    def stage(name, fn, items=n):
+        result, stats = measure(fn, items, repeat)
+        results[name] = stats
+        print(f'  {name:<14} {stats["seconds"]:>9.3f}s {stats["peak_rss_mb"]:>9.1f}MB '
+              f'{stats["per_second"] or 0:>12.1f}/s')
+        return result
+
+    print(f'Generating {n} images...')
+    paths = make_corpus(n, shape, seed, root, workers)
+    print(f'{n} images:')
+    images = stage('load', lambda: imageloader.load_images(paths, workers=workers))
+    hashes = stage('hash', lambda: featurecache.hash_files(paths, workers=workers))
+    names = np.array(paths)
+    stage('phash', lambda: pipeline.phash(images, names))
+    colors = stage('colorhist', lambda: pipeline.colorhist(images, names))
+    stage('color', lambda: colorfeatures.describe(images))
+    reduced = stage('pca', lambda: pipeline.pca(images.reshape(n, -1), n_components=20))
+    if n <= max_dense:
+        stage('distances', lambda: distances.condensed(reduced, workers=workers), n * (n - 1) // 2)
+    stage('knn', lambda: distances.knn(reduced, 15, workers=workers))
+    tree = stage('kmeans', lambda: tb.build_tree(reduced, partial(tb.kmeans_split, k=k), workers=workers))
+    stage('agglomerative', lambda: dendrogram.to_tree(
+        dendrogram.sparse_linkage(distances.knn_graph(*distances.knn(colors, 15, workers=workers))), k=k))
+    nodes = len(list(tb.preorder(tree)))
+    out = os.path.join(root, 'scratch')
+    os.makedirs(out, exist_ok=True)
+
+    def write_centroids():
+        # a fresh writer each time, and a fresh directory so nothing is skipped as unchanged
+        for name in os.listdir(out):
+            os.remove(os.path.join(out, name))
+        with centroidwriter.CentroidWriter(workers=workers) as writer:
+            return tb.cluster_nodes(tree, images, names, os.path.join(out, 'centroid-{}.JPEG'), writer)
+    clusters = stage('centroids', write_centroids, nodes)
+    stage('json', lambda: save_json(clusters, os.path.join(root, 'scratch.json')), nodes + n)
+    return results
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, threshold=0.1):
+    '''
+    Print the change in time of every stage against a baseline results file.
+    Returns the (size, stage) pairs more than threshold slower.
+    '''
+    slower = []
+    print(f'{"size":>8} {"stage":<14} {"baseline":>10} {"now":>10} {"change":>8}')
+    for size, stages in results['sizes'].items():
+        for name, stats in stages.items():
+            before = baseline.get('sizes', {}).get(size, {}).get(name)
+            if before is None:
+                continue
+            change = stats['seconds'] / before['seconds'] - 1 if before['seconds'] else 0
+            flag = ''
+            if change > threshold:
+                flag = '  slower'
+                slower.append((size, name))
+            elif change < -threshold:
+                flag = '  faster'
+            print(f'{size:>8} {name:<14} {before["seconds"]:>9.3f}s {stats["seconds"]:>9.3f}s {change:>+8.1%}{flag}')
+    return slower
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the clustering stages on synthetic corpora')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000])
+    parser.add_argument('--shape', type=int, nargs=3, default=[48, 64, 3], metavar=('H', 'W', 'C'))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=1, help='runs per stage, the fastest counts')
+    parser.add_argument('--max-dense', type=int, default=20000, help='largest size to run dense distances on')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--root', default=DEFAULT_ROOT, help='where corpora and scratch output go')
+    parser.add_argument('--out', help='json file to write the results to')
+    parser.add_argument('--compare', metavar='BASELINE', help='results json to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative slowdown reported as a regression')
+    args = parser.parse_args()
+
+    results = {
+        'meta': {'seed': args.seed, 'shape': args.shape, 'repeat': args.repeat, 'commit': _git_commit(),
+                 'python': platform.python_version(), 'numpy': np.__version__, 'cpus': os.cpu_count(),
+                 'machine': platform.machine(), 'workers': args.workers},
+        'sizes': {},
+    }
+    for n in args.sizes:
+        results['sizes'][str(n)] = run(n, tuple(args.shape), args.seed, repeat=args.repeat,
+                                       max_dense=args.max_dense, root=args.root, workers=args.workers)
+    if args.out:
+        os.makedirs(os.path.dirname(args.out) or '.', exist_ok=True)
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+            f.write('\n')
+    if args.compare:
+        with open(args.compare) as f:
+            slower = compare(results, json.load(f), args.threshold)
+        if slower:
+            raise SystemExit(1)
@@ -0,0 +1,138 @@
+'''
+Background writer for centroid preview images.
+
+Clustering used to block on cv2.imwrite for every node. A CentroidWriter
+queues the images on a thread pool instead (cv2 releases the GIL while
+encoding), and remembers a content hash of every file it wrote in a manifest
+next to the images. If a centroid's pixels and encoding settings haven't
+changed since the last run the file is left alone, so incremental rebuilds only
+rewrite what changed.
+'''
+import os
+import json
+import hashlib
+import threading
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+import instrument
+
+MANIFEST_NAME = '.centroids-manifest.json'
+
+EXTENSIONS = {'JPEG': '.JPEG', 'WEBP': '.webp', 'PNG': '.png'}
+
+
+def to_uint8(image):
+    '''Round a (float) mean image to uint8 rather than letting imwrite truncate it.'''
+    if image.dtype == np.uint8:
+        return image
+    return np.clip(np.rint(image), 0, 255).astype(np.uint8)
+
+
+class CentroidWriter:
+    '''
+    Writes images on a thread pool, skipping files whose content is unchanged.
+    Use as a context manager, or call close() to wait for pending writes and
+    save the manifests.
+    fmt - 'JPEG', 'WEBP' or 'PNG'. Paths get the matching extension.
+    quality - JPEG/WebP quality, 0-100
+    workers - encoder threads
+    max_pending - images queued at most, write() waits for the oldest beyond
+        that so a fast producer doesn't pile them all up in memory
+    '''
+    def __init__(self, fmt='JPEG', quality=95, workers=None, max_pending=None):
+        fmt = fmt.upper()
+        if fmt not in EXTENSIONS:
+            raise ValueError(f'Unknown format {fmt}, expected one of {list(EXTENSIONS)}')
+        self.fmt = fmt
+        self.quality = quality
+        if fmt == 'JPEG':
+            self.params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+        elif fmt == 'WEBP':
+            self.params = [cv2.IMWRITE_WEBP_QUALITY, quality]
+        else:
+            self.params = []
+        workers = workers or os.cpu_count() or 1
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.futures = deque()
+        self.max_pending = max_pending or 4 * workers
+        self.manifests = {} # directory -> {file name: hash}
+        self.lock = threading.Lock()
+        self.written = 0
+        self.skipped = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def path_for(self, path):
+        '''path with its extension replaced to match the output format.'''
+        return os.path.splitext(path)[0] + EXTENSIONS[self.fmt]
+
+    def _manifest(self, directory):
+        if directory not in self.manifests:
+            manifest_path = os.path.join(directory, MANIFEST_NAME)
+            manifest = {}
+            if os.path.exists(manifest_path):
+                with open(manifest_path) as f:
+                    manifest = json.load(f)
+            self.manifests[directory] = manifest
+        return self.manifests[directory]
+
+    def _write(self, path, image):
+        image = to_uint8(image)
+        h = hashlib.sha1(image.tobytes())
+        h.update(repr((image.shape, self.fmt, self.quality)).encode())
+        digest = h.hexdigest()
+
+        directory, name = os.path.split(path)
+        with self.lock:
+            manifest = self._manifest(directory)
+            unchanged = manifest.get(name) == digest and os.path.exists(path)
+        if unchanged:
+            with self.lock:
+                self.skipped += 1
+            return
+        with instrument.span('imwrite', path=path):
+            if not cv2.imwrite(path, image, self.params):
+                raise IOError(f'Could not write {path}')
+        instrument.count('centroids written')
+        with self.lock:
+            manifest[name] = digest
+            self.written += 1
+
+    def write(self, path, image):
+        '''
+        Queue an image to be written. Returns the path it will be written to
+        (the extension follows the format), to use as the preview.
+        '''
+        path = self.path_for(path)
+        while len(self.futures) >= self.max_pending:
+            self.futures.popleft().result()
+        self.futures.append(self.pool.submit(self._write, path, image))
+        return path
+
+    def close(self):
+        while self.futures:
+            self.futures.popleft().result()
+        self.pool.shutdown()
+        for directory, manifest in self.manifests.items():
+            manifest_path = os.path.join(directory, MANIFEST_NAME)
+            tmp = manifest_path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(manifest, f)
+            os.replace(tmp, manifest_path)
+
+
+@contextmanager
+def using(writer=None):
+    '''Use writer if given, otherwise a default CentroidWriter closed on exit.'''
+    if writer is not None:
+        yield writer
+        return
+    with CentroidWriter() as default:
+        yield default
@@ -1,33 +1,238 @@
+'''
+Cluster tree nodes and their JSON output, shared by all the clustering scripts.
+
+The tree is written without recursion, straight to a file object, so big trees
+don't hit the recursion limit or build the whole string in memory. Names and
+paths go through json.dumps so quotes and backslashes are escaped properly.
+
+save_sharded splits a tree into a small root file and subtree shards that the
+viewer can fetch on demand.
+'''
+import io
+import os
+import json
+import gzip
+import itertools
+import numpy as np
+import instrument
+
+try:
+  import brotli
+except ImportError:
+  brotli = None
+
+# Fields written to the json, in order. children is handled separately.
+FIELDS = ('name', 'preview', 'size', 'x', 'y', 'bounds', 'thumbs', 'atlas', 'sprite', 'shard')
+
 # Used to store the clusters and output them JSON
 class ClusterNode:
-  def __init__(self, name=None, preview=None, size=None):
+  __slots__ = ('name', 'preview', 'children', 'size', 'x', 'y', 'bounds', 'thumbs', 'atlas', 'sprite', 'shard',
+               'avg_img')
+
+  def __init__(self, name=None, preview=None, size=None, x=None, y=None, bounds=None, avg_img=None):
     self.name = name
     self.preview = preview
     self.children = None
     self.size = size
+    self.x = x
+    self.y = y
+    self.bounds = bounds
+    self.thumbs = None # {width: path} of the preview's thumbnails (see thumbnails)
+    self.atlas = None # sprite atlases of the children's previews (see thumbnails)
+    self.sprite = None # [atlas index, x, y, width, height] in the parent's atlases
+    self.shard = None # id of the shard holding the children (see save_sharded)
+    self.avg_img = avg_img # not written to the json
+
+  def json(self, indent=2):
+    f = io.StringIO()
+    write_json(self, f, indent=indent)
+    return f.getvalue()
+
+def _plain(value):
+  '''Turn numpy scalars and arrays into things json.dumps understands.'''
+  if isinstance(value, np.generic):
+    return value.item()
+  if isinstance(value, (list, tuple, np.ndarray)):
+    return [_plain(v) for v in value]
+  return value
+
+def iter_json(root, indent=2):
+  '''
+  Generate the json for a tree piece by piece.
+  indent - spaces per level, or None for compact output
+  '''
+  nl = '\n' if indent else ''
+  colon = ': ' if indent else ':'
+  step = ' ' * indent if indent else ''
+  separators = (', ', ': ') if indent else (',', ':')
+
+  # Either a node to open, (node, level, text after it), or a string to emit
+  stack = [(root, 0, '')]
+  while stack:
+    item = stack.pop()
+    if isinstance(item, str):
+      yield item
+      continue
+
+    node, level, after = item
+    pad = step * level
+    inner = pad + step
+    fields = [inner + '"' + key + '"' + colon + json.dumps(_plain(getattr(node, key, None)), separators=separators)
+              for key in FIELDS if getattr(node, key, None) is not None]
+    children = node.children or []
+
+    if not children:
+      yield pad + '{' + nl + (',' + nl).join(fields) + nl + pad + '}' + after
+      continue
+
+    fields.append(inner + '"children"' + colon + '[')
+    yield pad + '{' + nl + (',' + nl).join(fields) + nl
+    stack.append(nl + inner + ']' + nl + pad + '}' + after)
+    last = len(children) - 1
+    for i in range(last, -1, -1):
+      stack.append((children[i], level + 2, '' if i == last else ',' + nl))
+
+def write_json(root, f, indent=2):
+  '''Stream the json for a tree to a text file object.'''
+  buffer = []
+  for piece in iter_json(root, indent=indent):
+    buffer.append(piece)
+    if len(buffer) >= 4096:
+      f.write(''.join(buffer))
+      buffer = []
+  f.write(''.join(buffer))
+  f.write('\n')
+
+class _BrotliWriter:
+  '''Minimal text file object that brotli-compresses everything written to it.'''
+  def __init__(self, path):
+    self.file = open(path, 'wb')
+    self.compressor = brotli.Compressor()
+
+  def write(self, text):
+    self.file.write(self.compressor.process(text.encode('utf-8')))
+
+  def close(self):
+    self.file.write(self.compressor.finish())
+    self.file.close()
+
+def save_json(root, path, indent=2, compress=None):
+  '''
+  Write a tree to a json file.
+  indent - spaces per level, or None for compact output
+  compress - None, 'gzip' or 'brotli' (needs the brotli package). The
+    extension isn't added automatically.
+  '''
+  if compress is None:
+    f = open(path, 'w', encoding='utf-8')
+  elif compress == 'gzip':
+    f = gzip.open(path, 'wt', encoding='utf-8')
+  elif compress == 'brotli':
+    if brotli is None:
+      raise ImportError('brotli output needs the brotli package')
+    f = _BrotliWriter(path)
+  else:
+    raise ValueError(f'Unknown compression {compress}')
+  try:
+    with instrument.span('save json', path=path):
+      write_json(root, f, indent=indent)
+  finally:
+    f.close()
+
+def from_dict(data):
+  '''Build a ClusterNode tree from parsed json, without recursion.'''
+  def make(d):
+    node = ClusterNode()
+    for key in FIELDS:
+      if key in d:
+        setattr(node, key, d[key])
+    return node
+
+  root = make(data)
+  stack = [(data, root)]
+  while stack:
+    d, node = stack.pop()
+    if 'children' in d:
+      node.children = [make(child) for child in d['children']]
+      stack.extend(zip(d['children'], node.children))
+  return root
 
-  def json(self, level=0):
-    indent = ' '*(2*level)
-    result = indent + '{\n'
+def load_json(path):
+  '''Read a tree written by save_json (gzip compressed if the name ends in .gz).'''
+  opener = gzip.open if path.endswith('.gz') else open
+  with opener(path, 'rt', encoding='utf-8') as f:
+    return from_dict(json.load(f))
 
-    if self.name is not None:
-      result += indent + '  "name" : "' + self.name + '",\n'
+def _copy(node):
+  copy = ClusterNode()
+  for key in FIELDS:
+    setattr(copy, key, getattr(node, key, None))
+  return copy
 
-    if self.preview is not None:
-      result += indent + '  "preview" : "' + self.preview + '",\n'
+def _truncate(root, levels, min_size, ids):
+  '''
+  Copy the top levels of a tree. Bigger clusters below that are cut off:
+  they keep their fields but get a shard id instead of children.
+  Returns the copy and a list of (shard id, cut off node).
+  '''
+  top = _copy(root)
+  cut = []
+  stack = [(root, top, 0)]
+  while stack:
+    node, copy, depth = stack.pop()
+    if not node.children:
+      continue
+    if depth >= levels and (node.size or 0) > min_size:
+      copy.shard = next(ids)
+      cut.append((copy.shard, node))
+      continue
+    copy.children = [_copy(child) for child in node.children]
+    stack.extend((child, child_copy, depth + 1) for child, child_copy in zip(node.children, copy.children))
+  return top, cut
 
-    if self.size is not None:
-      result += indent + '  "size" : ' + str(self.size) + ',\n'
+def save_sharded(root, out_dir, levels=3, min_size=100, indent=None):
+  '''
+  Write a tree as a root file with the top levels, plus one shard file per
+  subtree below them, so the viewer can start from the root file and fetch
+  the rest as clusters are opened. Shards are cut the same way again, so every
+  file holds at most levels + 1 levels of the tree.
+  out_dir - gets root.json, shards/<id>.json and manifest.json
+  levels - levels of the tree per file
+  min_size - clusters of at most this many images are kept inline
+  indent - spaces per level, or None for compact output
+  The manifest lists every shard with its path, number of images and the
+  shard it is referenced from (null for the root file).
+  '''
+  os.makedirs(os.path.join(out_dir, 'shards'), exist_ok=True)
+  ids = itertools.count(1)
+  manifest = {'root': 'root.json', 'levels': levels, 'shards': {}}
 
-    if self.children is not None:
-      result += indent + '  "children" : [\n'
+  pending = [(None, None, root)] # (shard id, shard it's referenced from, subtree)
+  while pending:
+    shard, parent, subtree = pending.pop()
+    top, cut = _truncate(subtree, levels, min_size, ids)
+    if shard is None:
+      path = 'root.json'
+    else:
+      path = f'shards/{shard}.json'
+      manifest['shards'][str(shard)] = {'path': path, 'size': subtree.size, 'parent': parent}
+    save_json(top, os.path.join(out_dir, path), indent=indent)
+    pending.extend((child_shard, shard, node) for child_shard, node in cut)
 
-      for subcluster in self.children:
-        result += subcluster.json(level=level + 2) + ',\n'
-      result = result[:-2] + '\n'
-      result += indent + '  ]\n,'
+  with open(os.path.join(out_dir, 'manifest.json'), 'w') as f:
+    json.dump(manifest, f, indent=indent)
+    f.write('\n')
+  return manifest
 
-    result = result[:-2] + '\n'
-    result += indent + '}'
-    
-    return result
\ No newline at end of file
+def load_sharded(out_dir):
+  '''Read a tree written by save_sharded back into one ClusterNode tree.'''
+  root = load_json(os.path.join(out_dir, 'root.json'))
+  stack = [root]
+  while stack:
+    node = stack.pop()
+    if node.shard is not None:
+      shard = load_json(os.path.join(out_dir, 'shards', f'{node.shard}.json'))
+      node.children = shard.children
+      node.shard = None
+    stack.extend(node.children or [])
+  return root
@@ -0,0 +1,81 @@
+'''
+Small color-aware descriptors to cluster on instead of raw pixels.
+
+Clustering the flattened pixels means tens of thousands of dimensions per
+image, and pHash throws the color away. A descriptor here is
+  - a Lab thumbnail: the image averaged over a grid of blocks (8x8 by
+    default) and converted to Lab, so distances follow perceived color and
+    the rough layout of the picture, and
+  - a joint color histogram (4 bins per channel by default), square rooted so
+    euclidean distance on it is the Hellinger distance,
+256 floats with the defaults. Both are computed for a whole chunk of images
+at once with numpy (block sums with reduceat, histograms with one bincount),
+so there's no per image Python work besides one cvtColor per chunk.
+'''
+import numpy as np
+import cv2
+import imageloader
+
+
+def _grid(grid):
+    return (grid, grid) if np.isscalar(grid) else tuple(grid)
+
+
+def block_means(images, grid=8):
+    '''
+    Mean color of every block of a grid over each image.
+    images - (n, h, w, c) array
+    grid - blocks per side, or (rows, columns). Blocks differ by at most a
+        pixel when the size isn't a multiple.
+    Returns a (n, rows, columns, c) float32 array.
+    '''
+    rows, columns = _grid(grid)
+    n, h, w = images.shape[:3]
+    y = np.linspace(0, h, rows + 1).astype(int)
+    x = np.linspace(0, w, columns + 1).astype(int)
+    sums = np.add.reduceat(np.add.reduceat(images, y[:-1], axis=1, dtype=np.float32), x[:-1], axis=2)
+    areas = (np.diff(y)[:, None] * np.diff(x)[None, :]).astype(np.float32)
+    return sums / areas[None, :, :, None]
+
+
+def lab_thumbnails(images, grid=8):
+    '''
+    Block mean BGR images converted to Lab, scaled so every channel is about
+    -1..1 (L / 100, a and b / 128). Returns (n, rows, columns, 3) float32.
+    '''
+    means = block_means(images, grid)
+    n, rows, columns = means.shape[:3]
+    lab = cv2.cvtColor((means / 255).reshape(n * rows, columns, 3), cv2.COLOR_BGR2Lab)
+    return (lab / np.array([100, 128, 128], dtype=np.float32)).reshape(means.shape)
+
+
+def joint_histograms(images, bins=4):
+    '''
+    Normalized joint color histograms of a batch of uint8 images, bins per
+    channel. Returns a (n, bins ** 3) float32 array.
+    '''
+    n = len(images)
+    q = (images.reshape(n, -1, 3).astype(np.uint16) * bins) >> 8 # bin of every channel
+    codes = (q[..., 0] * bins + q[..., 1]) * bins + q[..., 2]
+    # one bincount for the whole batch: image i counts into bins i * bins^3 ...
+    codes = codes + (np.arange(n, dtype=np.int64) * bins ** 3)[:, None]
+    hist = np.bincount(codes.ravel(), minlength=n * bins ** 3).reshape(n, bins ** 3)
+    return (hist / codes.shape[1]).astype(np.float32)
+
+
+def describe(images, grid=8, bins=4, hist_weight=1.0, chunk_size=256):
+    '''
+    Descriptor of every image: the flattened Lab thumbnail and the square
+    rooted joint histogram. Each part has a norm of about 1, hist_weight
+    scales the histogram against the thumbnail.
+    images - (n, h, w, 3) uint8 BGR array, may be a memmap
+    Returns a (n, rows * columns * 3 + bins ** 3) float32 array.
+    '''
+    rows, columns = _grid(grid)
+    cells = rows * columns
+
+    def chunk_features(chunk):
+        chunk = np.asarray(chunk)
+        thumbnails = lab_thumbnails(chunk, (rows, columns)).reshape(len(chunk), -1) / np.sqrt(cells)
+        return np.hstack([thumbnails, hist_weight * np.sqrt(joint_histograms(chunk, bins))])
+    return imageloader.map_chunks(chunk_features, images, chunk_size).astype(np.float32)
@@ -0,0 +1,89 @@
+'''
+Near-duplicate collapsing before clustering.
+
+Photo sets have lots of near identical shots, and every one of them costs a
+row and a column of the distance matrix. Here images whose perceptual hashes
+are within a hamming radius are grouped (found with packedhash.MultiIndexHash,
+so without comparing all pairs), only one representative per group is
+clustered, weighted by the size of its group where the clusterer supports it,
+and afterwards the groups are expanded again so every image is a leaf of the
+tree next to its representative.
+
+Groups are built greedily: in file order, an image not in a group yet starts
+one and takes every ungrouped image within the radius of it. So every member
+is within the radius of its representative, and a chain of slightly different
+shots doesn't collapse into one group.
+'''
+import numpy as np
+from scipy.sparse import csr_matrix
+import packedhash
+import treebuilder as tb
+import instrument
+
+
+class Groups:
+    '''
+    Images grouped around representatives.
+    labels - group of every image
+    representatives - image index of every group's representative
+    weights - size of every group
+    '''
+    def __init__(self, labels, representatives):
+        self.labels = np.asarray(labels)
+        self.representatives = np.asarray(representatives)
+        self.weights = np.bincount(self.labels, minlength=len(self.representatives))
+        # members of group g are order[offsets[g]:offsets[g + 1]], representative first
+        key = np.where(np.arange(len(self.labels)) == self.representatives[self.labels], -1, np.arange(len(self.labels)))
+        self.order = np.lexsort((key, self.labels))
+        self.offsets = np.r_[0, np.cumsum(self.weights)]
+
+    def __len__(self):
+        return len(self.representatives)
+
+    @property
+    def duplicates(self):
+        '''How many images were collapsed into a representative.'''
+        return len(self.labels) - len(self.representatives)
+
+    def members(self, groups):
+        '''Image indices of all the members of the given groups, group by group.'''
+        groups = np.asarray(groups, dtype=np.int64)
+        counts = self.weights[groups]
+        # position of every member in order: the group's offset plus 0..count-1
+        shift = np.repeat(self.offsets[groups] - np.r_[0, np.cumsum(counts)[:-1]], counts)
+        return self.order[shift + np.arange(counts.sum())]
+
+    def expand(self, root):
+        '''
+        Turn a treebuilder tree built on the representatives (indices are
+        group numbers) into one over all the images, in place.
+        '''
+        for node in tb.preorder(root):
+            node.indices = self.members(node.indices)
+        return root
+
+
+def group_duplicates(codes, radius, nbits=64):
+    '''
+    Group near duplicates.
+    codes - packed hashes (packedhash.pack_hashes)
+    radius - largest hamming distance (bits) between a member and its representative
+    Returns Groups.
+    '''
+    n = len(codes)
+    with instrument.span('group duplicates', images=n, radius=radius):
+        pairs, _ = packedhash.MultiIndexHash(codes, radius, nbits).radius_pairs()
+        graph = csr_matrix((np.ones(2 * len(pairs), dtype=bool),
+                            (np.r_[pairs[:, 0], pairs[:, 1]], np.r_[pairs[:, 1], pairs[:, 0]])), shape=(n, n))
+        labels = np.full(n, -1, dtype=np.int64)
+        representatives = []
+        for i in range(n):
+            if labels[i] >= 0:
+                continue
+            neighbours = graph.indices[graph.indptr[i]:graph.indptr[i + 1]]
+            neighbours = neighbours[labels[neighbours] < 0]
+            labels[neighbours] = labels[i] = len(representatives)
+            representatives.append(i)
+    groups = Groups(labels, representatives)
+    instrument.count('duplicates collapsed', groups.duplicates)
+    return groups
@@ -0,0 +1,268 @@
+'''
+Sparse linkage and turning a dendrogram into a k-ary cluster tree.
+
+Instead of re-clustering a dense n x n distance matrix at every level of the
+tree, one full linkage is computed from the edges of a sparse kNN graph
+(O(n * k) memory),
+and the binary dendrogram is cut into a k-ary tree in a single pass: a node
+is split by repeatedly opening the most recent merge under it until it has k
+parts, which is what cutting that subtree's dendrogram at k clusters gives.
+
+Linkage matrices use scipy's layout: row i merges clusters Z[i, 0] and
+Z[i, 1] (ids below n are points, n + j is the cluster made by row j) at
+distance Z[i, 2] into a cluster of Z[i, 3] points.
+'''
+import heapq
+import numpy as np
+from scipy.sparse.csgraph import minimum_spanning_tree
+import treebuilder as tb
+
+
+def _join_components(Z, row, roots, size, distance):
+    '''Merge what the graph didn't connect, at the given distance.'''
+    n = len(Z) + 1
+    roots = sorted(roots)
+    while len(roots) > 1:
+        a, b = roots.pop(0), roots.pop(0)
+        size[n + row] = size[a] + size[b]
+        Z[row] = [a, b, distance, size[n + row]]
+        roots.append(n + row)
+        row += 1
+    return Z
+
+
+def single_linkage(graph):
+    '''
+    Single linkage from a sparse distance graph, via its minimum spanning
+    tree. Parts of a disconnected graph are joined last, at the largest
+    distance.
+    '''
+    n = graph.shape[0]
+    mst = minimum_spanning_tree(graph).tocoo()
+    order = np.argsort(mst.data, kind='stable')
+    top = float(mst.data.max()) if mst.nnz else 0.0
+
+    parent = np.arange(2 * n - 1)
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    Z = np.zeros((n - 1, 4))
+    size = np.ones(2 * n - 1, dtype=np.int64)
+    row = 0
+    for a, b, d in zip(mst.row[order], mst.col[order], mst.data[order]):
+        ra, rb = find(a), find(b)
+        size[n + row] = size[ra] + size[rb]
+        Z[row] = [min(ra, rb), max(ra, rb), d, size[n + row]]
+        parent[ra] = parent[rb] = n + row
+        row += 1
+    return _join_components(Z, row, {find(i) for i in range(n)}, size, top)
+
+
+def sparse_linkage(graph, linkage='average', weights=None):
+    '''
+    Agglomerative clustering using only the distances in a sparse graph
+    (e.g. distances.knn_graph), so the features and a dense matrix are never
+    needed. Only clusters joined by an edge can merge.
+    linkage - 'single' (via the minimum spanning tree), 'average' (mean of
+        the edges between two clusters) or 'complete' (longest edge)
+    weights - how many points every node stands for (e.g. dedup group
+        sizes). Average linkage weighs each edge by the product of its ends'
+        weights, as if the points were repeated; sizes in Z add them up.
+    Returns a linkage matrix.
+    '''
+    if linkage == 'single':
+        return single_linkage(graph)
+    if linkage not in ('average', 'complete'):
+        raise ValueError(f'Unknown linkage {linkage}')
+    n = graph.shape[0]
+    coo = graph.tocoo()
+    keep = coo.row < coo.col # the graph is symmetric, use every edge once
+    rows, cols, data = coo.row[keep], coo.col[keep], coo.data[keep].astype(np.float64)
+    size = np.ones(2 * n - 1, dtype=np.int64)
+    if weights is not None:
+        size[:n] = weights
+
+    # per cluster: {neighbour: (sum of edge distances, edge count, longest edge)}
+    adjacency = [dict() for _ in range(2 * n - 1)]
+    for a, b, d in zip(rows.tolist(), cols.tolist(), data.tolist()):
+        w = float(size[a] * size[b])
+        adjacency[a][b] = adjacency[b][a] = (d * w, w, d)
+    average = linkage == 'average'
+
+    def distance(stats):
+        return stats[0] / stats[1] if average else stats[2]
+
+    # one heap entry per cluster, for its closest neighbour: merging a and b
+    # never brings another cluster closer to the result than it was to a or b
+    # (both linkages are a mean or max of the old distances), so only the
+    # clusters whose closest neighbour was a or b need a new entry
+    best = [None] * (2 * n - 1)
+
+    def closest(u):
+        if not adjacency[u]:
+            best[u] = None
+            return None
+        c, stats = min(adjacency[u].items(), key=lambda item: (distance(item[1]), item[0]))
+        best[u] = (distance(stats), c)
+        return (best[u][0], u, c)
+
+    heap = [entry for entry in map(closest, range(n)) if entry is not None]
+    heapq.heapify(heap)
+    active = np.zeros(2 * n - 1, dtype=bool)
+    active[:n] = True
+    Z = np.zeros((n - 1, 4))
+    row = 0
+    top = float(data.max()) if len(data) else 0.0
+
+    while heap:
+        d, a, b = heapq.heappop(heap)
+        # entries are stale once either side merged or a's closest neighbour changed
+        if not (active[a] and active[b]) or best[a] != (d, b):
+            continue
+        new = n + row
+        size[new] = size[a] + size[b]
+        Z[row] = [a, b, d, size[new]]
+        row += 1
+        active[a] = active[b] = False
+        active[new] = True
+        best[a] = best[b] = None
+        neighbours = adjacency[a]
+        for c, stats in adjacency[b].items():
+            if c in neighbours:
+                s, count, longest = neighbours[c]
+                neighbours[c] = (s + stats[0], count + stats[1], max(longest, stats[2]))
+            else:
+                neighbours[c] = stats
+        neighbours.pop(a, None)
+        neighbours.pop(b, None)
+        adjacency[new] = neighbours
+        adjacency[a] = adjacency[b] = None
+        for c, stats in neighbours.items():
+            adjacency[c].pop(a, None)
+            adjacency[c].pop(b, None)
+            adjacency[c][new] = stats
+            if best[c][1] in (a, b):
+                entry = closest(c)
+                if entry is not None:
+                    heapq.heappush(heap, entry)
+        entry = closest(new)
+        if entry is not None:
+            heapq.heappush(heap, entry)
+        if len(heap) > 2 * (n - row) + 1024:
+            # mostly stale entries: rebuild from the live ones so the heap stays O(n)
+            heap = [(best[u][0], u, best[u][1]) for u in np.flatnonzero(active).tolist() if best[u] is not None]
+            heapq.heapify(heap)
+
+    return _join_components(Z, row, set(np.flatnonzero(active).tolist()), size, top)
+
+
+def leaf_ranges(Z):
+    '''
+    Order the points so every dendrogram node's points are contiguous.
+    Returns (order, start, end): the points under node u are
+    order[start[u]:end[u]].
+    '''
+    n = len(Z) + 1
+    children = Z[:, :2].astype(np.int64)
+    start = np.zeros(2 * n - 1, dtype=np.int64)
+    end = np.zeros(2 * n - 1, dtype=np.int64)
+    order = np.empty(n, dtype=np.int64)
+    position = 0
+    stack = [(2 * n - 2, False)]
+    while stack:
+        u, done = stack.pop()
+        if u < n:
+            order[position] = u
+            start[u], end[u] = position, position + 1
+            position += 1
+        elif done:
+            a, b = children[u - n]
+            start[u], end[u] = start[a], end[b]
+        else:
+            a, b = children[u - n]
+            stack.extend([(u, True), (b, False), (a, False)])
+    return order, start, end
+
+
+def cut(Z, u, k):
+    '''Split dendrogram node u into at most k parts, opening the latest merges first.'''
+    n = len(Z) + 1
+    # heap of -id: higher ids are later merges
+    parts = [-u]
+    while len(parts) < k and parts[0] < -(n - 1):
+        merge = -heapq.heappop(parts)
+        a, b = Z[merge - n, :2].astype(np.int64)
+        heapq.heappush(parts, -a)
+        heapq.heappush(parts, -b)
+    return sorted(-p for p in parts)
+
+
+def to_tree(Z, k=7, split_threshold=10, max_depth=10):
+    '''
+    Cut a dendrogram into a k-ary treebuilder tree (with ids), so the usual
+    node_means and convert work on it.
+    '''
+    n = len(Z) + 1
+    order, start, end = leaf_ranges(Z)
+
+    def node(u, depth):
+        built = tb.BuildNode(order[start[u]:end[u]], depth)
+        built.center = u # the dendrogram node, for whoever needs it
+        return built
+
+    root = node(2 * n - 2, 0)
+    stack = [root]
+    while stack:
+        current = stack.pop()
+        if current.size < split_threshold or current.depth >= max_depth:
+            continue
+        parts = cut(Z, current.center, k)
+        if len(parts) < 2:
+            continue
+        current.children = [node(u, current.depth + 1) for u in parts]
+        stack.extend(current.children)
+    return tb.number_nodes(root)
+
+
+def linkage_tree(Z, threshold=None, max_children=None):
+    '''
+    The dendrogram itself as a treebuilder tree (with ids): a node per merge,
+    and a one point leaf per image. Built top-down without recursion, so
+    chained merges as deep as the number of images are fine.
+    threshold - collapse binary chains: a merge within threshold of the
+        merge distance of the node above it is replaced by its children, so
+        nearly simultaneous merges become one k-ary node. None keeps it binary.
+    max_children - stop collapsing into a node once it has this many children
+    '''
+    n = len(Z) + 1
+    order, start, end = leaf_ranges(Z)
+    children = Z[:, :2].astype(np.int64)
+    height = Z[:, 2]
+
+    def node(u, depth):
+        built = tb.BuildNode(order[start[u]:end[u]], depth)
+        built.center = u
+        return built
+
+    root = node(2 * n - 2, 0)
+    stack = [root]
+    while stack:
+        current = stack.pop()
+        u = current.center
+        if u < n:
+            continue # a single image
+        parts = list(children[u - n])
+        if threshold is not None:
+            i = 0
+            while i < len(parts) and (max_children is None or len(parts) < max_children):
+                c = parts[i]
+                if c >= n and height[u - n] - height[c - n] <= threshold:
+                    parts[i:i + 1] = children[c - n]
+                else:
+                    i += 1
+        current.children = [node(c, current.depth + 1) for c in parts]
+        stack.extend(current.children)
+    return tb.number_nodes(root)
@@ -0,0 +1,210 @@
+'''
+Blocked pairwise distances.
+
+Distances are computed tile by tile with matrix products instead of calling a
+python function per pair (as pairwise_distances(..., metric=linalgNorm) did),
+tiles run on a thread pool (numpy releases the GIL inside BLAS), and the result
+can be float32, condensed (upper triangle only, like scipy's pdist) and/or
+written to a np.memmap so large matrices don't have to fit in RAM.
+
+Supported metrics:
+  euclidean - via |a|^2 + |b|^2 - 2ab
+  sqeuclidean
+  cosine - 1 - ab / (|a||b|)
+  hamming - fraction of differing entries, for 0/1 (bool) vectors.
+            Uses the same trick since |a - b|^2 counts mismatches.
+'''
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from scipy.sparse import csr_matrix
+import instrument
+
+METRICS = ('euclidean', 'sqeuclidean', 'cosine', 'hamming')
+
+
+def _prepare(X, metric, compute_dtype):
+    '''Row norms (or whatever per-row term the metric needs), computed in blocks.'''
+    if metric not in METRICS:
+        raise ValueError(f'Unknown metric {metric}, expected one of {METRICS}')
+    X = X.reshape(len(X), -1)
+    norms = np.empty(len(X), dtype=compute_dtype)
+    for start in range(0, len(X), 4096):
+        block = X[start:start + 4096].astype(compute_dtype)
+        norms[start:start + 4096] = np.einsum('ij,ij->i', block, block)
+    if metric == 'cosine':
+        norms = np.sqrt(norms)
+        norms[norms == 0] = 1
+    return X, norms
+
+
+def _tile(X, Y, x_norms, y_norms, metric, compute_dtype):
+    '''Distances between two blocks of rows.'''
+    a = X.astype(compute_dtype)
+    b = Y.astype(compute_dtype)
+    dots = a @ b.T
+    if metric == 'cosine':
+        d = 1 - dots / np.outer(x_norms, y_norms)
+        return np.clip(d, 0, 2, out=d)
+    d = x_norms[:, None] + y_norms[None, :] - 2 * dots
+    np.maximum(d, 0, out=d) # rounding can make identical rows slightly negative
+    if metric == 'euclidean':
+        np.sqrt(d, out=d)
+    elif metric == 'hamming':
+        d /= a.shape[1]
+    return d
+
+
+def _allocate(shape, dtype, memmap_path):
+    if memmap_path is not None:
+        return np.lib.format.open_memmap(memmap_path, mode='w+', dtype=dtype, shape=shape)
+    return np.empty(shape, dtype=dtype)
+
+
+def _run(jobs, workers):
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1:
+        for job in jobs:
+            job()
+        return
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for future in [pool.submit(job) for job in jobs]:
+            future.result()
+
+
+def pairwise(X, Y=None, metric='euclidean', dtype=np.float32, block_size=1024,
+             workers=None, memmap_path=None, compute_dtype=np.float64):
+    '''
+    Full distance matrix between the rows of X and Y (X with itself if Y is None).
+    X, Y - (n, ...) arrays, flattened per row
+    metric - one of METRICS
+    dtype - output dtype. float32 halves memory compared to sklearn's float64.
+    block_size - rows per tile
+    workers - threads computing tiles (None = one per core)
+    memmap_path - if set, the matrix is a np.memmap (.npy format) at this path
+    compute_dtype - dtype used inside a tile. float64 keeps the norm trick
+        accurate for raw pixels even when the output is float32.
+    '''
+    symmetric = Y is None
+    X, x_norms = _prepare(X, metric, compute_dtype)
+    if symmetric:
+        Y, y_norms = X, x_norms
+    else:
+        Y, y_norms = _prepare(Y, metric, compute_dtype)
+    n, m = len(X), len(Y)
+    out = _allocate((n, m), dtype, memmap_path)
+
+    def job(i, j):
+        def run():
+            d = _tile(X[i:i + block_size], Y[j:j + block_size],
+                      x_norms[i:i + block_size], y_norms[j:j + block_size], metric, compute_dtype)
+            if symmetric and i == j:
+                np.fill_diagonal(d, 0)
+            out[i:i + block_size, j:j + block_size] = d
+            if symmetric and i != j:
+                out[j:j + block_size, i:i + block_size] = d.T
+        return run
+
+    jobs = [job(i, j) for i in range(0, n, block_size)
+            for j in range(i if symmetric else 0, m, block_size)]
+    with instrument.span('pairwise distances', rows=n, columns=m):
+        _run(jobs, workers)
+    if memmap_path is not None:
+        out.flush()
+    return out
+
+
+def condensed_index(n, i, j):
+    '''Position of the pair (i, j), i < j, in a condensed distance vector.'''
+    return n * i - i * (i + 1) // 2 + (j - i - 1)
+
+
+def condensed(X, metric='euclidean', dtype=np.float32, block_size=1024,
+              workers=None, memmap_path=None, compute_dtype=np.float64):
+    '''
+    Condensed (upper triangular, scipy pdist layout) distances between the
+    rows of X. Needs half the memory of pairwise(), and can be passed straight
+    to scipy.cluster.hierarchy.linkage or squareform.
+    Arguments are the same as pairwise().
+    '''
+    X, norms = _prepare(X, metric, compute_dtype)
+    n = len(X)
+    out = _allocate((n * (n - 1) // 2,), dtype, memmap_path)
+
+    def job(i):
+        def run():
+            rows = X[i:i + block_size]
+            # Only columns from i on can be in the upper triangle of these rows
+            for j in range(i, n, block_size):
+                d = _tile(rows, X[j:j + block_size], norms[i:i + block_size],
+                          norms[j:j + block_size], metric, compute_dtype)
+                for r in range(len(rows)):
+                    row = i + r
+                    first = max(row + 1, j) # first column of this tile above the diagonal
+                    last = min(j + block_size, n)
+                    if first >= last:
+                        continue
+                    start = condensed_index(n, row, first)
+                    out[start:start + last - first] = d[r, first - j:last - j]
+        return run
+
+    with instrument.span('condensed distances', rows=n):
+        _run([job(i) for i in range(0, n, block_size)], workers)
+    if memmap_path is not None:
+        out.flush()
+    return out
+
+
+def knn(X, k, metric='euclidean', block_size=1024, workers=None, compute_dtype=np.float64):
+    '''
+    k nearest neighbours of every row of X among the other rows. Tiles are
+    merged into a running top k, so memory is O(block_size^2 + n * k) instead
+    of O(n^2).
+    Returns (indices, distances), both (n, k), sorted by distance.
+    '''
+    X, norms = _prepare(X, metric, compute_dtype)
+    n = len(X)
+    k = min(k, n - 1)
+    indices = np.empty((n, k), dtype=np.int64)
+    dists = np.empty((n, k), dtype=np.float32)
+
+    def job(i):
+        def run():
+            rows = X[i:i + block_size]
+            best_d = np.empty((len(rows), 0), dtype=compute_dtype)
+            best_i = np.empty((len(rows), 0), dtype=np.int64)
+            for j in range(0, n, block_size):
+                d = _tile(rows, X[j:j + block_size], norms[i:i + block_size],
+                          norms[j:j + block_size], metric, compute_dtype)
+                idx = np.broadcast_to(np.arange(j, j + d.shape[1]), d.shape)
+                d[idx == np.arange(i, i + len(rows))[:, None]] = np.inf # not its own neighbour
+                cand_d = np.concatenate([best_d, d], axis=1)
+                cand_i = np.concatenate([best_i, idx], axis=1)
+                if cand_d.shape[1] > k:
+                    keep = np.argpartition(cand_d, k - 1, axis=1)[:, :k]
+                    cand_d = np.take_along_axis(cand_d, keep, axis=1)
+                    cand_i = np.take_along_axis(cand_i, keep, axis=1)
+                best_d, best_i = cand_d, cand_i
+            order = np.argsort(best_d, axis=1, kind='stable')
+            indices[i:i + block_size] = np.take_along_axis(best_i, order, axis=1)
+            dists[i:i + block_size] = np.take_along_axis(best_d, order, axis=1)
+        return run
+
+    with instrument.span('knn', rows=n, k=k):
+        _run([job(i) for i in range(0, n, block_size)], workers)
+    return indices, dists
+
+
+def knn_graph(indices, dists):
+    '''
+    Symmetric sparse (scipy csr) graph from knn() (or packedhash.knn) results,
+    with the distances as edge weights.
+    '''
+    n, k = indices.shape
+    rows = np.repeat(np.arange(n), k)
+    # scipy.sparse drops zero weights, which would disconnect duplicate images
+    weights = np.maximum(dists.ravel().astype(np.float32), np.finfo(np.float32).tiny)
+    graph = csr_matrix((weights, (rows, indices.ravel())), shape=(n, n))
+    # an edge in either direction counts
+    return graph.maximum(graph.T).tocsr()
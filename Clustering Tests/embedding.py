@@ -0,0 +1,133 @@
+'''
+2D layouts that scale to large photo collections.
+
+Exact t-SNE on every image is the slowest step of tsne.py. Here t-SNE (sklearn's
+Barnes-Hut) only runs on a random sample of landmark images. Every other image
+is placed at the distance weighted average of its nearest landmarks in
+feature space, which is a blocked matrix product instead of another
+optimization, so it's linear in the number of images. New images can be placed
+the same way later without refitting.
+
+The PCA in front of it is fitted on a random sample of rows (randomized SVD)
+and transform runs a batch at a time, so the flattened pixels never have to
+be converted to float all at once. IncrementalPCA, which fits on every batch,
+is there for data where even the sample doesn't fit in memory, but it's much
+slower (35s against 1.2s on the 4000 example images).
+'''
+import numpy as np
+from sklearn.decomposition import PCA, IncrementalPCA
+from sklearn.manifold import TSNE
+import imageloader
+
+
+def stream_pca(X, n_components=20, batch_size=4096, method='randomized', sample=20000, random_state=0):
+    '''
+    Fit a PCA and reduce X, batch by batch.
+    X - (n, ...) array, may be a memmap; rows are flattened
+    method - 'randomized' fits a randomized PCA on a random sample of at most
+        sample rows, 'incremental' fits IncrementalPCA on every batch (slow,
+        only for when sample rows don't fit in memory)
+    Returns (pca, reduced) with reduced a float32 (n, n_components) array.
+    '''
+    n = len(X)
+    batch_size = max(batch_size, n_components)
+    if method == 'incremental':
+        pca = IncrementalPCA(n_components=n_components, batch_size=batch_size)
+        start = 0
+        while start < n:
+            # every batch needs at least n_components rows, so a short last one joins the one before
+            end = n if n - start < batch_size + n_components else start + batch_size
+            pca.partial_fit(X[start:end].reshape(end - start, -1).astype(np.float32))
+            start = end
+    elif method == 'randomized':
+        rows = np.sort(np.random.default_rng(random_state).choice(n, size=min(n, sample), replace=False))
+        pca = PCA(n_components=n_components, svd_solver='randomized', random_state=random_state)
+        pca.fit(X[rows].reshape(len(rows), -1).astype(np.float32))
+    else:
+        raise ValueError(f'Unknown PCA method {method}')
+    reduced = imageloader.map_chunks(lambda chunk: pca.transform(chunk.reshape(len(chunk), -1).astype(np.float32)),
+                                     X, batch_size)
+    return pca, reduced.astype(np.float32)
+
+
+class LandmarkEmbedding:
+    '''
+    t-SNE on landmarks, kNN interpolation for everything else.
+    n_landmarks - how many images t-SNE runs on
+    n_neighbors - landmarks averaged to place every other image
+    tsne - extra keyword arguments for sklearn's TSNE
+    '''
+    def __init__(self, n_landmarks=5000, n_neighbors=10, random_state=0, **tsne):
+        self.n_landmarks = n_landmarks
+        self.n_neighbors = n_neighbors
+        self.random_state = random_state
+        self.tsne = tsne
+        self.landmarks = None # features of the landmarks
+        self.locations = None # their 2D locations
+        self.pca_mean = None # optional projection from raw rows to the features, see place
+        self.pca_components = None
+
+    def set_projection(self, pca):
+        '''Remember the PCA the features came from, so place can take raw rows.'''
+        self.pca_mean = pca.mean_.astype(np.float32)
+        self.pca_components = pca.components_.astype(np.float32)
+        return self
+
+    def fit_transform(self, X):
+        '''Fit on X and return the (n, 2) layout of all its rows.'''
+        X = np.asarray(X, dtype=np.float32).reshape(len(X), -1)
+        n = len(X)
+        rng = np.random.default_rng(self.random_state)
+        landmarks = np.sort(rng.choice(n, size=min(n, self.n_landmarks), replace=False))
+        perplexity = self.tsne.get('perplexity', min(30, (len(landmarks) - 1) / 3))
+        tsne = TSNE(n_components=2, random_state=self.random_state, **dict(self.tsne, perplexity=perplexity))
+        self.landmarks = X[landmarks]
+        self.locations = tsne.fit_transform(self.landmarks).astype(np.float32)
+
+        result = np.empty((n, 2), dtype=np.float32)
+        result[landmarks] = self.locations
+        rest = np.setdiff1d(np.arange(n), landmarks)
+        if len(rest):
+            result[rest] = self.transform(X[rest])
+        return result
+
+    def transform(self, X, block_size=4096):
+        '''Place new rows: inverse distance weighted average of their nearest landmarks.'''
+        X = np.asarray(X, dtype=np.float32).reshape(len(X), -1)
+        k = min(self.n_neighbors, len(self.landmarks))
+        landmark_norms = np.einsum('ij,ij->i', self.landmarks, self.landmarks)
+        result = np.empty((len(X), 2), dtype=np.float32)
+        for start in range(0, len(X), block_size):
+            block = X[start:start + block_size]
+            d = landmark_norms[None, :] - 2 * block @ self.landmarks.T + np.einsum('ij,ij->i', block, block)[:, None]
+            nearest = np.argpartition(d, k - 1, axis=1)[:, :k]
+            d = np.sqrt(np.maximum(np.take_along_axis(d, nearest, axis=1), 0))
+            weights = 1 / np.maximum(d, 1e-6)
+            weights /= weights.sum(axis=1, keepdims=True)
+            result[start:start + block_size] = np.einsum('ik,ikj->ij', weights, self.locations[nearest])
+        return result
+
+    def place(self, X, chunk_size=4096):
+        '''Layout of new raw rows (e.g. flattened images), through the saved PCA.'''
+        if self.pca_components is None:
+            raise ValueError('No projection saved, use transform on reduced features')
+        return imageloader.map_chunks(
+            lambda chunk: self.transform((chunk.reshape(len(chunk), -1) - self.pca_mean) @ self.pca_components.T),
+            X, chunk_size)
+
+    def save(self, path):
+        arrays = dict(landmarks=self.landmarks, locations=self.locations, n_neighbors=self.n_neighbors)
+        if self.pca_components is not None:
+            arrays.update(pca_mean=self.pca_mean, pca_components=self.pca_components)
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        embedding = cls(n_landmarks=len(data['landmarks']), n_neighbors=int(data['n_neighbors']))
+        embedding.landmarks = data['landmarks']
+        embedding.locations = data['locations']
+        if 'pca_components' in data:
+            embedding.pca_mean = data['pca_mean']
+            embedding.pca_components = data['pca_components']
+        return embedding
@@ -0,0 +1,161 @@
+'''
+Persistent on-disk cache for extracted features, keyed by file content hash.
+
+Each extractor gets its own directory under the cache root holding a list of
+append-only .npy shards and an index.json mapping sha1(file contents) -> row.
+Rerunning after adding a few photos only extracts features for the new ones;
+renamed or moved files still hit the cache since only their bytes matter.
+'''
+import os
+import json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import instrument
+
+DEFAULT_ROOT = './output/cache'
+
+
+def file_hash(fname, block_size=1 << 20):
+    '''sha1 hex digest of a file's contents.'''
+    h = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def hash_files(filenames, workers=None):
+    '''Content hashes for a list of files, computed in parallel (hashlib releases the GIL).'''
+    with instrument.span('hash files'), ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as pool:
+        hashes = list(pool.map(file_hash, filenames))
+    instrument.count('files hashed', len(hashes))
+    return hashes
+
+
+def combined_hash(hashes, *params):
+    '''
+    Single key for an ordered set of files (plus any parameters). Row order
+    matters for things like distance matrices, so the order is part of the key.
+    '''
+    h = hashlib.sha1()
+    for digest in hashes:
+        h.update(digest.encode())
+    for p in params:
+        h.update(repr(p).encode())
+    return h.hexdigest()
+
+
+class FeatureCache:
+    '''
+    Content-addressed feature store for one extractor.
+    name - extractor name, used as the directory name. Include anything that
+        changes the output (e.g. 'vgg16-avgpool') so stale features are never reused.
+    root - cache root directory
+    '''
+    def __init__(self, name, root=DEFAULT_ROOT):
+        self.name = name
+        self.dir = os.path.join(root, name)
+        os.makedirs(self.dir, exist_ok=True)
+        self.index_path = os.path.join(self.dir, 'index.json')
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                index = json.load(f)
+            self.shards = index['shards']
+            self.rows = {k: tuple(v) for k, v in index['rows'].items()}
+        else:
+            self.shards = []
+            self.rows = {}
+        self._loaded = {}
+
+    def __contains__(self, digest):
+        return digest in self.rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _shard(self, i):
+        if i not in self._loaded:
+            self._loaded[i] = np.load(os.path.join(self.dir, self.shards[i]), mmap_mode='r')
+        return self._loaded[i]
+
+    def _save_index(self):
+        tmp = self.index_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'shards': self.shards, 'rows': self.rows}, f)
+        os.replace(tmp, self.index_path)
+
+    def add(self, hashes, features):
+        '''
+        Store features for the given content hashes as a new shard.
+        hashes - list of n content hashes
+        features - array with n rows
+        '''
+        features = np.asarray(features)
+        if len(hashes) != len(features):
+            raise ValueError('Need exactly one feature row per hash')
+        if len(hashes) == 0:
+            return
+        if self.shards:
+            first = self._shard(0)
+            if first.shape[1:] != features.shape[1:] or first.dtype != features.dtype:
+                raise ValueError(f'Features for {self.name} should be {first.dtype} {first.shape[1:]}, '
+                                 f'got {features.dtype} {features.shape[1:]}')
+        shard_name = f'shard-{len(self.shards)}.npy'
+        np.save(os.path.join(self.dir, shard_name), features)
+        self.shards.append(shard_name)
+        for row, digest in enumerate(hashes):
+            self.rows[digest] = (len(self.shards) - 1, row)
+        self._save_index()
+
+    def get(self, hashes):
+        '''Features for hashes that are all already in the cache, in the same order.'''
+        locations = np.array([self.rows[digest] for digest in hashes], dtype=np.int64).reshape(-1, 2)
+        first = self._shard(0)
+        result = np.empty((len(hashes),) + first.shape[1:], dtype=first.dtype)
+        # One fancy-indexed gather per shard rather than one read per row
+        for shard in np.unique(locations[:, 0]):
+            mask = locations[:, 0] == shard
+            result[mask] = self._shard(shard)[locations[mask, 1]]
+        return result
+
+    def get_or_compute(self, filenames, extract, hashes=None):
+        '''
+        Features for every file, only running the extractor on files we haven't seen.
+        filenames - paths of the images
+        extract - function taking an array of indices into filenames and
+            returning a feature array with one row per index
+        hashes - precomputed content hashes of filenames (computed if None)
+        '''
+        if hashes is None:
+            hashes = hash_files(filenames)
+        missing = []
+        seen = set()
+        for i, digest in enumerate(hashes):
+            if digest not in self.rows and digest not in seen:
+                missing.append(i)
+                seen.add(digest)
+        if missing:
+            print(f'{self.name}: extracting features for {len(missing)} of {len(hashes)} images')
+            missing = np.array(missing)
+            self.add([hashes[i] for i in missing], extract(missing))
+        return self.get(hashes)
+
+
+def cached_result(name, key, compute, root=DEFAULT_ROOT):
+    '''
+    Cache a single array that depends on a whole set of inputs (e.g. a PCA
+    projection or a distance matrix).
+    name - what is being cached, used in the file name
+    key - e.g. combined_hash(hashes, params...). A different key recomputes.
+    compute - function with no arguments returning the array
+    '''
+    os.makedirs(root, exist_ok=True)
+    path = os.path.join(root, f'{name}-{key}.npy')
+    if os.path.exists(path):
+        return np.load(path, mmap_mode='r')
+    result = np.asarray(compute())
+    tmp = path + '.tmp.npy'
+    np.save(tmp, result)
+    os.replace(tmp, path)
+    return result
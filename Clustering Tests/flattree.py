@@ -0,0 +1,276 @@
+'''
+Array backed cluster trees.
+
+Instead of one python object per node (most of them leaves repeating the same
+path twice, as name and preview), the tree is a handful of int arrays indexed
+by node: parent, first child, next sibling and size. Strings are interned in a
+single utf-8 buffer with offsets, and a leaf's name is derived from its
+preview path. Nodes are numbered in pre-order, so a subtree is a contiguous
+range of ids.
+
+NodeView is a small __slots__ handle that looks like a ClusterNode (name,
+preview, size, x, y, bounds, children), so clusternode.write_json can write a
+FlatTree directly. Trees save to and load from .npz.
+'''
+import os
+import numpy as np
+
+NONE = -1
+
+
+def _pack_strings(strings):
+    '''Encode strings into one uint8 buffer plus offsets.'''
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(e) for e in encoded], out=offsets[1:])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+class StringTable:
+    '''Interned strings: each distinct string is stored once and referred to by index.'''
+    def __init__(self, data=None, offsets=None):
+        self.data = np.zeros(0, dtype=np.uint8) if data is None else data
+        self.offsets = np.zeros(1, dtype=np.int64) if offsets is None else offsets
+        self._pending = []
+        self._index = {}
+
+    def __len__(self):
+        return len(self.offsets) - 1 + len(self._pending)
+
+    def intern(self, s):
+        if s is None:
+            return NONE
+        if not self._index and len(self.offsets) > 1:
+            self._index = {self[i]: i for i in range(len(self.offsets) - 1)}
+        i = self._index.get(s)
+        if i is None:
+            i = len(self)
+            self._index[s] = i
+            self._pending.append(s)
+        return i
+
+    def freeze(self):
+        '''Move strings added with intern into the packed buffer.'''
+        if self._pending:
+            data, offsets = _pack_strings(self._pending)
+            self.offsets = np.concatenate([self.offsets, offsets[1:] + self.offsets[-1]])
+            self.data = np.concatenate([self.data, data])
+            self._pending = []
+
+    def __getitem__(self, i):
+        if i == NONE:
+            return None
+        stored = len(self.offsets) - 1
+        if i >= stored:
+            return self._pending[i - stored]
+        return bytes(self.data[self.offsets[i]:self.offsets[i + 1]]).decode('utf-8')
+
+
+class NodeView:
+    '''A node of a FlatTree, with the same attributes as a ClusterNode.'''
+    __slots__ = ('tree', 'id')
+
+    def __init__(self, tree, id):
+        self.tree = tree
+        self.id = id
+
+    @property
+    def name(self):
+        name = self.tree.strings[self.tree.name_id[self.id]]
+        if name is None and self.is_leaf:
+            preview = self.preview
+            return None if preview is None else os.path.basename(preview)
+        return name
+
+    @property
+    def preview(self):
+        return self.tree.strings[self.tree.preview_id[self.id]]
+
+    @property
+    def size(self):
+        return int(self.tree.size[self.id])
+
+    def _coordinate(self, array):
+        if array is None or np.isnan(array[self.id]):
+            return None
+        return float(array[self.id])
+
+    @property
+    def x(self):
+        return self._coordinate(self.tree.x)
+
+    @property
+    def y(self):
+        return self._coordinate(self.tree.y)
+
+    @property
+    def bounds(self):
+        if self.tree.bounds is None or np.isnan(self.tree.bounds[self.id, 0]):
+            return None
+        return self.tree.bounds[self.id].tolist()
+
+    @property
+    def is_leaf(self):
+        return self.tree.first_child[self.id] == NONE
+
+    @property
+    def parent(self):
+        parent = self.tree.parent[self.id]
+        return None if parent == NONE else NodeView(self.tree, parent)
+
+    @property
+    def children(self):
+        if self.is_leaf:
+            return None
+        return [NodeView(self.tree, i) for i in self.tree.child_ids(self.id)]
+
+
+class FlatTree:
+    '''
+    A cluster tree as arrays. Build one with from_cluster_node or
+    from_build_tree, or load a saved one.
+    '''
+    def __init__(self, parent, first_child, next_sibling, size, name_id, preview_id,
+                 strings, x=None, y=None, bounds=None):
+        self.parent = parent
+        self.first_child = first_child
+        self.next_sibling = next_sibling
+        self.size = size
+        self.name_id = name_id
+        self.preview_id = preview_id
+        self.strings = strings
+        self.x = x
+        self.y = y
+        self.bounds = bounds
+
+    def __len__(self):
+        return len(self.parent)
+
+    @property
+    def root(self):
+        return NodeView(self, 0)
+
+    def node(self, i):
+        return NodeView(self, i)
+
+    def child_ids(self, i):
+        child = self.first_child[i]
+        while child != NONE:
+            yield int(child)
+            child = self.next_sibling[child]
+
+    def leaves(self):
+        '''Ids of all leaves.'''
+        return np.flatnonzero(self.first_child == NONE)
+
+    def subtree_end(self, i):
+        '''Nodes are in pre-order, so the subtree of i is the id range [i, subtree_end(i)).'''
+        while i != NONE:
+            sibling = self.next_sibling[i]
+            if sibling != NONE:
+                return int(sibling)
+            i = self.parent[i]
+        return len(self)
+
+    @classmethod
+    def _from_lists(cls, parent, size, names, previews, strings, x, y, bounds):
+        n = len(parent)
+        parent = np.asarray(parent, dtype=np.int32)
+        first_child = np.full(n, NONE, dtype=np.int32)
+        next_sibling = np.full(n, NONE, dtype=np.int32)
+        # group nodes by parent, keeping pre-order (= sibling order) within each group
+        ids = np.arange(1, n, dtype=np.int32)
+        order = np.argsort(parent[1:], kind='stable')
+        ids, parents = ids[order], parent[1:][order]
+        same = parents[1:] == parents[:-1]
+        next_sibling[ids[:-1][same]] = ids[1:][same]
+        starts = np.r_[True, ~same] if len(ids) else np.zeros(0, dtype=bool)
+        first_child[parents[starts]] = ids[starts]
+        strings.freeze()
+        has_coordinates = any(v is not None for v in x) or any(v is not None for v in y)
+        has_bounds = any(b is not None for b in bounds)
+        return cls(parent, first_child, next_sibling, np.asarray(size, dtype=np.int64),
+                   np.asarray(names, dtype=np.int32), np.asarray(previews, dtype=np.int32), strings,
+                   x=np.array([np.nan if v is None else v for v in x], dtype=np.float32) if has_coordinates else None,
+                   y=np.array([np.nan if v is None else v for v in y], dtype=np.float32) if has_coordinates else None,
+                   bounds=np.array([[np.nan] * 4 if b is None else b for b in bounds],
+                                   dtype=np.float32) if has_bounds else None)
+
+    @classmethod
+    def from_cluster_node(cls, root):
+        '''Flatten a ClusterNode tree.'''
+        strings = StringTable()
+        parent, size, names, previews, x, y, bounds = [], [], [], [], [], [], []
+        stack = [(root, NONE)]
+        while stack:
+            node, p = stack.pop()
+            i = len(parent)
+            parent.append(p)
+            size.append(node.size if node.size is not None else 0)
+            leaf = not node.children
+            # a leaf named after its own file doesn't need the name stored
+            derived = leaf and node.preview is not None and node.name == os.path.basename(node.preview)
+            names.append(NONE if derived else strings.intern(node.name))
+            previews.append(strings.intern(node.preview))
+            x.append(getattr(node, 'x', None))
+            y.append(getattr(node, 'y', None))
+            bounds.append(getattr(node, 'bounds', None))
+            for child in reversed(node.children or []):
+                stack.append((child, i))
+        return cls._from_lists(parent, size, names, previews, strings, x, y, bounds)
+
+    @classmethod
+    def from_build_tree(cls, root, names, preview_pattern=None, name_pattern='cluster {}', locations=None):
+        '''
+        Flatten a treebuilder tree directly, without making ClusterNodes.
+        names - path of every point
+        preview_pattern - e.g. './output/centroids/keras-centroid-{}.JPEG',
+            formatted with the node id. None for no cluster previews.
+        name_pattern - formatted with id + 1, like the scripts do
+        locations - optional (n, 2) embedding, stored as x/y of leaves
+        '''
+        strings = StringTable()
+        parent, size, node_names, previews, x, y, bounds = [], [], [], [], [], [], []
+        stack = [(root, NONE)]
+        while stack:
+            node, p = stack.pop()
+            i = len(parent)
+            parent.append(p)
+            size.append(node.size)
+            node_names.append(strings.intern(name_pattern.format(node.id + 1)))
+            previews.append(NONE if preview_pattern is None else strings.intern(preview_pattern.format(node.id)))
+            x.append(None)
+            y.append(None)
+            bounds.append(None)
+            if node.children is None:
+                for point in node.indices:
+                    parent.append(i)
+                    size.append(1)
+                    node_names.append(NONE)
+                    previews.append(strings.intern(str(names[point])))
+                    x.append(None if locations is None else locations[point][0])
+                    y.append(None if locations is None else locations[point][1])
+                    bounds.append(None)
+            else:
+                for child in reversed(node.children):
+                    stack.append((child, i))
+        return cls._from_lists(parent, size, node_names, previews, strings, x, y, bounds)
+
+    def save(self, path):
+        arrays = dict(parent=self.parent, first_child=self.first_child, next_sibling=self.next_sibling,
+                      size=self.size, name_id=self.name_id, preview_id=self.preview_id,
+                      string_data=self.strings.data, string_offsets=self.strings.offsets)
+        for key in ('x', 'y', 'bounds'):
+            if getattr(self, key) is not None:
+                arrays[key] = getattr(self, key)
+        np.savez_compressed(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(data['parent'], data['first_child'], data['next_sibling'], data['size'],
+                   data['name_id'], data['preview_id'],
+                   StringTable(data['string_data'], data['string_offsets']),
+                   x=data['x'] if 'x' in data else None,
+                   y=data['y'] if 'y' in data else None,
+                   bounds=data['bounds'] if 'bounds' in data else None)
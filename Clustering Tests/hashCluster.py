@@ -1,229 +1,184 @@
 # Test image hashing as means of clustering
-import os
-import cv2
+import inspect
+import argparse
 from glob import glob
 import imagehash
-from sklearn.cluster import KMeans, AgglomerativeClustering
+from sklearn.cluster import AgglomerativeClustering
 from scipy.cluster.hierarchy import linkage
-from scipy.spatial.distance import pdist, squareform
-from sklearn.metrics.pairwise import pairwise_distances
 import numpy as np
-from PIL import Image
-
-class ClusterNode:
-    def __init__(self, name=None, preview=None, size=None, x=None, y=None, bounds=None, avg_img=None):
-        self.name = name
-        self.preview = preview
-        self.children = []
-        self.size = size
-        self.x = x
-        self.y = y
-        self.bounds = bounds
-        self.avg_img = avg_img
-    # This function outputs the required json string for this cluster and any children
-
-    def json(self, level=0):
-        indent = ' '*(2*level)
-        result = indent + '{\n'
-
-        if self.name is not None:
-            result += indent + '  "name" : "' + self.name + '",\n'
-
-        if self.preview is not None:
-            result += indent + '  "preview" : "' + self.preview + '",\n'
-
-        if self.size is not None:
-            result += indent + '  "size" : ' + str(self.size) + ',\n'
-
-        if self.x is not None:
-            result += indent + '  "x" : ' + str(self.x) + ',\n'
-
-        if self.y is not None:
-            result += indent + '  "y" : ' + str(self.y) + ',\n'
-
-        if self.bounds is not None:
-            result += indent + '  "bounds" : ' + str(self.bounds) + ',\n'
-
-        if self.children != []:
-            result += indent + '  "children" : [\n'
-
-            for subcluster in self.children:
-                result += subcluster.json(level=level + 2) + ',\n'
-            result = result[:-2] + '\n'
-            result += indent + '  ]\n,'
-
-        result = result[:-2] + '\n'
-        result += indent + '}'
-
-        return result
-
-cluster_id = 0
-
-def agglomerative(X, images, names, k=7, split_threshold=10, max_depth=10):
+from functools import partial
+import imageloader
+import featurecache
+import distances
+import packedhash
+import treebuilder as tb
+import dendrogram
+import dedup
+import kselect
+import colorfeatures
+import quantize
+import instrument
+from clusternode import save_json
+
+# scikit-learn 1.2 renamed affinity to metric (and 1.4 removed affinity)
+PRECOMPUTED = {'metric' if 'metric' in inspect.signature(AgglomerativeClustering).parameters else 'affinity': 'precomputed'}
+
+def agglomerative_split(X, indices, k):
+    # X is a precomputed distance matrix, so take the rows and columns of this node
+    agg = AgglomerativeClustering(n_clusters=k, linkage='average', **PRECOMPUTED).fit(X[np.ix_(indices, indices)])
+    return agg.labels_, None
+
+def agglomerative(X, images, names, k=7, split_threshold=10, max_depth=10, workers=None, writer=None, groups=None,
+                  k_range=None):
     '''
-    Compute the hierarchical k means of a (transformed) data set.
-    X - input data
+    Compute the hierarchical agglomerative clustering of a data set.
+    X - precomputed distance matrix
+    images - the images, used to compute the centroid previews
     names - labels (to keep track of whats in which cluster)
-    locations - locations of data poitns in a particular embedding
     k - branching factor. How many clusters per level.
     split_threshold and max_depth - stopping point for recursion
+    workers - processes to build subtrees on (see treebuilder)
+    writer - centroidwriter.CentroidWriter for the centroid images (a default one if None)
+    groups - dedup.Groups if X is between the representatives only. images and
+        names are still all of them. sklearn's linkage can't take weights, so
+        here the groups only count in the sizes and centroids.
+    k_range - (smallest, largest) k to choose from at every node by the
+        silhouette on X, instead of a fixed k (see kselect)
     '''
-    cluster = ClusterNode()
-    cluster.size = X.shape[0]
-    # cluster.bounds = [np.min(locations[:, 0]), np.min(
-        # locations[:, 1]), np.ptp(locations[:, 0]), np.ptp(locations[:, 1])]
-
-    # output the centroids to a separate file
-    # Requires the images array, and the global for the id.
-    global cluster_id
-    centroid_outname = './example-data/centroids/agglomerative-mean' + str(cluster_id) + '.JPEG'
-    cluster_id += 1
-    cluster.name = f'cluster {cluster_id}'
-    cluster.preview = centroid_outname
-    cv2.imwrite(centroid_outname, np.mean(images, axis=0))
-
-    #Base Case
-    if X.shape[0] < split_threshold or max_depth <= 0:
-        cluster.children = [ClusterNode(os.path.basename(
-            name), name, 1) for name in names]
-        return cluster
-
-    # Cluster and Recurse
-    agg = AgglomerativeClustering(n_clusters=k, affinity='precomputed', linkage='average').fit(X)
-    labels = agg.labels_
-
-    cluster.children = []
-    for i in range(k):
-        cluster_X = X[labels == i]
-        cluster_images = images[labels == i]
-        cluster_names = names[labels == i]
-        # cluster_locations = locations[labels == i]
-        subcluster = agglomerative(cluster_X, cluster_images, cluster_names,
-                                          k=k, split_threshold=split_threshold, max_depth=max_depth-1)
-
-        cluster.children.append(subcluster)
-
-    return cluster
-
-#Takes the output of hierarchical clustering based on hamming distance and turns it into clusters and average images
-def hammingClustering(hamming, images, names):
-    #Intialization
-    # print(hamming.shape)
-    n = len(hamming)
-    # print(images.shape)
-    hamming = np.asarray(hamming)
-    print(hamming[n-2])
-    completedNodes = {}
-    return createClusters(hamming[n-2], hamming, images, completedNodes, names)
-
-def createClusters(z, hamming, images, completed, names):
-    cluster = ClusterNode()
-    # print(z)
-    cluster.size = z[3] #How many nodes are under it, min is 2.
-    # cluster.x = z[2] #Distance (TODO: Add this as a seperate thing in the json for us to do stuff with)
-
-    global cluster_id
-    #TODO If it's not a centroid, we should probably not treat it like one in the json (i.e. there should just be paths to images.)
-    centroid_outname = './example-data/centroids/hamming-average-' + str(cluster_id) + '.JPEG'
-    cluster_id += 1
-    cluster.children = [] #Every cluster has children in this paradigm
-    cluster.name = f'cluster {cluster_id}'
-    cluster.preview = centroid_outname
-
-    print(cluster_id, 'zs', z[0], z[1], z[0] in completed, z[1] in completed)
-
-    #If z is a base level image (less than n)
-    if z[0] < len(hamming) and z[1] < len(hamming):
-        #Create a centroid for these images
-        # print("Branch has reached a base node, stopping down recursion.")
-        cluster.avg_img = cv2.imwrite(centroid_outname, np.mean((images[int(z[0])], images[int(z[1])]), axis=0))
-        completed[z[0]] = images[int(z[0])]
-        completed[z[1]] = images[int(z[1])]
-        print(cluster_id, 'Finished')
-        cluster.children = [
-            ClusterNode(os.path.basename(names[int(z[0])]), names[int(z[0])], 1),
-            ClusterNode(os.path.basename(names[int(z[1])]), names[int(z[1])], 1)
-        ]
-        return cluster
-    #General case, requiring some level of recursion to unpack a cluster.
-    #NOTE: It'd be better design if this was a function.
-    #if it's been completed, we need it's average image
-    if z[0] in completed:
-        img1 = completed[z[0]]
-    #if it's never been touched, but big enough, we need to recurse and complete it.
-    elif z[0] > len(hamming):
-        child = int(z[0]) - len(hamming)
-        completed[z[0]] = True
-        newCluster1 = createClusters(hamming[child], hamming, images, completed, names)
-        cluster.children.append(newCluster1)
-        img1 = newCluster1.avg_img #NOTE: This whole average image storage in the object is useless now
-        completed[z[0]] = img1
-    #if it's never been touched, but small enough, we can complete it.
+    if k_range is None:
+        split = partial(agglomerative_split, k=k)
     else:
-        img1 = images[int(z[0])]
-        completed[z[0]] = img1
-        #TODO: Shouldn't make an extra cluster for one of these
-    #if it's been completed, we need it's average image
-    if z[1] in completed:
-        img2 = completed[z[1]]
-    #if it's never been touched, but big enough, we need to recurse and complete it.
-    elif z[1] > len(hamming):
-        child = int(z[1]) - len(hamming)
-        completed[z[1]] = True
-        newCluster2 = createClusters(hamming[child], hamming, images, completed, names)
-        cluster.children.append(newCluster2)
-        img2 = newCluster2.avg_img
-        completed[z[1]] = img2
-    #if it's never been touched, but small enough, we can complete it.
+        split = partial(kselect.adaptive_precomputed_split, k_range=k_range)
+    tree = tb.build_tree(X, split, split_threshold=split_threshold, max_depth=max_depth, workers=workers)
+    if groups is not None:
+        groups.expand(tree)
+    return tb.cluster_nodes(tree, images, names, './example-data/centroids/agglomerative-mean{}.JPEG', writer)
+
+def sparse_agglomerative(features, images, names, k=7, n_neighbors=15, linkage='average', split_threshold=10,
+                         max_depth=10, workers=None, writer=None, groups=None):
+    '''
+    Agglomerative clustering on a sparse kNN graph instead of a dense distance
+    matrix: one full linkage where only neighbours can merge, cut into a
+    k-ary tree (see dendrogram). Memory is O(n * n_neighbors), not O(n^2).
+    features - (n, ...) feature rows, e.g. the flattened images, or
+        quantize.PQCodes (neighbours then come from the codes, see quantize.knn)
+    n_neighbors - neighbours per image in the connectivity graph
+    linkage - 'average', 'complete' or 'single'
+    groups - dedup.Groups if features are the representatives only; average
+        linkage weighs them by their group sizes
+    Other arguments as in agglomerative. workers is used for the kNN search.
+    '''
+    if isinstance(features, quantize.PQCodes):
+        indices, dists = quantize.knn(features, n_neighbors)
     else:
-        img2 = images[int(z[0])]
-        completed[z[1]] = img2
-
-    #Create an avg image using the prior averages TODO: See if this can be weighted by cluster size.
-    cluster.avg_img = cv2.imwrite(centroid_outname, np.mean([img1, img2], axis=0))
-    return cluster
-
-def linalgNorm(x, y):
-    return np.linalg.norm(x-y)
-
-# Prepare input data
-print("Initializing images...")
-filenames = glob('./example-data/images/*.JPEG') #Grab all the image files
-images = [cv2.imread(fname) for fname in filenames] #Load all images
-rawimages = [Image.open(fname) for fname in filenames] #Load all raw images to be hashed NOTE this probably doesn't scale well
-
-
-#Hash all images
-X_hashed = [imagehash.phash(x).hash for x in rawimages]
-# print(X_averagehashed)
-X_hashed = np.stack(X_hashed).reshape(len(images), -1)
-
-# print(X_hashed)
-print("Computing Agglomerative...") #Agglomerative clustering works fine, but image hashing ignores color, might need to try a new metric.
-hammingDistMatrix = pdist(X_hashed, metric='hamming')
-hammingDist = squareform(hammingDistMatrix)
-# print(hammingDist)
-Img = np.stack(images).reshape(len(images),-1)
-# print(linalgNorm(images[0], images[1]))
-normDist = pairwise_distances(Img, Img, metric=linalgNorm) #Maybe cache this, it takes forever to compute
-# print(normDist)
-agglo = agglomerative(normDist, np.stack(images), np.array(filenames), k=10, max_depth=20)
-
-f = open('./example-data/agglo.json', 'w')
-f.write(agglo.json())
-f.write('\n')
-f.close()
-
-# print("Computing Hamming Linkage...")
-# cluster_id = 0
-# X_avg = pdist(X_avg, metric='hamming')
-# hamming = linkage(X_avg, metric='hamming', method='complete')
-# np.savetxt('hamming.txt', hamming)
-# ham = hammingClustering(hamming, np.stack(images), np.array(filenames))
-
-# f = open('./example-data/hamming-hashed.json', 'w')
-# f.write(ham.json())
-# f.write('\n')
-# f.close()
-
-print("Done!")
+        indices, dists = distances.knn(features.reshape(len(features), -1), n_neighbors, workers=workers)
+    graph = distances.knn_graph(indices, dists)
+    Z = dendrogram.sparse_linkage(graph, linkage=linkage, weights=None if groups is None else groups.weights)
+    tree = dendrogram.to_tree(Z, k=k, split_threshold=split_threshold, max_depth=max_depth)
+    if groups is not None:
+        groups.expand(tree)
+    return tb.cluster_nodes(tree, images, names, './example-data/centroids/agglomerative-mean{}.JPEG', writer)
+
+def hamming_clustering(Z, images, names, threshold=None, max_children=None, writer=None, groups=None):
+    '''
+    Turn a scipy linkage matrix (e.g. of the hash distances) into clusters
+    with average images. Every merge is a cluster, unless collapsed.
+    Z - linkage matrix
+    images - the images, used to compute the average images
+    names - labels (to keep track of whats in which cluster)
+    threshold, max_children - collapse chains of merges closer than
+        threshold into one cluster (see dendrogram.linkage_tree)
+    writer - centroidwriter.CentroidWriter for the average images (a default one if None)
+    groups - dedup.Groups if Z is of the representatives only. A group then
+        becomes a cluster of its duplicates where its representative was.
+    '''
+    tree = dendrogram.linkage_tree(Z, threshold=threshold, max_children=max_children)
+    if groups is not None:
+        groups.expand(tree)
+    return tb.cluster_nodes(tree, images, names, './example-data/centroids/hamming-average-{}.JPEG', writer,
+                            single_points=True)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Agglomerative clustering of the example images')
+    parser.add_argument('--sparse', action='store_true',
+                        help='cluster on a kNN graph instead of the full distance matrix (see dendrogram)')
+    parser.add_argument('--neighbors', type=int, default=15, help='neighbours per image with --sparse')
+    parser.add_argument('--hamming', action='store_true', help='also cluster by complete linkage of the hash distances')
+    parser.add_argument('--collapse', type=float, default=None,
+                        help='with --hamming, merge chains of clusters within this hash distance (fraction of bits) into one')
+    parser.add_argument('--dedup', type=int, default=None, metavar='BITS',
+                        help='cluster one image per group of near duplicates (hashes at most BITS apart, see dedup)')
+    parser.add_argument('--adaptive-k', type=int, nargs=2, metavar=('MIN', 'MAX'),
+                        help='without --sparse, choose the branching factor per node from this range (see kselect)')
+    parser.add_argument('--features', choices=['pixels', 'color'], default='pixels',
+                        help='agglomerate on the raw pixels or on compact color descriptors (see colorfeatures)')
+    parser.add_argument('--compress', choices=['float16', 'pq'],
+                        help='compute the distances from compressed features (see quantize)')
+    parser.add_argument('--pq-subspaces', type=int, default=64, help='bytes per image with --compress pq')
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    instrument.setup(args)
+
+    # Prepare input data
+    print("Initializing images...")
+    filenames = glob('./example-data/images/*.JPEG') #Grab all the image files
+    images = imageloader.load_images(filenames) #Load all images into one preallocated array
+
+
+    #Hash all images, reusing the decoded pixels instead of opening every file again
+    hashes = featurecache.hash_files(filenames)
+    X_hashed = featurecache.FeatureCache('phash').get_or_compute(filenames, lambda idx: imageloader.map_chunks(
+        lambda chunk: np.stack([imagehash.phash(imageloader.to_pil(x)).hash for x in chunk]), images, indices=idx), hashes=hashes)
+    # print(X_averagehashed)
+    X_hashed = X_hashed.reshape(len(images), -1)
+
+    # print(X_hashed)
+    print("Computing Agglomerative...") #Agglomerative clustering works fine, but image hashing ignores color, might need to try a new metric.
+    X_packed = packedhash.pack_hashes(X_hashed) #64 bit hashes as one uint64 each
+    Img = images.reshape(len(images),-1)
+    if args.features == 'color':
+        # pHash ignores color, these don't (and are ~36x smaller than the pixels)
+        Img = featurecache.FeatureCache('color').get_or_compute(
+            filenames, lambda idx: colorfeatures.describe(images[idx]), hashes=hashes)
+    groups = None
+    if args.dedup is not None:
+        # Only the representatives go through the distances and the clustering
+        groups = dedup.group_duplicates(X_packed, args.dedup, nbits=X_hashed.shape[1])
+        print(f"{groups.duplicates} near duplicates collapsed, clustering {len(groups)} images")
+        X_packed = X_packed[groups.representatives]
+        Img = Img[groups.representatives]
+    if args.compress == 'float16':
+        Img = quantize.to_float16(Img)
+    elif args.compress == 'pq':
+        print("Compressing...")
+        Img = quantize.PQCodes.compress(Img, m=args.pq_subspaces)
+    with instrument.span('clustering'), instrument.profile('clustering'):
+        if args.sparse:
+            agglo = sparse_agglomerative(Img, images, np.array(filenames), k=10, n_neighbors=args.neighbors, max_depth=20,
+                                         groups=groups)
+        else:
+            key = ('euclidean', 'float32')
+            if groups is not None:
+                key += ('dedup', args.dedup)
+            if args.features == 'color':
+                key += ('color',)
+            if args.compress is not None:
+                key += (args.compress, args.pq_subspaces) if args.compress == 'pq' else (args.compress,)
+            normDist = featurecache.cached_result('normdist', featurecache.combined_hash(hashes, *key),
+                lambda: quantize.pairwise(Img) if args.compress == 'pq' else
+                distances.pairwise(Img, metric='euclidean', dtype=np.float32)) #Blocked + cached
+            # print(normDist)
+            agglo = agglomerative(normDist, images, np.array(filenames), k=10, max_depth=20, groups=groups,
+                                  k_range=args.adaptive_k)
+
+    save_json(agglo, './example-data/agglo.json')
+
+    if args.hamming:
+        print("Computing Hamming Linkage...")
+        hamming = linkage(packedhash.condensed(X_packed, nbits=X_hashed.shape[1]), method='complete')
+        # np.savetxt('hamming.txt', hamming)
+        ham = hamming_clustering(hamming, images, np.array(filenames), threshold=args.collapse, groups=groups)
+
+        save_json(ham, './example-data/hamming-hashed.json')
+
+    print("Done!")
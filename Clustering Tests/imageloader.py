@@ -0,0 +1,95 @@
+'''
+Shared image loading for the clustering scripts.
+
+Images are decoded straight into one preallocated uint8 array (optionally a
+np.memmap on disk) by a pool of worker threads, instead of building a python
+list of arrays and np.stack-ing it, which held the whole corpus in memory twice.
+'''
+import os
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+from PIL import Image
+import instrument
+
+
+def read_image(fname, shape=None):
+    '''
+    Decode a single image as a BGR uint8 array (same layout as cv2.imread).
+    fname - path to the image
+    shape - optional (h, w, c) to resize to if the file doesn't match
+    '''
+    img = cv2.imread(fname)
+    if img is None:
+        raise IOError(f'Could not read image {fname}')
+    if shape is not None and img.shape != tuple(shape):
+        img = cv2.resize(img, (shape[1], shape[0]), interpolation=cv2.INTER_AREA)
+    return img
+
+
+def load_images(filenames, shape=None, memmap_path=None, workers=None):
+    '''
+    Decode every file into a single preallocated (n, h, w, c) uint8 array.
+    filenames - paths of the images to load
+    shape - (h, w, c) of every image. Read from the first file if None.
+    memmap_path - if set, the array is a np.memmap backed by this file, so
+        the corpus doesn't need to fit in RAM
+    workers - number of decoder threads. cv2 releases the GIL while
+        decoding so threads are enough to use every core.
+    '''
+    filenames = list(filenames)
+    if shape is None:
+        shape = read_image(filenames[0]).shape
+    shape = (len(filenames),) + tuple(shape)
+
+    if memmap_path is not None:
+        images = np.lib.format.open_memmap(memmap_path, mode='w+', dtype=np.uint8, shape=shape)
+    else:
+        images = np.empty(shape, dtype=np.uint8)
+
+    # Each worker writes directly into its own row, so nothing is copied twice
+    def decode(i):
+        images[i] = read_image(filenames[i], shape[1:])
+        instrument.count('images loaded')
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    with instrument.span('load images', images=len(filenames)), ThreadPoolExecutor(max_workers=workers) as pool:
+        for _ in pool.map(decode, range(len(filenames))):
+            pass
+
+    if memmap_path is not None:
+        images.flush()
+    return images
+
+
+def iter_chunks(images, chunk_size=256, indices=None):
+    '''
+    Iterate over an image array in chunks of at most chunk_size images.
+    Yields (start, chunk) where chunk is a view when indices is None, so
+    streaming over a memmap only pages in one chunk at a time.
+    indices - optional subset (int or bool array) of images to visit
+    '''
+    if indices is not None:
+        indices = np.asarray(indices)
+        if indices.dtype == bool:
+            indices = np.flatnonzero(indices)
+        for start in range(0, len(indices), chunk_size):
+            yield start, images[indices[start:start + chunk_size]]
+    else:
+        for start in range(0, len(images), chunk_size):
+            yield start, images[start:start + chunk_size]
+
+
+def map_chunks(fn, images, chunk_size=256, indices=None):
+    '''
+    Apply fn to every chunk and concatenate the results along the first axis.
+    fn - takes a (m, h, w, c) chunk and returns an array with m rows
+    '''
+    results = [fn(chunk) for _, chunk in iter_chunks(images, chunk_size, indices)]
+    return np.concatenate(results)
+
+
+def to_pil(img):
+    '''Convert a BGR array from read_image into an RGB PIL image (e.g. for imagehash).'''
+    return Image.fromarray(img[..., ::-1])
@@ -0,0 +1,217 @@
+'''
+Incrementally add photos to an already built cluster tree.
+
+When a tree is built with a state_path, the per-node statistics needed to
+extend it are saved next to the JSON: each node's parent, depth, size, mean
+feature (used to route new images) and mean image (its preview), plus the
+feature of every image and which leaf it's in.
+
+Adding an image walks it down from the root to the nearest child at every
+level, updating the size, mean feature and mean image of every node on the
+way. A leaf is only re-split (with k-means, like a full build) once it holds
+more than split_threshold * split_factor images, so a daily batch of new
+photos costs a few seconds instead of a full rebuild. Existing node ids never
+change, so only previews of nodes that were touched are rewritten.
+'''
+import os
+from functools import partial
+import cv2
+import numpy as np
+from clusternode import ClusterNode, save_json
+import treebuilder as tb
+import centroidwriter
+
+
+class TreeState:
+    '''
+    Flat arrays describing a cluster tree, indexed by node id.
+    parent - parent id of every node, -1 for the root
+    depth, count - depth and number of images under every node
+    centroid - mean feature of every node
+    mean_image - mean image of every node
+    point_leaf - leaf node of every image
+    point_feature - feature of every image, needed to re-split leaves
+    names - path of every image
+    '''
+    def __init__(self, parent, depth, count, centroid, mean_image, point_leaf, point_feature, names,
+                 k=7, split_threshold=10, max_depth=10, centroid_pattern='./output/centroids/centroid-{}.JPEG'):
+        self.parent = np.asarray(parent, dtype=np.int64)
+        self.depth = np.asarray(depth, dtype=np.int64)
+        self.count = np.asarray(count, dtype=np.int64)
+        self.centroid = np.asarray(centroid, dtype=np.float32)
+        self.mean_image = np.asarray(mean_image, dtype=np.float32)
+        self.point_leaf = np.asarray(point_leaf, dtype=np.int64)
+        self.point_feature = np.asarray(point_feature, dtype=np.float32)
+        self.names = np.asarray(names, dtype=str)
+        self.k = k
+        self.split_threshold = split_threshold
+        self.max_depth = max_depth
+        self.centroid_pattern = centroid_pattern
+        self._index_children()
+
+    def _index_children(self):
+        self.children = [[] for _ in self.parent]
+        for node, parent in enumerate(self.parent):
+            if parent >= 0:
+                self.children[parent].append(node)
+
+    @classmethod
+    def from_tree(cls, root, X, images, names, **params):
+        '''
+        Collect the state of a treebuilder tree.
+        root - BuildNode tree with ids (from treebuilder.build_tree)
+        X - features the tree was built on
+        images - the images, for the mean images
+        params - k, split_threshold, max_depth, centroid_pattern
+        '''
+        nodes = sorted(tb.preorder(root), key=lambda node: node.id)
+        parent = np.full(len(nodes), -1)
+        point_leaf = np.empty(len(names), dtype=np.int64)
+        for node in nodes:
+            if node.children is None:
+                point_leaf[node.indices] = node.id
+            else:
+                for child in node.children:
+                    parent[child.id] = node.id
+        X = np.asarray(X).reshape(len(X), -1)
+        return cls(parent, [node.depth for node in nodes], [node.size for node in nodes],
+                   tb.node_means(root, X), tb.node_means(root, images), point_leaf, X, names, **params)
+
+    def save(self, path):
+        np.savez(path, parent=self.parent, depth=self.depth, count=self.count, centroid=self.centroid,
+                 mean_image=self.mean_image, point_leaf=self.point_leaf, point_feature=self.point_feature,
+                 names=self.names, k=self.k, split_threshold=self.split_threshold,
+                 max_depth=self.max_depth, centroid_pattern=self.centroid_pattern)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(data['parent'], data['depth'], data['count'], data['centroid'], data['mean_image'],
+                   data['point_leaf'], data['point_feature'], data['names'], k=int(data['k']),
+                   split_threshold=int(data['split_threshold']), max_depth=int(data['max_depth']),
+                   centroid_pattern=str(data['centroid_pattern']))
+
+    def _new_node(self, parent, centroid, mean_image, count):
+        node = len(self.parent)
+        self.parent = np.append(self.parent, parent)
+        self.depth = np.append(self.depth, self.depth[parent] + 1)
+        self.count = np.append(self.count, count)
+        self.centroid = np.concatenate([self.centroid, centroid[None]])
+        self.mean_image = np.concatenate([self.mean_image, mean_image[None]])
+        self.children.append([])
+        self.children[parent].append(node)
+        return node
+
+    def route(self, x):
+        '''Path of node ids from the root to the leaf nearest to feature x.'''
+        node = 0
+        path = [node]
+        while self.children[node]:
+            children = self.children[node]
+            node = children[np.argmin(np.linalg.norm(self.centroid[children] - x, axis=1))]
+            path.append(node)
+        return path
+
+    def insert(self, X, images, names, split_factor=2):
+        '''
+        Add new images to the tree.
+        X - features of the new images, in the same space the tree was built in
+        images - the new images
+        names - paths of the new images
+        split_factor - leaves are re-split once they hold more than
+            split_threshold * split_factor images
+        Returns the set of node ids whose preview changed.
+        '''
+        X = np.asarray(X, dtype=np.float32).reshape(len(X), -1)
+        touched = set()
+        leaves = np.empty(len(X), dtype=np.int64)
+        for i, x in enumerate(X):
+            path = self.route(x)
+            # running means along the path
+            self.count[path] += 1
+            counts = self.count[path][:, None]
+            self.centroid[path] += (x - self.centroid[path]) / counts
+            self.mean_image[path] += (images[i] - self.mean_image[path]) / counts[..., None, None]
+            leaves[i] = path[-1]
+            touched.update(path)
+
+        self.point_leaf = np.concatenate([self.point_leaf, leaves])
+        self.point_feature = np.concatenate([self.point_feature, X])
+        self.names = np.concatenate([self.names, np.asarray(names, dtype=str)])
+
+        limit = self.split_threshold * split_factor
+        for leaf in np.unique(leaves):
+            if self.count[leaf] > limit and self.depth[leaf] < self.max_depth:
+                touched.update(self._resplit(leaf))
+        return touched
+
+    def _resplit(self, leaf):
+        '''Replace a leaf by a subtree built on the images in it. Returns the new node ids.'''
+        members = np.flatnonzero(self.point_leaf == leaf)
+        subtree = tb.build_tree(self.point_feature[members], partial(tb.kmeans_split, k=self.k),
+                                split_threshold=self.split_threshold,
+                                max_depth=self.max_depth - self.depth[leaf], workers=1)
+        new_nodes = []
+        # pre-order, so a node's id in the big tree is known before its children are added
+        ids = {subtree.id: leaf}
+        for node in tb.preorder(subtree):
+            for child in node.children or []:
+                rows = members[child.indices]
+                ids[child.id] = self._new_node(ids[node.id], self.point_feature[rows].mean(axis=0),
+                                               self._member_mean_image(rows, ids[node.id]), len(rows))
+                new_nodes.append(ids[child.id])
+            if node.children is None:
+                self.point_leaf[members[node.indices]] = ids[node.id]
+        return new_nodes
+
+    def _member_mean_image(self, rows, fallback):
+        '''Mean image of some images. Their pixels aren't stored, so read them back.'''
+        loaded = [cv2.imread(name) for name in self.names[rows]]
+        if any(img is None for img in loaded):
+            return self.mean_image[fallback]
+        return np.mean(loaded, axis=0)
+
+    def preview(self, node):
+        return self.centroid_pattern.format(node)
+
+    def write_previews(self, nodes, writer=None):
+        with centroidwriter.using(writer) as writer:
+            for node in nodes:
+                writer.write(self.preview(node), self.mean_image[node])
+
+    def cluster_tree(self):
+        '''The tree as ClusterNodes, for json output.'''
+        members = [[] for _ in self.parent]
+        for i, leaf in enumerate(self.point_leaf):
+            members[leaf].append(i)
+
+        def make_cluster(node):
+            return ClusterNode(f'cluster {node + 1}', self.preview(node), int(self.count[node]))
+
+        root = make_cluster(0)
+        stack = [(0, root)]
+        while stack:
+            node, cluster = stack.pop()
+            if not self.children[node]:
+                cluster.children = [ClusterNode(os.path.basename(self.names[i]), self.names[i], 1)
+                                    for i in members[node]]
+                continue
+            cluster.children = []
+            for child in self.children[node]:
+                child_cluster = make_cluster(child)
+                cluster.children.append(child_cluster)
+                stack.append((child, child_cluster))
+        return root
+
+
+def update(state_path, json_path, X, images, names, split_factor=2, indent=2):
+    '''
+    Add new images to a saved tree, rewrite the json and only the previews
+    that changed, and save the updated state.
+    '''
+    state = TreeState.load(state_path)
+    touched = state.insert(X, images, names, split_factor=split_factor)
+    state.write_previews(sorted(touched))
+    save_json(state.cluster_tree(), json_path, indent=indent)
+    state.save(state_path)
+    return state
@@ -0,0 +1,210 @@
+'''
+Lightweight timing, memory and counter instrumentation.
+
+Wrap work in span('name', **details) and bump counters with count('name').
+Nothing is recorded unless enable() was called: span() then returns a shared
+do-nothing context manager and count() returns straight away, so the calls can
+stay in hot paths.
+
+When enabled, every span records its start, duration, thread, process and the
+RSS at its end, and the whole run can be written as a Chrome trace (open it in
+chrome://tracing or https://ui.perfetto.dev) plus a per-span summary. Spans
+recorded in treebuilder's worker processes are sent back with their results.
+profile('name') additionally runs cProfile around a stage when asked for on the
+command line.
+
+Scripts hook it up with:
+  instrument.add_arguments(parser)
+  args = parser.parse_args()
+  instrument.setup(args)
+which adds --trace PATH and --profile STAGE.
+'''
+import os
+import json
+import time
+import atexit
+import cProfile
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+enabled = False
+_events = [] # (name, start ns, duration ns, pid, tid, details)
+_counters = defaultdict(int)
+_counter_events = [] # (name, ns, increment, pid)
+_lock = threading.Lock()
+_profile_stages = set()
+_profile_dir = '.'
+_origin = time.perf_counter_ns()
+
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+def _rss_mb():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1 << 20)
+    except (OSError, ValueError):
+        return None
+
+
+class _Span:
+    __slots__ = ('name', 'details', 'start')
+
+    def __init__(self, name, details):
+        self.name = name
+        self.details = details
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter_ns()
+        details = self.details
+        rss = _rss_mb()
+        if rss is not None:
+            details['rss_mb'] = round(rss, 1)
+        with _lock:
+            _events.append((self.name, self.start, end - self.start, os.getpid(), threading.get_ident(), details))
+        return False
+
+
+def span(name, **details):
+    '''Context manager timing a piece of work. details show up in the trace.'''
+    if not enabled:
+        return _NO_SPAN
+    return _Span(name, details)
+
+
+def count(name, n=1):
+    '''Add n to a counter (e.g. images processed, nodes built).'''
+    if not enabled:
+        return
+    with _lock:
+        _counters[name] += n
+        _counter_events.append((name, time.perf_counter_ns(), n, os.getpid()))
+
+
+@contextmanager
+def profile(name):
+    '''Run cProfile around a stage if --profile asked for it, saving <name>.prof.'''
+    if name not in _profile_stages and 'all' not in _profile_stages:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        os.makedirs(_profile_dir, exist_ok=True)
+        path = os.path.join(_profile_dir, f'{name}.prof')
+        profiler.dump_stats(path)
+        print(f'Profile of {name} written to {path} (view with python -m pstats or snakeviz)')
+
+
+def enable(on=True):
+    global enabled
+    enabled = on
+
+
+def drain():
+    '''Take the recorded events out (used to ship them from worker processes).'''
+    global _events, _counter_events
+    with _lock:
+        events, counters = _events, _counter_events
+        _events, _counter_events = [], []
+    return events, counters
+
+
+def merge(recorded):
+    '''Add events drained in another process.'''
+    events, counters = recorded
+    with _lock:
+        _events.extend(events)
+        _counter_events.extend(counters)
+        for name, _, n, _ in counters:
+            _counters[name] += n
+
+
+def counters():
+    return dict(_counters)
+
+
+def summary():
+    '''Total time, calls and the largest RSS per span name, slowest first.'''
+    totals = defaultdict(lambda: [0, 0, 0.0])
+    for name, _, duration, _, _, details in _events:
+        total = totals[name]
+        total[0] += duration
+        total[1] += 1
+        total[2] = max(total[2], details.get('rss_mb') or 0)
+    return sorted(((name, ns / 1e9, calls, rss) for name, (ns, calls, rss) in totals.items()),
+                  key=lambda row: -row[1])
+
+
+def print_summary():
+    rows = summary()
+    if not rows and not _counters:
+        return
+    print(f'{"span":<28} {"seconds":>10} {"calls":>8} {"max rss MB":>11}')
+    for name, seconds, calls, rss in rows:
+        print(f'{name:<28} {seconds:>10.3f} {calls:>8} {rss:>11.1f}')
+    for name, value in sorted(_counters.items()):
+        print(f'{name:<28} {value:>10}')
+
+
+def chrome_trace():
+    '''The recorded events in Chrome's trace event format.'''
+    trace = []
+    totals = defaultdict(int)
+    for name, start, duration, pid, tid, details in _events:
+        trace.append({'name': name, 'ph': 'X', 'ts': (start - _origin) / 1000, 'dur': duration / 1000,
+                      'pid': pid, 'tid': tid, 'args': details})
+    # counters are drawn as running totals per process
+    for name, ns, n, pid in sorted(_counter_events, key=lambda event: event[1]):
+        totals[name, pid] += n
+        trace.append({'name': name, 'ph': 'C', 'ts': (ns - _origin) / 1000, 'pid': pid,
+                      'args': {name: totals[name, pid]}})
+    return {'traceEvents': trace, 'displayTimeUnit': 'ms', 'otherData': {'counters': dict(_counters)}}
+
+
+def write_trace(path):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(chrome_trace(), f)
+    print(f'Trace written to {path}')
+
+
+def add_arguments(parser):
+    parser.add_argument('--trace', metavar='PATH', help='record spans and counters, write a Chrome trace json here')
+    parser.add_argument('--profile', metavar='STAGE', action='append', default=[],
+                        help="run cProfile around this stage ('all' for every one), .prof files go next to --trace")
+
+
+def setup(args):
+    '''Enable instrumentation if --trace or --profile was given, reporting at exit.'''
+    global _profile_dir
+    _profile_stages.update(args.profile)
+    if args.trace:
+        _profile_dir = os.path.dirname(args.trace) or '.'
+    if not args.trace:
+        return
+    enable()
+
+    def report():
+        print_summary()
+        write_trace(args.trace)
+    atexit.register(report)
@@ -2,97 +2,163 @@ from keras.preprocessing import image
 from keras.applications.vgg16 import VGG16
 from keras.applications.vgg16 import preprocess_input
 import numpy as np
-from sklearn.cluster import KMeans
 import glob
-from clusternode import ClusterNode
-import cv2
-import os
+from clusternode import save_json, save_sharded
 import argparse
-
-def hierarchical_k_means(X, images, names,  k=7, split_threshold=10, max_depth=10):
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import imageloader
+import featurecache
+import treebuilder as tb
+import centroidwriter
+import incremental
+import flattree
+import annindex
+import quantize
+import kselect
+import instrument
+
+def hierarchical_k_means(X, images, names,  k=7, split_threshold=10, max_depth=10, workers=None, state_path=None, writer=None,
+                         index_path=None, k_range=None, criterion='silhouette', flat=False):
     '''
     Compute the hierarchical k means of a (transformed) data set.
-    X - input data
+    X - input data, can be compressed (see quantize)
+    images - the images, used to compute the centroid previews
     names - labels (to keep track of whats in which cluster)
-    locations - locations of data poitns in a particular embedding
     k - branching factor. How many clusters per level.
     split_threshold and max_depth - stopping point for recursion
+    workers - processes to build subtrees on (see treebuilder)
+    state_path - if set, save what's needed to add images later (see incremental)
+    writer - centroidwriter.CentroidWriter for the centroid images (a default one if None)
+    index_path - if set, save a similar photo index on the same tree there (see annindex)
+    k_range - (smallest, largest) k to choose from at every node instead of a
+        fixed k (see kselect)
+    criterion - how k_range candidates are compared, 'silhouette' or 'calinski'
+    flat - return a flattree.FlatTree made straight from the built tree
+        instead of ClusterNodes, so there's no python object per image
     '''
-    cluster = ClusterNode()
-    cluster.size = X.shape[0]
-
-    # output the centroids to a separate file
-    global cluster_id
-    centroid_outname = './output/centroids/keras-centroid-' + \
-        str(cluster_id) + '.JPEG'
-    cluster_id += 1
-    cluster.name = f'cluster {cluster_id}'
-    cluster.preview = centroid_outname
-    cv2.imwrite(centroid_outname, np.mean(images, axis=0))
-
-    # Base Case
-    if X.shape[0] < split_threshold or max_depth <= 0:
-        cluster.children = [ClusterNode(os.path.basename(
-            name), name, 1) for name in names]
-        return cluster
-
-    # Cluster and Recurse
-    kmeans = KMeans(n_clusters=k).fit(X)
-    labels = kmeans.labels_
-
-    cluster.children = []
-    for i in range(k):
-        cluster_X = X[labels == i]
-        cluster_images = images[labels == i]
-        cluster_names = names[labels == i]
-        subcluster = hierarchical_k_means(cluster_X, cluster_images, cluster_names,
-                                          k=k, split_threshold=split_threshold, max_depth=max_depth-1)
-        cluster.children.append(subcluster)
-
-    return cluster
-
-def kerasCluster(filenames):
-    model = VGG16(weights='imagenet', include_top=False)
+    split = tb.make_split(quantize.pq_kmeans_split if isinstance(X, quantize.PQCodes) else tb.kmeans_split,
+                          k, k_range, criterion)
+    tree = tb.build_tree(X, split, split_threshold=split_threshold, max_depth=max_depth, workers=workers)
+    if state_path is not None:
+        incremental.TreeState.from_tree(tree, X, images, names, k=k, split_threshold=split_threshold,
+                                        max_depth=max_depth,
+                                        centroid_pattern='./output/centroids/keras-centroid-{}.JPEG').save(state_path)
+    if index_path is not None:
+        annindex.TreeIndex.from_tree(tree, X, names).save(index_path)
+    preview_pattern = './output/centroids/keras-centroid-{}.JPEG'
+    if flat:
+        with centroidwriter.using(writer) as writer:
+            tb.write_previews(tree, images, preview_pattern, writer)
+            return flattree.FlatTree.from_build_tree(tree, names, writer.path_for(preview_pattern))
+    return tb.cluster_nodes(tree, images, names, preview_pattern, writer)
+
+def load_batch(paths):
+    '''Decode and preprocess a batch of images for VGG16.'''
+    # All images already the same size
+    batch = np.stack([image.img_to_array(image.load_img(img_path)) for img_path in paths])
+    return preprocess_input(batch)
+
+def kerasCluster(filenames, batch_size=32, pooling=None, workers=2, prefetch=2):
+    '''
+    Extract VGG16 conv features for every image.
+    filenames - images to extract features from
+    batch_size - images per model.predict call
+    pooling - None for the flattened 7x7x512 conv output, 'avg' for
+        global average pooling (512 floats per image)
+    workers, prefetch - decoder threads, and how many batches to have
+        decoded ahead of the one being predicted
+    '''
+    model = VGG16(weights='imagenet', include_top=False, pooling=pooling)
     model.summary()
     # Idea: Use glob and the file names to implment this. I think it's kind of cheating given our goal w the project but it should work fine overall
 
     # Use silhouette coefficient to validate https://scikit-learn.org/stable/modules/clustering.html#silhouette-coefficient
 
-    vgg16_feature_list = []
-
-    # images = [cv2.imread(fname) for fname in filenames]
-    # print(filenames)
-    for img_path in filenames:
-        # print(img_path)
-        # Code to take an image and add it to the model feature list
-        img = image.load_img(img_path) #All images already the same size
-        img_data = image.img_to_array(img)
-        img_data = np.expand_dims(img_data, axis=0)
-        img_data = preprocess_input(img_data)
-
-        vgg16_feature = model.predict(img_data)
-        vgg16_feature_np = np.array(vgg16_feature)
-        vgg16_feature_list.append(vgg16_feature_np.flatten())
-
-    # Take the feature list, make it into a numpy array, and then fit a k means model to it.
-    vgg16_feature_list_np = np.array(vgg16_feature_list)
-    print(vgg16_feature_list_np)
+    batches = [filenames[i:i + batch_size] for i in range(0, len(filenames), batch_size)]
+    vgg16_feature_list_np = None
+    start = 0
+
+    # Producer/consumer: the pool decodes upcoming batches while the model runs on the current one
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque(pool.submit(load_batch, paths) for paths in batches[:prefetch + 1])
+        next_batch = len(pending)
+        while pending:
+            img_data = pending.popleft().result()
+            if next_batch < len(batches):
+                pending.append(pool.submit(load_batch, batches[next_batch]))
+                next_batch += 1
+
+            vgg16_feature = model.predict(img_data, batch_size=batch_size)
+            vgg16_feature = vgg16_feature.reshape(len(img_data), -1)
+            if vgg16_feature_list_np is None:
+                vgg16_feature_list_np = np.empty((len(filenames), vgg16_feature.shape[1]), dtype=np.float32)
+            vgg16_feature_list_np[start:start + len(img_data)] = vgg16_feature
+            start += len(img_data)
+
+    print('VGG16 features:', vgg16_feature_list_np.shape)
     return vgg16_feature_list_np
 
-filenames = glob.glob('./example-data/images/*.JPEG')
-images = [cv2.imread(fname) for fname in filenames] #Load all images
-
-print("Clustering (K-Means) + Keras...")
-cluster_id = 0 # give a unique id to each cluster
-kerasPreproc = kerasCluster(filenames) #TODO Cache this result
-print("Keras Model Completed Training")
-kmeans = hierarchical_k_means(kerasPreproc, np.stack(images), np.array(filenames))
-
-f = open('./output/keras.json', 'w')
-f.write(kmeans.json())
-f.write('\n')
-f.close()
-print("Completed!")
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Hierarchical k-means on VGG16 features')
+    parser.add_argument('--pooling', default=None, help="'avg' shrinks each feature from 7x7x512 to 512 floats")
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--compact', action='store_true', help='write the json without indentation')
+    parser.add_argument('--format', default='JPEG', help='centroid image format: JPEG, WEBP or PNG')
+    parser.add_argument('--quality', type=int, default=95, help='centroid JPEG/WebP quality')
+    parser.add_argument('--npz', help='also save the tree as a compact array backed .npz (see flattree)')
+    parser.add_argument('--state', help='.npz file to save the tree state to, or update from')
+    parser.add_argument('--update', metavar='GLOB', help='add these images to the tree saved in --state')
+    parser.add_argument('--shard', metavar='DIR', help='also write the tree as shards the viewer can load on demand')
+    parser.add_argument('--shard-levels', type=int, default=3, help='tree levels per shard file')
+    parser.add_argument('--index', metavar='DIR', help='also save a similar photo index (see annindex)')
+    parser.add_argument('--compress', choices=['float16', 'pq'], help='cluster on compressed features (see quantize)')
+    parser.add_argument('--pq-subspaces', type=int, default=256, help='bytes per image with --compress pq')
+    parser.add_argument('--adaptive-k', type=int, nargs=2, metavar=('MIN', 'MAX'),
+                        help='choose the branching factor per node from this range (see kselect)')
+    parser.add_argument('--k-criterion', choices=kselect.CRITERIA, default='silhouette')
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    instrument.setup(args)
+    if args.update and not args.state:
+        parser.error('--update needs the --state the tree was built with')
+    if args.compress == 'pq' and (args.state or args.index):
+        # both keep every feature row uncompressed, which would undo the compression
+        parser.error('--state and --index need uncompressed features')
+
+    filenames = glob.glob(args.update or './example-data/images/*.JPEG')
+    images = imageloader.load_images(filenames) #Load all images
+
+    print("Clustering (K-Means) + Keras...")
+    pooling = args.pooling
+    hashes = featurecache.hash_files(filenames)
+    with instrument.span('vgg16 features'), instrument.profile('features'):
+        kerasPreproc = featurecache.FeatureCache('vgg16' if pooling is None else 'vgg16-' + pooling).get_or_compute(
+            filenames, lambda idx: kerasCluster([filenames[i] for i in idx], pooling=pooling), hashes=hashes)
+    print("Keras Model Completed Training")
+    if args.compress == 'float16':
+        kerasPreproc = quantize.to_float16(kerasPreproc)
+    elif args.compress == 'pq':
+        kerasPreproc = quantize.PQCodes.compress(kerasPreproc, m=args.pq_subspaces)
+    if args.update:
+        incremental.update(args.state, './output/keras.json', kerasPreproc, images, filenames,
+                           indent=None if args.compact else 2)
+    else:
+        with centroidwriter.CentroidWriter(args.format, args.quality) as writer, \
+                instrument.span('clustering'), instrument.profile('clustering'):
+            kmeans = hierarchical_k_means(kerasPreproc, images, np.array(filenames), workers=args.workers,
+                                          state_path=args.state, writer=writer, index_path=args.index,
+                                          k_range=args.adaptive_k, criterion=args.k_criterion,
+                                          flat=bool(args.npz))
+        if args.npz:
+            kmeans.save(args.npz)
+            kmeans = kmeans.root # writes the same json as the ClusterNodes would
+
+        save_json(kmeans, './output/keras.json', indent=None if args.compact else 2)
+        if args.shard:
+            save_sharded(kmeans, args.shard, levels=args.shard_levels,
+                         indent=None if args.compact else 2)
+    print("Completed!")
 
 #TODO Visualize the result of kmeans
 #TODO Add the default clustering code
@@ -0,0 +1,211 @@
+'''
+Picking the branching factor per node instead of a fixed k.
+
+The exact silhouette is O(n^2) for every candidate k, which is far too slow to
+run at every node of the tree. Here candidates are compared on a random
+sample of the node: the sample's distances are computed once (or taken from a
+precomputed distance matrix) and reused for every candidate, and the
+silhouette of all samples is a couple of matrix products per candidate rather
+than a loop over points. Calinski-Harabasz needs no distances at all and is
+cheaper still.
+
+Only the largest candidate is fitted, with a few Lloyd iterations, and every
+smaller k comes from merging its centroids (weighted by their sizes, Ward
+style), so a node costs one cheap k-means on the sample whatever the range.
+When the sample is the whole node, which it is for most nodes, the winning
+labels are the split; bigger nodes go to the usual split function with the
+chosen k. Nodes under min_size just use a fixed k.
+
+  split = partial(kselect.adaptive_split, split=tb.kmeans_split, k_range=(2, 10))
+  tree = tb.build_tree(X, split)
+'''
+import numpy as np
+from scipy.cluster.hierarchy import linkage, fcluster
+from scipy.spatial.distance import squareform
+from sklearn.cluster import KMeans
+import distances
+import instrument
+
+CRITERIA = ('silhouette', 'calinski')
+
+
+def silhouette(D, labels, rows=None):
+    '''
+    Mean silhouette coefficient.
+    D - (s, m) distances from s scored points to all m points
+    labels - cluster of each of the m points
+    rows - which of the m points the rows of D are, None if s == m and in order
+    Points alone in their cluster score 0, as in sklearn.
+    '''
+    labels = np.asarray(labels)
+    rows = np.arange(len(labels)) if rows is None else np.asarray(rows)
+    k = int(labels.max()) + 1
+    if k < 2:
+        return -1.0
+    onehot = np.zeros((len(labels), k), dtype=np.float64)
+    onehot[np.arange(len(labels)), labels] = 1
+    counts = onehot.sum(axis=0)
+    sums = np.asarray(D, dtype=np.float64) @ onehot # (s, k) total distance to every cluster
+    own = labels[rows]
+    own_count = counts[own]
+    a = sums[np.arange(len(rows)), own] / np.maximum(own_count - 1, 1)
+    means = sums / np.maximum(counts, 1)
+    means[np.arange(len(rows)), own] = np.inf
+    means[:, counts == 0] = np.inf
+    b = means.min(axis=1)
+    s = (b - a) / np.maximum(np.maximum(a, b), 1e-12)
+    s[own_count <= 1] = 0
+    return float(s.mean())
+
+
+def calinski_harabasz(X, labels):
+    '''Calinski-Harabasz score: between to within cluster dispersion, higher is better.'''
+    X = np.asarray(X, dtype=np.float64)
+    labels = np.asarray(labels)
+    n, k = len(X), int(labels.max()) + 1
+    if k < 2 or k >= n:
+        return 0.0
+    onehot = np.zeros((n, k))
+    onehot[np.arange(n), labels] = 1
+    counts = onehot.sum(axis=0)
+    means = (onehot.T @ X) / np.maximum(counts, 1)[:, None]
+    mean = X.mean(axis=0)
+    between = float((counts * ((means - mean) ** 2).sum(axis=1)).sum())
+    # sum of |x - mean of its cluster|^2, without an (n, d) temporary
+    within = max(float(np.einsum('ij,ij->', X, X) - (counts * (means ** 2).sum(axis=1)).sum()), 0.0)
+    return between * (n - k) / (within * (k - 1)) if within > 0 else np.inf
+
+
+def _candidates(k_range, n):
+    lo, hi = k_range
+    return list(range(max(lo, 2), min(hi, n - 1) + 1))
+
+
+def _sample(X, indices, sample, random_state):
+    '''At most sample random rows of X[indices], as float32 vectors.'''
+    rng = np.random.default_rng(random_state)
+    if len(indices) > sample:
+        indices = indices[np.sort(rng.choice(len(indices), size=sample, replace=False))]
+    return np.asarray(X[indices], dtype=np.float32).reshape(len(indices), -1)
+
+
+def _ward_merges(centers, sizes, smallest):
+    '''
+    Merge size-weighted centers pairwise, cheapest Ward cost first, down to
+    smallest clusters. Yields (k, groups, centers) at every k on the way, groups
+    mapping each of the original centers to one of the k merged ones.
+    '''
+    centers = np.asarray(centers, dtype=np.float64).copy()
+    sizes = np.asarray(sizes, dtype=np.float64).copy()
+    groups = np.arange(len(centers))
+    alive = np.arange(len(centers))
+    while True:
+        yield len(alive), np.searchsorted(alive, groups), centers[alive]
+        if len(alive) <= smallest:
+            return
+        c, s = centers[alive], sizes[alive]
+        squared = ((c[:, None, :] - c[None, :, :]) ** 2).sum(axis=2)
+        cost = s[:, None] * s[None, :] / np.maximum(s[:, None] + s[None, :], 1) * squared
+        cost[np.diag_indices(len(alive))] = np.inf
+        i, j = np.unravel_index(np.argmin(cost), cost.shape)
+        a, b = alive[min(i, j)], alive[max(i, j)]
+        total = sizes[a] + sizes[b]
+        if total > 0:
+            centers[a] = (sizes[a] * centers[a] + sizes[b] * centers[b]) / total
+        sizes[a] = total
+        groups[groups == b] = a
+        alive = alive[alive != b]
+
+
+def _best_partition(Xs, candidates, criterion, n_iter, random_state):
+    '''
+    Best labels of the rows Xs over the candidate k. Only the largest k is
+    fitted (k-means++ and n_iter Lloyd iterations), every smaller one comes from
+    merging its centroids, and the silhouette distances are computed once.
+    Returns (k, labels, centers).
+    '''
+    kmeans = KMeans(n_clusters=candidates[-1], n_init=1, max_iter=n_iter, random_state=random_state).fit(Xs)
+    sizes = np.bincount(kmeans.labels_, minlength=candidates[-1])
+    D = distances.pairwise(Xs, workers=1) if criterion == 'silhouette' else None
+    best, best_score = None, -np.inf
+    for k, groups, centers in _ward_merges(kmeans.cluster_centers_, sizes, candidates[0]):
+        labels = groups[kmeans.labels_]
+        score = silhouette(D, labels) if D is not None else calinski_harabasz(Xs, labels)
+        if score > best_score:
+            best, best_score = (k, labels, centers.astype(np.float32)), score
+    return best
+
+
+def choose_k(X, k_range=(2, 10), criterion='silhouette', sample=500, n_iter=20, random_state=0):
+    '''
+    Best number of k-means clusters for the rows of X.
+    X - (n, ...) rows (can be a memmap or PQCodes: only the sample is read)
+    k_range - (smallest, largest) k to try
+    criterion - 'silhouette' or 'calinski'
+    sample - rows the candidates are fitted and scored on
+    n_iter - Lloyd iterations of the one k-means fit
+    Returns k, or None if X is too small to split.
+    '''
+    if criterion not in CRITERIA:
+        raise ValueError(f'Unknown criterion {criterion}')
+    Xs = _sample(X, np.arange(len(X)), sample, random_state)
+    candidates = _candidates(k_range, len(Xs))
+    if not candidates:
+        return None
+    return _best_partition(Xs, candidates, criterion, n_iter, random_state)[0]
+
+
+def adaptive_split(X, indices, split, k_range=(2, 10), criterion='silhouette', sample=500, k=None,
+                   min_size=100, n_iter=20, random_state=0):
+    '''
+    treebuilder split function choosing k per node on a sample of the node.
+    split - split(X, indices, k=k) for the whole node (e.g. treebuilder.kmeans_split,
+        or a partial of streamkmeans or quantize's)
+    k - fixed k for nodes smaller than min_size, the smallest of k_range if None
+    When the sample is the whole node, the winning labels (after a few more
+    Lloyd iterations) are the split and split isn't called at all.
+    '''
+    if criterion not in CRITERIA:
+        raise ValueError(f'Unknown criterion {criterion}')
+    if len(indices) < min_size:
+        return split(X, indices, k=k_range[0] if k is None else k)
+    with instrument.span('choose k', size=len(indices)):
+        Xs = _sample(X, indices, sample, random_state)
+        candidates = _candidates(k_range, len(Xs))
+        if not candidates:
+            return None
+        k, _, centers = _best_partition(Xs, candidates, criterion, n_iter, random_state)
+        if len(Xs) == len(indices):
+            kmeans = KMeans(n_clusters=k, init=centers, n_init=1, max_iter=n_iter).fit(Xs)
+    instrument.count(f'k={k}')
+    if len(Xs) == len(indices):
+        return kmeans.labels_, kmeans.cluster_centers_
+    return split(X, indices, k=k)
+
+
+def adaptive_precomputed_split(D, indices, k_range=(2, 10), method='average', sample=1000, random_state=0):
+    '''
+    treebuilder split function for a precomputed distance matrix: one linkage
+    of the node gives every candidate's labels (fcluster), and the silhouette
+    of a sample of rows is read straight off D, so no distance is recomputed.
+    '''
+    sub = np.asarray(D[np.ix_(indices, indices)], dtype=np.float64)
+    candidates = _candidates(k_range, len(indices))
+    if not candidates:
+        return None
+    with instrument.span('choose k', size=len(indices)):
+        Z = linkage(squareform(sub, checks=False), method=method)
+        rng = np.random.default_rng(random_state)
+        rows = np.sort(rng.choice(len(indices), size=min(len(indices), sample), replace=False))
+        best, best_score = None, -np.inf
+        for k in candidates:
+            labels = fcluster(Z, k, criterion='maxclust') - 1
+            if labels.max() < 1:
+                continue
+            score = silhouette(sub[rows], labels, rows)
+            if score > best_score:
+                best, best_score = labels, score
+    if best is None:
+        return None
+    instrument.count(f'k={int(best.max()) + 1}')
+    return best, None
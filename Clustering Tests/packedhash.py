@@ -0,0 +1,280 @@
+'''
+Bit-packed perceptual hashes and popcount based hamming distances.
+
+imagehash gives each hash as an 8x8 bool array. Packing it into a uint64
+makes it 64x smaller, and the distance between two hashes becomes
+popcount(a ^ b) which we compute for whole blocks of pairs at once.
+
+MultiIndexHash answers "everything within radius r" without comparing all
+pairs: split each code into m substrings, then by the pigeonhole principle any
+code within distance r is within r // m of the query on at least one
+substring, so only codes whose substring keys are that close need to be
+checked. Substrings are kept about log2(n) bits long so a bucket holds about
+one code, and the keys within r // m bits are probed directly.
+'''
+from itertools import combinations
+import numpy as np
+
+# Number of set bits in every byte value
+POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def pack_hashes(hashes):
+    '''
+    Pack boolean hashes into uint64 words.
+    hashes - (n, ...) bool array, e.g. (n, 8, 8) from imagehash or (n, 64)
+    Returns a (n, words) uint64 array, zero padded to a multiple of 64 bits.
+    '''
+    bits = np.asarray(hashes, dtype=bool).reshape(len(hashes), -1)
+    words = -(-bits.shape[1] // 64)
+    padded = np.zeros((len(bits), words * 64), dtype=bool)
+    padded[:, :bits.shape[1]] = bits
+    return np.ascontiguousarray(np.packbits(padded, axis=1)).view(np.uint64)
+
+
+def unpack_hashes(codes, nbits=64):
+    '''Inverse of pack_hashes, returns (n, nbits) bool.'''
+    codes = np.ascontiguousarray(codes, dtype=np.uint64)
+    return np.unpackbits(codes.view(np.uint8), axis=1)[:, :nbits].astype(bool)
+
+
+def popcount(x):
+    '''Number of set bits summed over the last axis of a uint64 array.'''
+    x = np.ascontiguousarray(x, dtype=np.uint64)
+    return POPCOUNT_TABLE[x.view(np.uint8)].sum(axis=-1, dtype=np.uint16)
+
+
+def _block(A, B):
+    '''Bit distances between every row of A and every row of B.'''
+    return popcount(A[:, None, :] ^ B[None, :, :])
+
+
+def distances(A, B=None, block_size=1024):
+    '''
+    Matrix of hamming distances (number of differing bits) as uint16.
+    A, B - packed codes from pack_hashes. B defaults to A.
+    '''
+    if B is None:
+        B = A
+    out = np.empty((len(A), len(B)), dtype=np.uint16)
+    for i in range(0, len(A), block_size):
+        for j in range(0, len(B), block_size):
+            out[i:i + block_size, j:j + block_size] = _block(A[i:i + block_size], B[j:j + block_size])
+    return out
+
+
+def condensed(A, nbits=None, block_size=1024):
+    '''
+    Condensed (scipy pdist layout) hamming distances between rows of A.
+    nbits - if given, distances are divided by it to give the fraction of
+        differing bits, matching pdist(..., metric='hamming') on the bool hashes.
+    '''
+    n = len(A)
+    out = np.empty(n * (n - 1) // 2, dtype=np.uint16 if nbits is None else np.float64)
+    for i in range(0, n, block_size):
+        rows = A[i:i + block_size]
+        for j in range(i, n, block_size):
+            d = _block(rows, A[j:j + block_size])
+            for r in range(len(rows)):
+                row = i + r
+                first = max(row + 1, j)
+                last = min(j + block_size, n)
+                if first >= last:
+                    continue
+                start = n * row - row * (row + 1) // 2 + (first - row - 1)
+                out[start:start + last - first] = d[r, first - j:last - j]
+    if nbits is not None:
+        out /= nbits
+    return out
+
+
+def knn(A, k, B=None, block_size=256):
+    '''
+    k nearest neighbours in hamming distance.
+    A - packed query codes
+    B - packed codes to search. If None, searches A itself and excludes each
+        query from its own results.
+    Returns (indices, distances), both (len(A), k), sorted by distance.
+    '''
+    exclude_self = B is None
+    if B is None:
+        B = A
+    k = min(k, len(B) - exclude_self)
+    indices = np.empty((len(A), k), dtype=np.int64)
+    dists = np.empty((len(A), k), dtype=np.uint16)
+    for i in range(0, len(A), block_size):
+        rows = A[i:i + block_size]
+        best_d = np.full((len(rows), 0), 0, dtype=np.uint16)
+        best_i = np.full((len(rows), 0), 0, dtype=np.int64)
+        for j in range(0, len(B), 4 * block_size):
+            d = _block(rows, B[j:j + 4 * block_size])
+            idx = np.broadcast_to(np.arange(j, j + d.shape[1]), d.shape)
+            if exclude_self:
+                d = d.astype(np.int32)
+                d[idx == np.arange(i, i + len(rows))[:, None]] = np.iinfo(np.uint16).max + 1
+            cand_d = np.concatenate([best_d, d], axis=1)
+            cand_i = np.concatenate([best_i, idx], axis=1)
+            keep = np.argpartition(cand_d, k - 1, axis=1)[:, :k] if cand_d.shape[1] > k else \
+                np.broadcast_to(np.arange(cand_d.shape[1]), cand_d.shape)
+            best_d = np.take_along_axis(cand_d, keep, axis=1)
+            best_i = np.take_along_axis(cand_i, keep, axis=1)
+        order = np.argsort(best_d, axis=1, kind='stable')
+        dists[i:i + len(rows)] = np.take_along_axis(best_d, order, axis=1)
+        indices[i:i + len(rows)] = np.take_along_axis(best_i, order, axis=1)
+    return indices, dists
+
+
+def _flips(nbits, radius):
+    '''Every mask of nbits bits with at most radius of them set, as uint64.'''
+    masks = [0]
+    for t in range(1, min(radius, nbits) + 1):
+        masks.extend(sum(1 << b for b in bits) for bits in combinations(range(nbits), t))
+    return np.array(masks, dtype=np.uint64)
+
+
+class MultiIndexHash:
+    '''
+    Multi-index hashing for radius queries on packed codes.
+    codes - packed codes from pack_hashes
+    radius - largest radius that will be queried
+    nbits - number of meaningful bits per code
+    n_chunks - substrings per code, by default as many as keep them about
+        log2(len(codes)) bits long, and at most radius + 1
+    '''
+    def __init__(self, codes, radius, nbits=64, n_chunks=None):
+        self.codes = np.ascontiguousarray(codes, dtype=np.uint64)
+        self.radius = radius
+        self.nbits = nbits
+        if n_chunks is None:
+            # about log2(n) bits per substring leaves about one code per bucket
+            width = max(int(np.ceil(np.log2(max(len(self.codes), 2)))), 1)
+            n_chunks = max(1, min(radius + 1, nbits // width))
+        self.n_chunks = n_chunks
+        # within radius r, some substring is within r // n_chunks of the query's
+        self.chunk_radius = radius // n_chunks
+        self.bounds = np.linspace(0, nbits, self.n_chunks + 1).astype(int)
+        self.flips = [_flips(int(self.bounds[c + 1] - self.bounds[c]), self.chunk_radius)
+                      for c in range(self.n_chunks)]
+
+        keys = self._keys(self.codes)
+        self.order = np.argsort(keys, axis=0, kind='stable')
+        self.sorted_keys = np.take_along_axis(keys, self.order, axis=0)
+
+    def _keys(self, codes):
+        '''(n, n_chunks) integer key of each substring.'''
+        bits = unpack_hashes(codes, self.nbits)
+        keys = np.zeros((len(codes), self.n_chunks), dtype=np.uint64)
+        for c in range(self.n_chunks):
+            chunk = bits[:, self.bounds[c]:self.bounds[c + 1]].astype(np.uint64)
+            weights = np.uint64(1) << np.arange(chunk.shape[1], dtype=np.uint64)
+            keys[:, c] = (chunk * weights).sum(axis=1, dtype=np.uint64)
+        return keys
+
+    def query(self, code, radius=None):
+        '''
+        Indices of all indexed codes within radius of a single packed code,
+        with their distances, sorted by distance.
+        '''
+        radius = self.radius if radius is None else radius
+        if radius > self.radius:
+            raise ValueError(f'Index was built for radius <= {self.radius}')
+        code = np.asarray(code, dtype=np.uint64).reshape(1, -1)
+        keys = self._keys(code)[0]
+        candidates = []
+        for c in range(self.n_chunks):
+            probes = keys[c] ^ self.flips[c]
+            lo = np.searchsorted(self.sorted_keys[:, c], probes, side='left')
+            hi = np.searchsorted(self.sorted_keys[:, c], probes, side='right')
+            candidates.extend(self.order[l:h, c] for l, h in zip(lo, hi) if h > l)
+        if not candidates:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.uint16)
+        candidates = np.unique(np.concatenate(candidates))
+        d = popcount(self.codes[candidates] ^ code)
+        keep = d <= radius
+        candidates, d = candidates[keep], d[keep]
+        order = np.argsort(d, kind='stable')
+        return candidates[order], d[order]
+
+    def _bucket_pairs(self, c):
+        '''
+        For every flip of substring c, the pairs of buckets (runs of equal keys in
+        sorted order) whose keys differ by it, each unordered pair once, as
+        (starts, sizes) of both sides.
+        '''
+        keys = self.sorted_keys[:, c]
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+        sizes = np.diff(np.r_[starts, len(keys)])
+        unique = keys[starts]
+        for flip in self.flips[c]:
+            if flip == 0:
+                a = np.flatnonzero(sizes > 1)
+                b = a
+            else:
+                targets = unique ^ flip
+                b = np.minimum(np.searchsorted(unique, targets), len(unique) - 1)
+                a = np.flatnonzero((unique[b] == targets) & (targets > unique))
+                b = b[a]
+            yield starts[a], sizes[a], starts[b], sizes[b]
+
+    def _candidate_count(self):
+        total = 0
+        for c in range(self.n_chunks):
+            for _, size_a, _, size_b in self._bucket_pairs(c):
+                total += int((size_a * size_b).sum())
+        return total
+
+    def _blocked_pairs(self, radius, block_size=1024):
+        '''radius_pairs by computing every distance, block by block.'''
+        pairs, dists = [], []
+        n = len(self.codes)
+        for i in range(0, n, block_size):
+            for j in range(i, n, block_size):
+                d = _block(self.codes[i:i + block_size], self.codes[j:j + block_size])
+                rows, columns = np.nonzero(d <= radius)
+                keep = i + rows < j + columns
+                rows, columns = rows[keep], columns[keep]
+                pairs.append(np.stack([i + rows, j + columns], axis=1))
+                dists.append(d[rows, columns])
+        pairs, dists = np.concatenate(pairs), np.concatenate(dists)
+        order = np.lexsort((pairs[:, 1], pairs[:, 0]))
+        return pairs[order], dists[order]
+
+    def radius_pairs(self, radius=None, max_candidates=1 << 22):
+        '''
+        All pairs (i, j), i < j, of indexed codes within radius of each other.
+        Candidates sharing a (nearby) substring are checked max_candidates at a
+        time, so only the pairs actually within radius are kept around. When
+        the buckets are so full that this would check more than a quarter of
+        all pairs, every distance is computed instead.
+        Returns (pairs, distances) with pairs a (p, 2) int array, sorted.
+        '''
+        radius = self.radius if radius is None else radius
+        if radius > self.radius:
+            raise ValueError(f'Index was built for radius <= {self.radius}')
+        n = len(self.codes)
+        if n < 2:
+            return np.empty((0, 2), dtype=np.int64), np.empty(0, dtype=np.uint16)
+        if self._candidate_count() > n * (n - 1) // 8:
+            return self._blocked_pairs(radius)
+        pairs = [np.empty((0, 2), dtype=np.int64)]
+        for c in range(self.n_chunks):
+            order = self.order[:, c]
+            for start_a, size_a, start_b, size_b in self._bucket_pairs(c):
+                work = size_a * size_b
+                ends = np.cumsum(work)
+                # pieces of consecutive bucket pairs with about max_candidates candidates each
+                cuts = np.r_[0, np.searchsorted(ends, np.arange(max_candidates, ends[-1] if len(ends) else 0,
+                                                                max_candidates), side='right'), len(work)]
+                for lo, hi in zip(cuts[:-1], cuts[1:]):
+                    if hi <= lo:
+                        continue
+                    # every (row, column) of the lo:hi blocks of bucket pairs
+                    owner = np.repeat(np.arange(lo, hi), work[lo:hi])
+                    local = np.arange(len(owner)) - np.repeat(ends[lo:hi] - work[lo:hi] - (ends[lo - 1] if lo else 0),
+                                                              work[lo:hi])
+                    i = order[start_a[owner] + local // size_b[owner]]
+                    j = order[start_b[owner] + local % size_b[owner]]
+                    keep = (i != j) & (popcount(self.codes[i] ^ self.codes[j]) <= radius)
+                    pairs.append(np.stack([np.minimum(i, j)[keep], np.maximum(i, j)[keep]], axis=1))
+        pairs = np.unique(np.concatenate(pairs), axis=0)
+        return pairs, popcount(self.codes[pairs[:, 0]] ^ self.codes[pairs[:, 1]])
@@ -0,0 +1,350 @@
+'''
+One entry point for all the clusterings: feature extractors, reducers and
+clusterers are registered plugins, and a job is extractor -> reducers ->
+clusterer. All the jobs of a run go into one DAG, so shared steps (loading the
+images, hashing the files, extracting a feature, a PCA) run once, independent
+stages run at the same time on a thread pool (the heavy parts are numpy, cv2,
+sklearn or keras, which release the GIL), and extracted features and
+reductions are cached on disk (see featurecache).
+
+Run from the repo root, jobs written as clusterer:extractor[+reducer...]:
+  python "Clustering Tests/pipeline.py" --run kmeans:pixels+pca --run kmeans:phash --run linkage:phash
+Each job writes ./output/<job>.json with centroids in ./output/centroids/.
+Parameters go in a json config instead:
+  {"images": "./example-data/images/*.JPEG",
+   "jobs": [{"extractor": "pixels", "reducers": [{"name": "pca", "n_components": 20}],
+             "clusterer": {"name": "kmeans", "k": 7}, "output": "./output/kmeans-pca.json"}]}
+
+New plugins register with the decorators:
+  @extractor('name')  fn(images, filenames, **params) -> one feature row per image
+  @reducer('name')    fn(X, **params) -> reduced X
+  @clusterer('name')  fn(X, images, names, preview_pattern, writer, **params) -> ClusterNode
+
+--trace ./output/trace.json records every stage (and the loading, hashing,
+splits and centroid writes inside them) as a Chrome trace, --profile <stage>
+runs cProfile around a stage, see instrument.py.
+'''
+import os
+import json
+import argparse
+from glob import glob
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+from scipy.cluster.hierarchy import linkage
+import imageloader
+import featurecache
+import treebuilder as tb
+import centroidwriter
+import distances
+import packedhash
+import dendrogram
+import colorfeatures
+import instrument
+import streamkmeans
+from clusternode import save_json
+
+EXTRACTORS = {} # name -> (fn, cache)
+REDUCERS = {}
+CLUSTERERS = {}
+
+
+def extractor(name, cache=True):
+    '''
+    Register a feature extractor.
+    cache - keep its features in a FeatureCache. Not worth it for features
+        that are as cheap to get as the images themselves.
+    '''
+    def register(fn):
+        EXTRACTORS[name] = (fn, cache)
+        return fn
+    return register
+
+
+def reducer(name):
+    def register(fn):
+        REDUCERS[name] = fn
+        return fn
+    return register
+
+
+def clusterer(name):
+    def register(fn):
+        CLUSTERERS[name] = fn
+        return fn
+    return register
+
+
+# Extractors
+
+@extractor('pixels', cache=False)
+def pixels(images, filenames):
+    return images.reshape(len(images), -1) # a view, no copy
+
+
+def _image_hash(hash_function, images, hash_size):
+    # (n, hash_size, hash_size) like hashCluster.py stores them, so the two share the 'phash' cache
+    import imagehash
+    return imageloader.map_chunks(
+        lambda chunk: np.stack([hash_function(imagehash, imageloader.to_pil(img), hash_size).hash
+                                for img in chunk]), images)
+
+
+@extractor('phash')
+def phash(images, filenames, hash_size=8):
+    return _image_hash(lambda imagehash, img, size: imagehash.phash(img, size), images, hash_size)
+
+
+@extractor('ahash')
+def ahash(images, filenames, hash_size=8):
+    return _image_hash(lambda imagehash, img, size: imagehash.average_hash(img, size), images, hash_size)
+
+
+@extractor('dhash')
+def dhash(images, filenames, hash_size=8):
+    return _image_hash(lambda imagehash, img, size: imagehash.dhash(img, size), images, hash_size)
+
+
+@extractor('colorhist')
+def colorhist(images, filenames, bins=8):
+    '''Normalized joint BGR histogram with bins per channel.'''
+    import cv2
+    def histogram(img):
+        hist = cv2.calcHist([img], [0, 1, 2], None, [bins] * 3, [0, 256] * 3).ravel()
+        return hist / max(hist.sum(), 1)
+    return imageloader.map_chunks(lambda chunk: np.stack([histogram(img) for img in chunk]).astype(np.float32),
+                                  images)
+
+
+@extractor('color')
+def color(images, filenames, grid=8, bins=4, hist_weight=1.0):
+    '''Lab thumbnail plus joint color histogram, 256 floats with the defaults (see colorfeatures).'''
+    return colorfeatures.describe(images, grid=grid, bins=bins, hist_weight=hist_weight)
+
+
+@extractor('vgg16')
+def vgg16(images, filenames, pooling=None):
+    from kerasCluster import kerasCluster # keras is slow to import, only do it when needed
+    return kerasCluster(list(filenames), pooling=pooling)
+
+
+# Reducers
+
+@reducer('pca')
+def pca(X, n_components=20, method='randomized'):
+    import embedding
+    return embedding.stream_pca(X, n_components=n_components, method=method)[1]
+
+
+@reducer('float16')
+def float16(X):
+    import quantize
+    return quantize.to_float16(X)
+
+
+# Clusterers
+
+@clusterer('kmeans')
+def kmeans(X, images, names, preview_pattern, writer, k=7, split_threshold=10, max_depth=10, minibatch=False,
+           batch_size=1024, workers=None, k_range=None, criterion='silhouette'):
+    '''Hierarchical k-means, with k chosen per node from k_range if given (see kselect).'''
+    X = X.reshape(len(X), -1)
+    split = partial(streamkmeans.minibatch_kmeans_split, batch_size=batch_size) if minibatch else tb.kmeans_split
+    split = tb.make_split(split, k, k_range, criterion)
+    tree = tb.build_tree(X, split, split_threshold=split_threshold, max_depth=max_depth, workers=workers)
+    return tb.cluster_nodes(tree, images, names, preview_pattern, writer)
+
+
+@clusterer('agglomerative')
+def agglomerative(X, images, names, preview_pattern, writer, k=7, n_neighbors=15, linkage='average',
+                  split_threshold=10, max_depth=10):
+    '''Sparse kNN graph agglomerative clustering, cut into a k-ary tree (see dendrogram).'''
+    indices, dists = distances.knn(X.reshape(len(X), -1), n_neighbors)
+    Z = dendrogram.sparse_linkage(distances.knn_graph(indices, dists), linkage=linkage)
+    tree = dendrogram.to_tree(Z, k=k, split_threshold=split_threshold, max_depth=max_depth)
+    return tb.cluster_nodes(tree, images, names, preview_pattern, writer)
+
+
+@clusterer('linkage')
+def full_linkage(X, images, names, preview_pattern, writer, method='complete', threshold=None, max_children=None):
+    '''
+    Every merge of a full scipy linkage as a cluster (see dendrogram.linkage_tree).
+    Binary features (hashes) use packed hamming distances.
+    '''
+    X = X.reshape(len(X), -1)
+    if X.dtype == bool:
+        condensed = packedhash.condensed(packedhash.pack_hashes(X), nbits=X.shape[1])
+    else:
+        condensed = distances.condensed(X)
+    tree = dendrogram.linkage_tree(linkage(condensed, method=method), threshold=threshold,
+                                   max_children=max_children)
+    return tb.cluster_nodes(tree, images, names, preview_pattern, writer, single_points=True)
+
+
+class Stage:
+    '''A node of the DAG: fn is called with the results of deps. name labels it in traces.'''
+    def __init__(self, key, fn, deps=(), name=None):
+        self.key = key
+        self.fn = fn
+        self.deps = list(deps)
+        self.name = name or key
+
+    def __call__(self, *inputs):
+        with instrument.span(self.name), instrument.profile(self.name):
+            return self.fn(*inputs)
+
+
+def _key(kind, name, params, *upstream):
+    return json.dumps([kind, name, sorted(params.items())] + list(upstream), default=str)
+
+
+def _label(name, params):
+    return name + ''.join(f'-{key}{value}' for key, value in sorted(params.items()))
+
+
+class Pipeline:
+    '''
+    A set of jobs over the same images. Add jobs with add_job (or the
+    features/reduce/cluster steps), then run.
+    pattern - glob of the images
+    cache_root - featurecache root
+    workers - stages running at once
+    '''
+    def __init__(self, pattern, cache_root=featurecache.DEFAULT_ROOT, workers=None, writer=None):
+        self.filenames = sorted(glob(pattern))
+        if not self.filenames:
+            raise ValueError(f'No images match {pattern}')
+        self.cache_root = cache_root
+        self.workers = workers or os.cpu_count() or 1
+        self.writer = writer
+        self.stages = {}
+        self.outputs = []
+        self.images = self._add(Stage('images', lambda: imageloader.load_images(self.filenames)))
+        self.hashes = self._add(Stage('hashes', lambda: featurecache.hash_files(self.filenames)))
+
+    def _add(self, stage):
+        # the same step with the same inputs is only run once
+        self.stages.setdefault(stage.key, stage)
+        return stage.key
+
+    def features(self, name, **params):
+        fn, cache = EXTRACTORS[name]
+        if not cache:
+            return self._add(Stage(_key('extract', name, params), lambda images: fn(images, self.filenames, **params),
+                                   [self.images], _label(name, params)))
+
+        def extract(images, hashes):
+            store = featurecache.FeatureCache(_label(name, params), root=self.cache_root)
+            features = store.get_or_compute(self.filenames, lambda idx: fn(images[idx], np.array(self.filenames)[idx],
+                                                                           **params), hashes=hashes)
+            return features.reshape(len(features), -1) # one flat row per image
+        return self._add(Stage(_key('extract', name, params), extract, [self.images, self.hashes], _label(name, params)))
+
+    def reduce(self, upstream, name, **params):
+        fn = REDUCERS[name]
+        key = _key('reduce', name, params, upstream)
+
+        def run(X, hashes):
+            cache_key = featurecache.combined_hash(hashes, key)
+            return featurecache.cached_result(_label(name, params), cache_key, lambda: fn(X, **params),
+                                              root=self.cache_root)
+        return self._add(Stage(key, run, [upstream, self.hashes], _label(name, params)))
+
+    def cluster(self, upstream, name, output, **params):
+        fn = CLUSTERERS[name]
+        job = os.path.splitext(os.path.basename(output))[0]
+        preview_pattern = os.path.join(os.path.dirname(output) or '.', 'centroids', job + '-centroid-{}.JPEG')
+        os.makedirs(os.path.dirname(preview_pattern), exist_ok=True)
+
+        def run(X, images):
+            print(f'{job}: clustering')
+            with centroidwriter.using(self.writer) as writer:
+                root = fn(X, images, np.array(self.filenames), preview_pattern, writer, **params)
+            save_json(root, output)
+            print(f'{job}: wrote {output}')
+            return output
+        self.outputs.append(output)
+        return self._add(Stage(_key('cluster', name, params, upstream, output), run, [upstream, self.images], job))
+
+    def add_job(self, extractor, clusterer, output=None, reducers=()):
+        '''
+        extractor, clusterer - name, or dict with 'name' and parameters
+        reducers - list of the same, applied in order
+        output - json path, ./output/<clusterer>-<extractor>[-<reducers>].json by default
+        '''
+        def split(step):
+            step = dict(step) if isinstance(step, dict) else {'name': step}
+            return step.pop('name'), step
+
+        name, params = split(extractor)
+        key = self.features(name, **params)
+        names = [name]
+        for step in reducers:
+            name, params = split(step)
+            key = self.reduce(key, name, **params)
+            names.append(name)
+        name, params = split(clusterer)
+        output = output or f'./output/{name}-' + '-'.join(names) + '.json'
+        return self.cluster(key, name, output, **params)
+
+    def run(self):
+        '''Run every stage once its inputs are ready. Returns the results by stage key.'''
+        results = {}
+        remaining = dict(self.stages)
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            running = {}
+            while remaining or running:
+                for key, stage in list(remaining.items()):
+                    if all(dep in results for dep in stage.deps):
+                        del remaining[key]
+                        running[pool.submit(stage, *[results[dep] for dep in stage.deps])] = key
+                if not running:
+                    raise ValueError('Stages depend on something that is never computed')
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    results[running.pop(future)] = future.result()
+        return results
+
+
+def parse_job(spec):
+    ''''clusterer:extractor+reducer+...' -> add_job arguments'''
+    clusterer_name, _, features = spec.partition(':')
+    if not features:
+        raise ValueError(f'Job {spec} should look like clusterer:extractor[+reducer...]')
+    extractor_name, *reducers = features.split('+')
+    return dict(extractor=extractor_name, clusterer=clusterer_name, reducers=reducers)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run several clusterings over shared features')
+    parser.add_argument('--images', default='./example-data/images/*.JPEG')
+    parser.add_argument('--run', action='append', default=[], metavar='CLUSTERER:EXTRACTOR[+REDUCER...]')
+    parser.add_argument('--config', help='json file with images and jobs, see the module docstring')
+    parser.add_argument('--workers', type=int, default=None, help='stages running at once')
+    parser.add_argument('--list', action='store_true', help='list the registered plugins')
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    instrument.setup(args)
+
+    if args.list:
+        print('extractors:', ', '.join(EXTRACTORS))
+        print('reducers:', ', '.join(REDUCERS))
+        print('clusterers:', ', '.join(CLUSTERERS))
+        raise SystemExit
+
+    jobs = [parse_job(spec) for spec in args.run]
+    images = args.images
+    if args.config:
+        with open(args.config) as f:
+            config = json.load(f)
+        images = config.get('images', images)
+        jobs += config.get('jobs', [])
+    if not jobs:
+        parser.error('nothing to do, add --run or --config')
+
+    with centroidwriter.CentroidWriter() as writer:
+        pipeline = Pipeline(images, workers=args.workers, writer=writer)
+        for job in jobs:
+            pipeline.add_job(**job)
+        pipeline.run()
+    print("Done!")
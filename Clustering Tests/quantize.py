@@ -0,0 +1,298 @@
+'''
+Compressed storage for clustering features.
+
+Two options, both usable in place of the feature matrix:
+  float16 - to_float16 halves float32 features (a quarter of float64). Reads
+      of X[indices] come back as float16 and get upcast per node (or per batch
+      with streaming k-means, see streamkmeans), so the full matrix is never
+      held at full precision.
+  product quantization - ProductQuantizer splits every vector into m
+      sub-vectors and replaces each by the index of the nearest of 256
+      codewords learned for that subspace, so a vector costs m bytes. With
+      m = d / 8 that's 32x smaller than float32.
+
+PQCodes wraps codes and their quantizer so they look like a read-only float32
+array: X[indices] decodes just those rows, so existing split functions work
+unchanged. pq_kmeans_split runs k-means on the codes themselves, with
+asymmetric distances (exact centroid against quantized points, via a lookup
+table per centroid), so big nodes are never decoded. pairwise and knn give
+symmetric (code against code) distances for the agglomerative paths, looked
+up from codeword tables instead of decoding.
+'''
+import numpy as np
+from sklearn.cluster import KMeans
+import treebuilder as tb
+import instrument
+
+
+def to_float16(X, chunk_size=4096, out=None):
+    '''
+    Copy X to float16 in chunks, so a big float32/float64 X is never copied
+    whole. out can be a preallocated array or np.memmap of X's shape.
+    '''
+    if out is None:
+        out = np.empty(X.shape, dtype=np.float16)
+    for start in range(0, len(X), chunk_size):
+        out[start:start + chunk_size] = X[start:start + chunk_size]
+    return out
+
+
+class ProductQuantizer:
+    '''
+    m - number of subspaces, i.e. bytes per vector. Vectors are zero padded
+        to a multiple of m.
+    ks - codewords per subspace, at most 256 so codes fit in uint8
+    '''
+    def __init__(self, m=8, ks=256):
+        if ks > 256:
+            raise ValueError('ks has to fit in a byte')
+        self.m = m
+        self.ks = ks
+        self.d = None
+        self.codebooks = None # (m, ks, dsub)
+
+    @property
+    def dsub(self):
+        return self.codebooks.shape[2]
+
+    def _rows(self, X):
+        '''Rows as float32, zero padded to m * dsub columns.'''
+        X = np.asarray(X, dtype=np.float32).reshape(len(X), -1)
+        pad = self.m * self.dsub - X.shape[1]
+        if pad:
+            X = np.pad(X, ((0, 0), (0, pad)))
+        return X.reshape(len(X), self.m, self.dsub)
+
+    def fit(self, X, sample=20000, n_iter=20, random_state=0):
+        '''
+        Learn the codebooks with k-means in every subspace, on a random sample
+        of at most sample rows of X.
+        '''
+        n = len(X)
+        self.d = int(np.prod(X.shape[1:]))
+        rng = np.random.default_rng(random_state)
+        rows = np.sort(rng.choice(n, size=min(n, sample), replace=False))
+        ks = min(self.ks, len(rows))
+        dsub = -(-self.d // self.m)
+        self.codebooks = np.zeros((self.m, self.ks, dsub), dtype=np.float32)
+        sub = self._rows(X[rows])
+        for j in range(self.m):
+            kmeans = KMeans(n_clusters=ks, n_init=1, max_iter=n_iter, random_state=random_state).fit(sub[:, j])
+            self.codebooks[j, :ks] = kmeans.cluster_centers_
+            # with a tiny sample, pad with copies; argmin never picks them
+            self.codebooks[j, ks:] = kmeans.cluster_centers_[0]
+        return self
+
+    def encode(self, X, chunk_size=4096):
+        '''(n, m) uint8 codes of the rows of X, computed a chunk at a time.'''
+        codes = np.empty((len(X), self.m), dtype=np.uint8)
+        norms = np.einsum('jkd,jkd->jk', self.codebooks, self.codebooks)
+        for start in range(0, len(X), chunk_size):
+            sub = self._rows(X[start:start + chunk_size])
+            for j in range(self.m):
+                # nearest codeword: minimize |c|^2 - 2xc
+                d = norms[j] - 2 * sub[:, j] @ self.codebooks[j].T
+                codes[start:start + chunk_size, j] = np.argmin(d, axis=1)
+        return codes
+
+    def decode(self, codes):
+        '''Approximate float32 vectors for codes.'''
+        codes = np.asarray(codes)
+        out = np.empty((len(codes), self.m, self.dsub), dtype=np.float32)
+        for j in range(self.m):
+            out[:, j] = self.codebooks[j][codes[:, j]]
+        return out.reshape(len(codes), -1)[:, :self.d]
+
+    def distance_table(self, q):
+        '''(m, ks) squared distances from each sub-vector of q to every codeword.'''
+        sub = self._rows(np.asarray(q)[None])[0]
+        return ((self.codebooks - sub[:, None, :]) ** 2).sum(axis=2)
+
+    def adc(self, codes, q):
+        '''
+        Asymmetric squared distances from an exact vector q to quantized
+        vectors: one table lookup per subspace instead of a d-dimensional
+        difference.
+        '''
+        table = self.distance_table(q)
+        return table[np.arange(self.m), codes].sum(axis=1)
+
+    def codeword_distances(self):
+        '''(m, ks, ks) squared distances between the codewords of each subspace.'''
+        norms = np.einsum('jkd,jkd->jk', self.codebooks, self.codebooks)
+        dots = np.einsum('jad,jbd->jab', self.codebooks, self.codebooks)
+        return np.maximum(norms[:, :, None] + norms[:, None, :] - 2 * dots, 0)
+
+    def save(self, path):
+        np.savez(path, m=self.m, ks=self.ks, d=self.d, codebooks=self.codebooks)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        pq = cls(int(data['m']), int(data['ks']))
+        pq.d = int(data['d'])
+        pq.codebooks = data['codebooks']
+        return pq
+
+
+class PQCodes:
+    '''
+    Product quantized rows that index like a float32 (n, d) array: X[rows]
+    decodes only those rows. Small and picklable, so it can be sent to the
+    treebuilder process pool.
+    '''
+    dtype = np.dtype(np.float32)
+
+    def __init__(self, codes, pq):
+        self.codes = codes
+        self.pq = pq
+
+    @classmethod
+    def compress(cls, X, m=8, sample=20000, random_state=0):
+        '''Fit a quantizer on X and encode it.'''
+        pq = ProductQuantizer(m).fit(X, sample=sample, random_state=random_state)
+        return cls(pq.encode(X), pq)
+
+    def __len__(self):
+        return len(self.codes)
+
+    @property
+    def shape(self):
+        return (len(self.codes), self.pq.d)
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes
+
+    def __getitem__(self, rows):
+        return self.pq.decode(self.codes[rows])
+
+    def __array__(self, dtype=None, copy=None):
+        decoded = self.pq.decode(self.codes)
+        return decoded if dtype is None else decoded.astype(dtype)
+
+
+def _assign(codes, pq, centers, chunk_size=16384):
+    '''Nearest center (by ADC) and its squared distance for every code.'''
+    tables = np.stack([pq.distance_table(c) for c in centers]) # (k, m, ks)
+    labels = np.empty(len(codes), dtype=np.int64)
+    dist = np.empty(len(codes), dtype=np.float32)
+    subspaces = np.arange(pq.m)
+    for start in range(0, len(codes), chunk_size):
+        chunk = codes[start:start + chunk_size]
+        d = tables[:, subspaces, chunk].sum(axis=2).T # (chunk, k)
+        labels[start:start + chunk_size] = np.argmin(d, axis=1)
+        dist[start:start + chunk_size] = d[np.arange(len(chunk)), labels[start:start + chunk_size]]
+    return labels, dist
+
+
+def _means(codes, pq, labels, k):
+    '''Mean of the decoded vectors of each cluster, from codeword counts.'''
+    counts = np.zeros((k, pq.m, pq.ks))
+    for j in range(pq.m):
+        np.add.at(counts[:, j], (labels, codes[:, j]), 1)
+    sums = np.einsum('cjk,jkd->cjd', counts, pq.codebooks).reshape(k, -1)[:, :pq.d]
+    sizes = np.bincount(labels, minlength=k)
+    return (sums / np.maximum(sizes, 1)[:, None]).astype(np.float32), sizes
+
+
+def pq_kmeans(codes, pq, k, n_iter=50, random_state=0):
+    '''
+    Lloyd's k-means directly on product quantized codes. Initialized with
+    k-means++ (using ADC distances). Returns (labels, centers).
+    '''
+    rng = np.random.default_rng(random_state)
+    n = len(codes)
+    centers = [pq.decode(codes[rng.integers(n)][None])[0]]
+    closest = pq.adc(codes, centers[0])
+    for _ in range(1, k):
+        total = closest.sum()
+        i = rng.choice(n, p=closest / total) if total > 0 else rng.integers(n)
+        centers.append(pq.decode(codes[i][None])[0])
+        closest = np.minimum(closest, pq.adc(codes, centers[-1]))
+    centers = np.stack(centers)
+
+    labels = None
+    for _ in range(n_iter):
+        new_labels, dist = _assign(codes, pq, centers)
+        if labels is not None and np.array_equal(labels, new_labels):
+            break
+        labels = new_labels
+        centers, sizes = _means(codes, pq, labels, k)
+        # restart empty clusters on the worst fitting points
+        for c in np.flatnonzero(sizes == 0):
+            worst = int(np.argmax(dist))
+            centers[c] = pq.decode(codes[worst][None])[0]
+            dist[worst] = 0
+    return labels, centers
+
+
+def pq_kmeans_split(X, indices, k, small=4096, **kwargs):
+    '''
+    treebuilder split function for PQCodes, running k-means on the codes.
+    The centers are in the original feature space. Small nodes are decoded and
+    split with plain k-means, which is faster there. Extra keyword arguments go
+    to pq_kmeans.
+    '''
+    if len(indices) <= small:
+        return tb.kmeans_split(X, indices, k)
+    return pq_kmeans(X.codes[indices], X.pq, k, **kwargs)
+
+
+def _sdc(tables, a, b):
+    '''Squared symmetric distances between two blocks of codes.'''
+    d = np.zeros((len(a), len(b)))
+    for s in range(len(tables)):
+        d += tables[s][a[:, s][:, None], b[:, s][None, :]]
+    return d
+
+
+def pairwise(X, block_size=1024, dtype=np.float32):
+    '''
+    Euclidean distance matrix between the rows of PQCodes, both sides
+    quantized, like distances.pairwise on the decoded rows.
+    '''
+    tables = X.pq.codeword_distances()
+    n = len(X)
+    out = np.empty((n, n), dtype=dtype)
+    with instrument.span('pq pairwise distances', rows=n):
+        for i in range(0, n, block_size):
+            a = X.codes[i:i + block_size]
+            for j in range(i, n, block_size):
+                d = np.sqrt(_sdc(tables, a, X.codes[j:j + block_size]))
+                out[i:i + block_size, j:j + block_size] = d
+                out[j:j + block_size, i:i + block_size] = d.T
+    np.fill_diagonal(out, 0)
+    return out
+
+
+def knn(X, k, block_size=1024):
+    '''
+    k nearest neighbours of every row of PQCodes among the other rows, by
+    symmetric distance, like distances.knn. Memory is O(block_size^2 + n * k).
+    Returns (indices, distances), both (n, k), sorted by distance.
+    '''
+    tables = X.pq.codeword_distances()
+    n = len(X)
+    k = min(k, n - 1)
+    indices = np.empty((n, k), dtype=np.int64)
+    dists = np.empty((n, k), dtype=np.float32)
+    with instrument.span('pq knn', rows=n, k=k):
+        for i in range(0, n, block_size):
+            a = X.codes[i:i + block_size]
+            best_d = np.empty((len(a), 0))
+            best_i = np.empty((len(a), 0), dtype=np.int64)
+            for j in range(0, n, block_size):
+                d = _sdc(tables, a, X.codes[j:j + block_size])
+                idx = np.broadcast_to(np.arange(j, j + d.shape[1]), d.shape)
+                d[idx == np.arange(i, i + len(a))[:, None]] = np.inf # not its own neighbour
+                best_d = np.concatenate([best_d, d], axis=1)
+                best_i = np.concatenate([best_i, idx], axis=1)
+                if best_d.shape[1] > k:
+                    keep = np.argpartition(best_d, k - 1, axis=1)[:, :k]
+                    best_d = np.take_along_axis(best_d, keep, axis=1)
+                    best_i = np.take_along_axis(best_i, keep, axis=1)
+            order = np.argsort(best_d, axis=1, kind='stable')
+            indices[i:i + block_size] = np.take_along_axis(best_i, order, axis=1)
+            dists[i:i + block_size] = np.sqrt(np.take_along_axis(best_d, order, axis=1))
+    return indices, dists
@@ -0,0 +1,72 @@
+'''
+Mini-batch k-means that streams over a (possibly memory-mapped) feature matrix.
+
+Full k-means re-reads every row of a node's subset on every Lloyd iteration,
+and X[indices] copies the whole subset first. Here the centroids are fit with
+MiniBatchKMeans.partial_fit on random batches read straight out of X, stopping
+once the centroids stop moving, and labels are assigned in one chunked pass.
+Memory use depends on batch_size and chunk_size, not on the size of the node.
+'''
+import numpy as np
+from sklearn.cluster import MiniBatchKMeans
+import treebuilder as tb
+
+
+def minibatch_kmeans(X, k, indices=None, batch_size=1024, max_iter=200, tol=1e-3,
+                     patience=5, random_state=0):
+    '''
+    Fit k centroids on rows of X with mini-batch k-means.
+    X - (n, d) array, may be a np.memmap
+    indices - rows of X to use (all of them if None)
+    batch_size - rows drawn per iteration
+    max_iter - most batches to draw
+    tol - stop when the largest centroid shift, relative to the mean
+        centroid norm, stays below tol for patience batches in a row
+    Returns the fitted MiniBatchKMeans.
+    '''
+    if indices is None:
+        indices = np.arange(len(X))
+    rng = np.random.default_rng(random_state)
+    # the first batch initializes the centroids, so it needs at least k rows
+    batch_size = max(batch_size, 3 * k)
+    kmeans = MiniBatchKMeans(n_clusters=k, batch_size=batch_size, random_state=random_state, n_init=1)
+
+    previous = None
+    still = 0
+    for _ in range(max_iter):
+        # sorted so a memmap is read front to back
+        batch = np.sort(rng.choice(indices, size=min(batch_size, len(indices)), replace=False))
+        kmeans.partial_fit(np.asarray(X[batch], dtype=np.float64))
+        centers = kmeans.cluster_centers_
+        if previous is not None:
+            shift = np.max(np.linalg.norm(centers - previous, axis=1))
+            scale = np.mean(np.linalg.norm(centers, axis=1)) or 1
+            still = still + 1 if shift / scale < tol else 0
+            if still >= patience:
+                break
+        previous = centers.copy()
+    return kmeans
+
+
+def assign_labels(X, kmeans, indices=None, chunk_size=4096):
+    '''Nearest centroid for every row in indices, one chunk at a time.'''
+    if indices is None:
+        indices = np.arange(len(X))
+    labels = np.empty(len(indices), dtype=np.int64)
+    for start in range(0, len(indices), chunk_size):
+        chunk = np.asarray(X[indices[start:start + chunk_size]], dtype=np.float64)
+        labels[start:start + chunk_size] = kmeans.predict(chunk)
+    return labels
+
+
+def minibatch_kmeans_split(X, indices, k, **kwargs):
+    '''
+    treebuilder split function using streaming mini-batch k-means.
+    Nodes that fit in a few batches are small enough for plain k-means, which
+    is faster and better there. Extra keyword arguments go to minibatch_kmeans.
+    '''
+    if len(indices) <= 4 * kwargs.get('batch_size', 1024):
+        return tb.kmeans_split(X, indices, k)
+    kmeans = minibatch_kmeans(X, k, indices, **kwargs)
+    labels = assign_labels(X, kmeans, indices)
+    return labels, kmeans.cluster_centers_
@@ -0,0 +1,173 @@
+'''
+Thumbnail pyramid and per-cluster sprite atlases for the viewer.
+
+Run after clustering, on the json it wrote:
+  python "Clustering Tests/thumbnails.py" ./output/keras.json
+
+Every preview in the tree (source photos and centroids) is downscaled to a few
+widths, in parallel, into <out>/<width>/, and every node gets "thumbs":
+{width: path}. Then for every cluster the thumbnails of its children are read
+back and packed into sprite atlases in <out>/atlas/. The cluster gets
+"atlas": [paths], and each child gets "sprite": [atlas index, x, y, width,
+height], so opening a cluster needs one image request instead of one per
+child. Only one cluster's thumbnails are in memory at a time.
+'''
+import os
+import hashlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+import clusternode as cn
+import centroidwriter
+import imageloader
+
+DEFAULT_OUT = './output/thumbs'
+
+
+def thumbnail_key(path):
+    '''File name of a preview's thumbnails. Hashing the path keeps same-named files in different folders apart.'''
+    return hashlib.sha1(path.encode('utf-8')).hexdigest()[:12] + '-' + os.path.splitext(os.path.basename(path))[0]
+
+
+def downscale(img, width):
+    '''Resize to the given width keeping the aspect ratio. Never upscales.'''
+    if img.shape[1] <= width:
+        return img
+    height = max(1, round(img.shape[0] * width / img.shape[1]))
+    return cv2.resize(img, (width, height), interpolation=cv2.INTER_AREA)
+
+
+def build_thumbnails(previews, out_dir=DEFAULT_OUT, widths=(32, 64, 128), writer=None, workers=None):
+    '''
+    Write thumbnails of every preview at every width.
+    Returns {preview: {width: path of the thumbnail}}.
+    '''
+    for width in widths:
+        os.makedirs(os.path.join(out_dir, str(width)), exist_ok=True)
+
+    def make(path):
+        try:
+            img = imageloader.read_image(path)
+        except IOError:
+            print(f'Skipping missing preview {path}')
+            return path, None
+        thumbs = {}
+        # each size from the previous one, cheaper than from the original every time
+        for width in sorted(widths, reverse=True):
+            img = downscale(img, width)
+            thumbs[str(width)] = writer.write(os.path.join(out_dir, str(width), thumbnail_key(path)), img)
+        return path, thumbs
+
+    result = {}
+    with centroidwriter.using(writer) as writer:
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as pool:
+            for path, thumbs in pool.map(make, previews):
+                if thumbs is not None:
+                    result[path] = thumbs
+    return result
+
+
+def pack(images, max_size=2048):
+    '''
+    Pack images into as few atlases as needed, in rows (shelf packing).
+    Returns (atlases, sprites) with sprites[i] = [atlas index, x, y, w, h].
+    '''
+    atlases = []
+    sprites = []
+    placed = [] # (x, y, img) in the atlas being filled
+    x = y = row_height = width = height = 0
+    # roughly square atlases: aim for sqrt(n) images per row
+    if images:
+        per_row = max(1, int(np.ceil(np.sqrt(len(images)))))
+        row_width = min(max_size, per_row * max(img.shape[1] for img in images))
+    for img in images:
+        h, w = img.shape[:2]
+        if x + w > row_width:
+            x, y = 0, y + row_height
+            row_height = 0
+        if y + h > max_size:
+            atlases.append(_compose(placed, width, height))
+            placed = []
+            x = y = row_height = width = height = 0
+        placed.append((x, y, img))
+        sprites.append([len(atlases), x, y, w, h])
+        x += w
+        row_height = max(row_height, h)
+        width, height = max(width, x), max(height, y + row_height)
+    if placed:
+        atlases.append(_compose(placed, width, height))
+    return atlases, sprites
+
+
+def _compose(placed, width, height):
+    atlas = np.zeros((height, width, 3), dtype=np.uint8)
+    for x, y, img in placed:
+        atlas[y:y + img.shape[0], x:x + img.shape[1]] = img
+    return atlas
+
+
+def build_atlases(root, thumbs, width, out_dir=DEFAULT_OUT, writer=None, max_size=2048):
+    '''
+    Pack the width-wide thumbnails of each cluster's children into atlases,
+    setting atlas on the clusters and sprite on their children.
+    thumbs - {preview: {width: path}} from build_thumbnails, written already
+    '''
+    os.makedirs(os.path.join(out_dir, 'atlas'), exist_ok=True)
+    with centroidwriter.using(writer) as writer:
+        stack = [root]
+        n_atlases = 0
+        while stack:
+            node = stack.pop()
+            children = node.children or []
+            stack.extend(children)
+            with_preview = [child for child in children if child.preview in thumbs]
+            if not with_preview:
+                continue
+            images = [imageloader.read_image(thumbs[child.preview][str(width)]) for child in with_preview]
+            atlases, sprites = pack(images, max_size)
+            node.atlas = []
+            for atlas in atlases:
+                node.atlas.append(writer.write(os.path.join(out_dir, 'atlas', f'atlas-{n_atlases}'), atlas))
+                n_atlases += 1
+            for child, sprite in zip(with_preview, sprites):
+                child.sprite = sprite
+    return root
+
+
+def add_previews(root, out_dir=DEFAULT_OUT, widths=(32, 64, 128), atlas_width=64, workers=None):
+    '''Build the thumbnails and atlases for a ClusterNode tree.'''
+    previews = sorted({node.preview for node in _nodes(root) if node.preview is not None})
+    # closing the writer waits for every thumbnail, the atlases read them back
+    thumbs = build_thumbnails(previews, out_dir, widths, workers=workers)
+    for node in _nodes(root):
+        node.thumbs = thumbs.get(node.preview)
+    with centroidwriter.CentroidWriter(workers=workers) as writer:
+        build_atlases(root, thumbs, atlas_width, out_dir, writer=writer)
+    return root
+
+
+def _nodes(root):
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        yield node
+        stack.extend(node.children or [])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build preview thumbnails and sprite atlases for a cluster tree')
+    parser.add_argument('tree', help='json written by one of the clustering scripts')
+    parser.add_argument('--out', default=DEFAULT_OUT, help='directory for the thumbnails and atlases')
+    parser.add_argument('--widths', type=int, nargs='+', default=[32, 64, 128])
+    parser.add_argument('--atlas-width', type=int, default=64, help='which thumbnail width goes into the atlases')
+    parser.add_argument('--output', help='where to write the json with atlases (default: overwrite the input)')
+    parser.add_argument('--compact', action='store_true', help='write the json without indentation')
+    args = parser.parse_args()
+    if args.atlas_width not in args.widths:
+        parser.error('--atlas-width has to be one of --widths')
+
+    print("Building thumbnails...")
+    tree = add_previews(cn.load_json(args.tree), args.out, args.widths, args.atlas_width)
+    cn.save_json(tree, args.output or args.tree, indent=None if args.compact else 2)
+    print("Done!")
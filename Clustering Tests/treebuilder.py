@@ -0,0 +1,329 @@
+'''
+Shared engine for the recursive hierarchical clusterers.
+
+The clusterers only differ in how they split a set of points, so they just
+provide a split function and this module does the recursion. Large nodes are
+split on a process pool one level at a time, so independent subtrees are built
+on all cores; subtrees smaller than parallel_threshold are built serially by
+whichever process reaches them, since shipping them around costs more than it
+saves.
+
+With instrumentation on (see instrument.py) every split is a span tagged
+with its depth and size, and the spans recorded in the workers come back with
+their results.
+
+Node ids are assigned after the tree is built, in pre-order with children in
+label order, so they don't depend on the order workers finish in and no
+global counter is needed.
+
+A split function is called as split(data, indices) and returns either None
+(don't split this node) or (labels, centers), where labels gives a child
+number 0..k-1 for every index and centers is anything per child (e.g. the
+k-means centroids) or None. It has to be picklable (a module level function
+or a functools.partial of one) to run on the pool.
+
+The scripts also share make_split (a fixed or per node k, see kselect) and
+cluster_nodes (the ClusterNode tree with mean image previews).
+'''
+import os
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+from sklearn.cluster import KMeans
+import instrument
+import kselect
+import centroidwriter
+from clusternode import ClusterNode
+
+
+class BuildNode:
+    '''
+    A node of the tree being built.
+    indices - rows of the data in this node
+    depth - depth of the node, the root is 0
+    center - what the parent's split function returned for this child
+    children - list of BuildNode, or None for a leaf
+    id - pre-order id, set by number_nodes
+    '''
+    __slots__ = ('indices', 'depth', 'center', 'children', 'id')
+
+    def __init__(self, indices, depth=0, center=None):
+        self.indices = indices
+        self.depth = depth
+        self.center = center
+        self.children = None
+        self.id = None
+
+    @property
+    def size(self):
+        return len(self.indices)
+
+
+def _split(node, data, split, split_threshold, max_depth):
+    '''Split a node once. Returns the children, or None if the node is a leaf.'''
+    if node.size < split_threshold or node.depth >= max_depth:
+        return None
+    with instrument.span('split', depth=node.depth, size=node.size):
+        result = split(data, node.indices)
+    if result is None:
+        return None
+    labels, centers = result
+    labels = np.asarray(labels)
+    n_children = int(labels.max()) + 1 if centers is None else len(centers)
+    if n_children <= 1:
+        return None
+    children = [BuildNode(node.indices[labels == i], node.depth + 1,
+                          None if centers is None else centers[i])
+                for i in range(n_children)]
+    children = [child for child in children if child.size > 0]
+    instrument.count('nodes built', len(children))
+    return children
+
+
+def _build_serial(node, data, split, split_threshold, max_depth):
+    '''Build the whole subtree under node in this process, without recursion.'''
+    stack = [node]
+    while stack:
+        current = stack.pop()
+        current.children = _split(current, data, split, split_threshold, max_depth)
+        if current.children is not None:
+            stack.extend(current.children)
+    return node
+
+
+# State of a pool worker, set once by _init_worker so the data isn't sent with every task
+_worker = {}
+
+
+def _share(data):
+    '''
+    What to send to the workers for data. A memmap of a whole .npy file is sent
+    as its path and reopened, instead of pickling (and so copying) its contents.
+    '''
+    if isinstance(data, np.memmap) and data.filename and data.flags.c_contiguous:
+        try:
+            reopened = np.load(data.filename, mmap_mode='r')
+        except ValueError:
+            return data
+        if reopened.size == data.size and reopened.dtype == data.dtype:
+            return ('npy', data.filename, data.shape)
+    return data
+
+
+def _init_worker(data, split, split_threshold, max_depth, trace=False):
+    instrument.enable(trace)
+    instrument.drain() # a forked worker starts with a copy of the parent's events
+    if isinstance(data, tuple) and len(data) == 3 and data[0] == 'npy':
+        data = np.load(data[1], mmap_mode='r').reshape(data[2])
+    _worker.update(data=data, split=split, split_threshold=split_threshold, max_depth=max_depth)
+
+
+def _task(node, parallel_threshold):
+    '''
+    Run in a worker: build small subtrees completely, split big nodes once and
+    hand the children back so they can be fanned out again. Also returns the
+    instrumentation recorded meanwhile, if any.
+    '''
+    args = (_worker['data'], _worker['split'], _worker['split_threshold'], _worker['max_depth'])
+    if node.size < parallel_threshold:
+        _build_serial(node, *args)
+        return node, True, instrument.drain() if instrument.enabled else None
+    node.children = _split(node, *args)
+    return node, False, instrument.drain() if instrument.enabled else None
+
+
+def build_tree(data, split, n=None, split_threshold=10, max_depth=10,
+               parallel_threshold=1000, workers=None):
+    '''
+    Build a cluster tree.
+    data - whatever the split function needs (features, a distance matrix...)
+    split - split function, see the module docstring
+    n - number of points, len(data) if None
+    split_threshold and max_depth - stopping point for recursion
+    parallel_threshold - subtrees smaller than this are built serially
+    workers - size of the process pool. 1 (or a tree smaller than
+        parallel_threshold) builds everything in this process.
+    Returns the root BuildNode with ids assigned.
+    '''
+    if n is None:
+        n = len(data)
+    root = BuildNode(np.arange(n))
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    instrument.count('nodes built') # the root
+    if workers <= 1 or n < parallel_threshold:
+        with instrument.span('build tree', points=n):
+            _build_serial(root, data, split, split_threshold, max_depth)
+        return number_nodes(root)
+
+    with instrument.span('build tree', points=n, workers=workers), \
+            ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                initargs=(_share(data), split, split_threshold, max_depth, instrument.enabled)) as pool:
+        # Futures return a copy of the node, so remember where to put it back
+        pending = {pool.submit(_task, root, parallel_threshold): (None, 0)}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                parent, i = pending.pop(future)
+                node, finished, recorded = future.result()
+                if recorded is not None:
+                    instrument.merge(recorded)
+                if parent is None:
+                    root = node
+                else:
+                    parent.children[i] = node
+                if finished or node.children is None:
+                    continue
+                for j, child in enumerate(node.children):
+                    if child.size < split_threshold or child.depth >= max_depth:
+                        continue # a leaf, nothing to do
+                    pending[pool.submit(_task, child, parallel_threshold)] = (node, j)
+
+    return number_nodes(root)
+
+
+def kmeans_split(X, indices, k, random_state=0):
+    '''
+    Split function for plain k-means. The centers are the k-means centroids.
+    Seeded so rebuilding on the same data gives the same tree (and centroids).
+    '''
+    kmeans = KMeans(n_clusters=k, random_state=random_state).fit(X[indices])
+    return kmeans.labels_, kmeans.cluster_centers_
+
+
+def make_split(split, k, k_range=None, criterion='silhouette'):
+    '''
+    A split function from split(X, indices, k=...): with a fixed k, or with k
+    chosen per node from k_range (see kselect.adaptive_split), which falls
+    back to k on small nodes.
+    '''
+    if k_range is None:
+        return partial(split, k=k)
+    return partial(kselect.adaptive_split, split=split, k_range=tuple(k_range), criterion=criterion, k=k)
+
+
+def preorder(root):
+    '''Iterate over the nodes of a tree in pre-order, without recursion.'''
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        yield node
+        if node.children:
+            stack.extend(reversed(node.children))
+
+
+def number_nodes(root, start=0):
+    '''Assign deterministic pre-order ids.'''
+    for i, node in enumerate(preorder(root), start):
+        node.id = i
+    return root
+
+
+def iter_node_means(root, data):
+    '''
+    Mean of data (e.g. the images) over every node, as (node, float32 mean)
+    pairs with every child before its parent. Sums and counts are computed
+    once per leaf and then added up the tree, so every row of data is read
+    once instead of once per level, and parents are exactly size-weighted
+    averages of their children. A child's sum is dropped as soon as its parent
+    has absorbed it, and the biggest child of a node is done first, so only a
+    few sums per level of the tree are alive at once rather than one per node.
+    uint8 images are summed in uint32, anything else in float64.
+    '''
+    dtype = np.uint32 if data.dtype == np.uint8 else np.float64
+    sums = {} # id -> (sum, count) of the nodes whose parent isn't done yet
+    stack = [(root, False)]
+    while stack:
+        node, expanded = stack.pop()
+        if node.children is not None and not expanded:
+            stack.append((node, True))
+            # pushed smallest first, so the biggest child is done first
+            stack.extend((child, False) for child in sorted(node.children, key=lambda child: child.size))
+            continue
+        if node.children is None:
+            total, count = data[node.indices].sum(axis=0, dtype=dtype), node.size
+        else:
+            total, count = sums.pop(node.children[0].id)
+            for child in node.children[1:]:
+                child_total, child_count = sums.pop(child.id)
+                total += child_total
+                count += child_count
+        if node is not root:
+            sums[node.id] = (total, count)
+        yield node, np.divide(total, max(count, 1), out=np.empty(total.shape, dtype=np.float32), casting='unsafe')
+
+
+def node_means(root, data):
+    '''
+    iter_node_means as one float32 array indexed by node id. The array holds
+    every node's mean, so cluster_nodes streams them to the writer instead.
+    '''
+    means = np.empty((sum(1 for _ in preorder(root)),) + data.shape[1:], dtype=np.float32)
+    for node, mean in iter_node_means(root, data):
+        means[node.id] = mean
+    return means
+
+
+def convert(root, make_cluster, make_leaf, single_points=False):
+    '''
+    Turn a BuildNode tree into ClusterNodes (or anything with a children list).
+    make_cluster(node) - makes the cluster for an internal or leaf BuildNode
+    make_leaf(index) - makes the entry for a single point
+    single_points - make one point leaves (as in a dendrogram) with make_leaf
+        directly, instead of a cluster around a single point
+    '''
+    result = make_cluster(root)
+    stack = [(root, result)]
+    while stack:
+        node, cluster = stack.pop()
+        if node.children is None:
+            cluster.children = [make_leaf(i) for i in node.indices]
+            continue
+        cluster.children = []
+        for child in node.children:
+            if single_points and child.children is None and child.size == 1:
+                cluster.children.append(make_leaf(child.indices[0]))
+                continue
+            child_cluster = make_cluster(child)
+            cluster.children.append(child_cluster)
+            stack.append((child, child_cluster))
+    return result
+
+
+def write_previews(root, images, preview_pattern, writer):
+    '''
+    Write the mean image of every node as it's computed (see iter_node_means).
+    Returns {node id: preview path}.
+    '''
+    return {node.id: writer.write(preview_pattern.format(node.id), mean)
+            for node, mean in iter_node_means(root, images)}
+
+
+def cluster_nodes(root, images, names, preview_pattern, writer=None, single_points=False, annotate=None,
+                  make_leaf=None):
+    '''
+    ClusterNodes for a tree, previewed by the mean image of every node.
+    images - the images the indices refer to
+    names - image paths, leaves are named after their base name
+    preview_pattern - path of node i's preview, with {} for i
+    writer - centroidwriter.CentroidWriter for the previews (a default one if None)
+    single_points - as in convert
+    annotate(node, cluster) - called on every cluster, to add anything else
+    make_leaf(index) - entry for a single image, a plain ClusterNode if None
+    '''
+    if make_leaf is None:
+        def make_leaf(i):
+            return ClusterNode(os.path.basename(names[i]), names[i], 1)
+
+    with centroidwriter.using(writer) as writer:
+        previews = write_previews(root, images, preview_pattern, writer) # every centroid in one bottom-up pass
+
+        def make_cluster(node):
+            cluster = ClusterNode(f'cluster {node.id + 1}', size=node.size)
+            cluster.preview = previews[node.id]
+            if annotate is not None:
+                annotate(node, cluster)
+            return cluster
+
+        return convert(root, make_cluster, make_leaf, single_points=single_points)
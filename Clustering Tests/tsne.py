@@ -1,142 +1,113 @@
 import os
-import cv2
+import argparse
 from glob import glob
 import numpy as np
+from functools import partial
 from sklearn.manifold import TSNE
-from sklearn.decomposition import PCA
-from sklearn.cluster import KMeans
-import matplotlib.pyplot as plt
+import imageloader
+import featurecache
+import embedding
+import colorfeatures
+import treebuilder as tb
+import instrument
+from clusternode import ClusterNode, save_json
 
 
-# Used to store the clusters and output them JSON
-class ClusterNode:
-    def __init__(self, name=None, preview=None, size=None, x=None, y=None, bounds=None):
-        self.name = name
-        self.preview = preview
-        self.children = []
-        self.size = size
-        self.x = x
-        self.y = y
-        self.bounds = bounds
-    #This function outputs the required json string for this cluster and any children
-    def json(self, level=0):
-        indent = ' '*(2*level)
-        result = indent + '{\n'
-
-        if self.name is not None:
-            result += indent + '  "name" : "' + self.name + '",\n'
-
-        if self.preview is not None:
-            result += indent + '  "preview" : "' + self.preview + '",\n'
-
-        if self.size is not None:
-            result += indent + '  "size" : ' + str(self.size) + ',\n'
-
-        if self.x is not None:
-            result += indent + ' "x" : ' + str(self.x) + ',\n'
-
-        if self.y is not None:
-            result += indent + ' "y" : ' + str(self.y) + ',\n'
-
-        if self.bounds is not None:
-            result += indent + '  "bounds" : ' + str(self.bounds) + ',\n'
-
-        if self.children != []:
-            result += indent + '  "children" : [\n'
-
-            for subcluster in self.children:
-                result += subcluster.json(level=level + 2) + ',\n'
-            result = result[:-2] + '\n'
-            result += indent + '  ]\n,'
-
-        result = result[:-2] + '\n'
-        result += indent + '}'
-
-        return result
-
-
-cluster_id = 0
-
-
-def hierarchical_k_means(X, images, names, locations, k=7, split_threshold=10, max_depth=10):
+def hierarchical_k_means(X, images, names, locations, k=7, split_threshold=10, max_depth=10, workers=None, writer=None):
     '''
     Compute the hierarchical k means of a (transformed) data set.
     X - input data
+    images - the images, used to compute the centroid previews
     names - labels (to keep track of whats in which cluster)
     locations - locations of data poitns in a particular embedding
     k - branching factor. How many clusters per level.
     split_threshold and max_depth - stopping point for recursion
+    workers - processes to build subtrees on (see treebuilder)
+    writer - centroidwriter.CentroidWriter for the centroid images (a default one if None)
     '''
-    cluster = ClusterNode()
-    cluster.size = X.shape[0]
-    cluster.bounds = [np.min(locations[:, 0]), np.min(
-        locations[:, 1]), np.ptp(locations[:, 0]), np.ptp(locations[:, 1])]
-
-    # output the centroids to a separate file
-    global cluster_id
-    centroid_outname = './output/centroids/kmeans-centroid-' + \
-        str(cluster_id) + '.JPEG'
-    cluster_id += 1
-    cluster.name = f'cluster {cluster_id}'
-    cluster.preview = centroid_outname
-    cv2.imwrite(centroid_outname, np.mean(images, axis=0))
-
-    # Base Case
-    if X.shape[0] < split_threshold or max_depth <= 0:
-        cluster.children = [ClusterNode(os.path.basename(
-            name), name, 1, x=location[0], y=location[1]) for name, location in zip(names, locations)]
-        return cluster
-
-    # Cluster and Recurse
-    kmeans = KMeans(n_clusters=k).fit(X)
-    labels = kmeans.labels_
-
-    cluster.children = []
-    for i in range(k):
-        cluster_X = X[labels == i]
-        cluster_images = images[labels == i]
-        cluster_names = names[labels == i]
-        cluster_locations = locations[labels == i]
-        subcluster = hierarchical_k_means(cluster_X, cluster_images, cluster_names,
-                                          cluster_locations, k=k, split_threshold=split_threshold, max_depth=max_depth-1)
-
-        cluster.children.append(subcluster)
-
-    return cluster
-
-
-# Prepare input data
-print("Initializing images...")
-filenames = glob('./example-data/images/*.JPEG')
-images = [cv2.imread(fname) for fname in filenames]
-image_shape = images[0].shape
-X = np.stack(images).reshape(len(images), -1)
-
-# Reduce dimensionality
-print("Performing PCA...")
-X_reduced = PCA(n_components=20).fit_transform(X)
-
-print("Trying TSNE...")
-X_embedded = TSNE(n_components=2).fit_transform(X_reduced)
-
-# plt.scatter(X_embedded[:, 0], X_embedded[:, 1])
-# plt.show()
-
-# print("Comparing K-means...")
-# k-means on unreduced input points
-# kmeans = KMeans(n_clusters=7).fit(X)
-
-# plt.scatter(X_embedded[:, 0], X_embedded[:, 1], c=kmeans.labels_, cmap="Accent")
-# plt.show()
-
-print("Computing K-means...")
-
-hkmeans = hierarchical_k_means(X_reduced, np.stack(
-    images), np.array(filenames), X_embedded)
-
-f = open('./output/kmeans-tsne.json', 'w')
-f.write(hkmeans.json())
-f.write('\n')
-f.close()
-
-print("Done!")
+    tree = tb.build_tree(X, partial(tb.kmeans_split, k=k), split_threshold=split_threshold,
+                         max_depth=max_depth, workers=workers)
+
+    def annotate(node, cluster):
+        node_locations = locations[node.indices]
+        cluster.bounds = [np.min(node_locations[:, 0]), np.min(
+            node_locations[:, 1]), np.ptp(node_locations[:, 0]), np.ptp(node_locations[:, 1])]
+
+    def make_leaf(i):
+        return ClusterNode(os.path.basename(names[i]), names[i], 1, x=locations[i][0], y=locations[i][1])
+
+    return tb.cluster_nodes(tree, images, names, './output/centroids/kmeans-centroid-{}.JPEG', writer,
+                            annotate=annotate, make_leaf=make_leaf)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Hierarchical k-means on PCA features, laid out with t-SNE')
+    parser.add_argument('--landmarks', type=int, default=5000,
+                        help='images t-SNE runs on, the rest are interpolated (see embedding). 0 runs it on all')
+    parser.add_argument('--pca', default='randomized', choices=['randomized', 'incremental'],
+                        help="'randomized' fits on a sample of the images; 'incremental' fits on every image "
+                             "batch by batch, much slower, only for when the sample doesn't fit in memory")
+    parser.add_argument('--embedding', help='.npz to save the landmark layout and PCA to, to place new images later')
+    parser.add_argument('--features', choices=['pixels', 'color'], default='pixels',
+                        help='reduce the raw pixels or compact color descriptors (see colorfeatures)')
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    instrument.setup(args)
+    if args.embedding and not args.landmarks:
+        parser.error('--embedding needs --landmarks')
+
+    # Prepare input data
+    print("Initializing images...")
+    filenames = glob('./example-data/images/*.JPEG')
+    images = imageloader.load_images(filenames)
+    image_shape = images[0].shape
+    X = images.reshape(len(images), -1)
+
+    # Reduce dimensionality
+    hashes = featurecache.hash_files(filenames)
+    features = () # part of the cache keys
+    if args.features == 'color':
+        with instrument.span('features'), instrument.profile('features'):
+            X = featurecache.FeatureCache('color').get_or_compute(
+                filenames, lambda idx: colorfeatures.describe(images[idx]), hashes=hashes)
+        features = ('color',)
+    print("Performing PCA...")
+    with instrument.span('pca'), instrument.profile('pca'):
+        if args.embedding:
+            # the fitted PCA is saved with the layout, so don't take it from the cache
+            pca, X_reduced = embedding.stream_pca(X, n_components=20, method=args.pca)
+        else:
+            X_reduced = featurecache.cached_result('pca', featurecache.combined_hash(hashes, 20, args.pca, *features),
+                                                   lambda: embedding.stream_pca(X, n_components=20, method=args.pca)[1])
+
+    print("Trying TSNE...")
+    with instrument.span('tsne'), instrument.profile('tsne'):
+        if args.embedding:
+            landmark_embedding = embedding.LandmarkEmbedding(n_landmarks=args.landmarks).set_projection(pca)
+            X_embedded = landmark_embedding.fit_transform(X_reduced)
+            landmark_embedding.save(args.embedding)
+        elif args.landmarks:
+            X_embedded = featurecache.cached_result('tsne', featurecache.combined_hash(hashes, 20, args.pca, 2, args.landmarks, *features),
+                                                    lambda: embedding.LandmarkEmbedding(args.landmarks).fit_transform(X_reduced))
+        else:
+            X_embedded = featurecache.cached_result('tsne', featurecache.combined_hash(hashes, 20, args.pca, 2, *features),
+                                                    lambda: TSNE(n_components=2).fit_transform(X_reduced))
+
+    # plt.scatter(X_embedded[:, 0], X_embedded[:, 1])
+    # plt.show()
+
+    # print("Comparing K-means...")
+    # k-means on unreduced input points
+    # kmeans = KMeans(n_clusters=7).fit(X)
+
+    # plt.scatter(X_embedded[:, 0], X_embedded[:, 1], c=kmeans.labels_, cmap="Accent")
+    # plt.show()
+
+    print("Computing K-means...")
+
+    with instrument.span('clustering'), instrument.profile('clustering'):
+        hkmeans = hierarchical_k_means(X_reduced, images, np.array(filenames), X_embedded)
+
+    save_json(hkmeans, './output/kmeans-tsne.json')
+
+    print("Done!")